@@ -1,7 +1,8 @@
 #!/usr/env python
 # -*- coding: utf-8 -*-
 import os
-from config import load_config
+from config import load_config, get_option
+from lbsociam.lib import session
 
 
 class LBSociam(object):
@@ -32,4 +33,48 @@ class LBSociam(object):
         self.max_size = config.get('lbsociam', 'max_size')
         self.status_base = config.get('lbsociam', 'status_base')
         self.dictionary_base = config.get('lbsociam', 'dictionary_base')
-        self.gmaps_api_key = config.get('maps', 'api_key')
\ No newline at end of file
+        self.gmaps_api_key = config.get('maps', 'api_key')
+        gmaps_rate_limit = get_option(config, 'maps', 'rate_limit', 5)
+        self.gmaps_rate_limit = float(gmaps_rate_limit) if gmaps_rate_limit else None
+        self.gmaps_rate_burst = float(get_option(config, 'maps', 'rate_burst', 10))
+        gmaps_daily_quota = get_option(config, 'maps', 'daily_quota', 2500)
+        self.gmaps_daily_quota = int(gmaps_daily_quota) if gmaps_daily_quota else None
+        self.gmaps_quota_sleep = float(get_option(config, 'maps', 'quota_sleep', 86400))
+        # Brazilian cities CSV used for offline reverse geocoding
+        self.gazetteer = get_option(config, 'maps', 'gazetteer') or None
+        self.geo_tile_size = int(get_option(config, 'maps', 'geo_tile_size', 256))
+        self.location_cache_size = int(get_option(config, 'maps', 'location_cache_size', 10000))
+        location_disk_cache_size = get_option(config, 'maps', 'location_disk_cache_size')
+        self.location_disk_cache_size = int(location_disk_cache_size) if location_disk_cache_size else None
+        self.location_negative_ttl = float(get_option(config, 'maps', 'location_negative_ttl', 86400))
+        self.geo_concurrency = int(get_option(config, 'maps', 'geo_concurrency', 4))
+        self.geo_queue_size = int(get_option(config, 'maps', 'geo_queue_size', 100))
+        self.geo_retries = int(get_option(config, 'maps', 'geo_retries', 3))
+        self.geo_retry_interval = float(get_option(config, 'maps', 'geo_retry_interval', 1))
+        self.page_size = int(get_option(config, 'lbsociam', 'page_size', 1000))
+        self.batch_size = int(get_option(config, 'lbsociam', 'batch_size', 100))
+        self.srl_cache_enabled = get_option(config, 'lbsociam', 'srl_cache', 'true').lower() in ('true', 'yes', '1')
+        self.srl_cache_size = int(get_option(config, 'lbsociam', 'srl_cache_size', 200000))
+        self.corpus_page_size = int(get_option(config, 'lbsociam', 'corpus_page_size', 5000))
+        self.corpus_save_interval = int(get_option(config, 'lbsociam', 'corpus_save_interval', 50000))
+        self.lda_check_interval = float(get_option(config, 'lbsociam', 'lda_check_interval', 300))
+        self.lda_retrain_ratio = float(get_option(config, 'lbsociam', 'lda_retrain_ratio', 0.2))
+        self.lda_max_updates = int(get_option(config, 'lbsociam', 'lda_max_updates', 10))
+        self.lda_engine = get_option(config, 'lbsociam', 'lda_engine', 'single')
+        lda_workers = get_option(config, 'lbsociam', 'lda_workers')
+        self.lda_workers = int(lda_workers) if lda_workers else None
+        self.lda_passes = int(get_option(config, 'lbsociam', 'lda_passes', 1))
+        self.lda_chunksize = int(get_option(config, 'lbsociam', 'lda_chunksize', 2000))
+        self.category_index_ttl = float(get_option(config, 'lbsociam', 'category_index_ttl', 300))
+        self.frequency_flush_size = int(get_option(config, 'lbsociam', 'frequency_flush_size', 1000))
+        self.frequency_flush_interval = float(get_option(config, 'lbsociam', 'frequency_flush_interval', 30))
+        self.analytics_checkpoint = int(get_option(config, 'lbsociam', 'analytics_checkpoint', 0))
+
+        # HTTP connection pool shared by all bases in this process
+        session.configure(
+            pool_connections=int(get_option(config, 'lbgenerator', 'pool_connections', 10)),
+            pool_maxsize=int(get_option(config, 'lbgenerator', 'pool_maxsize', 10)),
+            max_retries=int(get_option(config, 'lbgenerator', 'max_retries', 0)),
+            connect_timeout=float(get_option(config, 'lbgenerator', 'connect_timeout', 5)),
+            timeout=float(get_option(config, 'lbgenerator', 'timeout', 60))
+        )
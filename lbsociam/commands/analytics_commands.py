@@ -14,8 +14,9 @@ from lbsociam.model import lbstatus
 from lbsociam import LBSociam
 from multiprocessing import Queue, Process
 from lbsociam.model import analytics
+from lbsociam.lib import documents
 from requests.exceptions import HTTPError
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 
 log = logging.getLogger()
 
@@ -28,6 +29,13 @@ class AnalyticsCommands(command.Command):
         paster analytics create_base
             - Create analytics base
 
+        paster analytics create_cube -s <start date> [-e <end date>]
+            - Fill data_dir/analytics/cube.npz with status by state, category and day from daily rollups
+
+        paster analytics rollup -s <start date> [-e <end date>] [-r]
+            - Compute daily rollups on data_dir/rollups missing on interval or with new or changed status.
+              -r computes every day on interval again
+
     The commands should be run from the LBSociam directory.
     """
 
@@ -65,6 +73,14 @@ class AnalyticsCommands(command.Command):
         default=None
     )
 
+    parser.add_option(
+        '-r', '--recompute',
+        action='store_true',
+        dest='recompute',
+        help='Compute every rollup on interval again',
+        default=False
+    )
+
     def __init__(self, name):
         """
         Constructor method
@@ -104,6 +120,12 @@ class AnalyticsCommands(command.Command):
         if cmd == 'create_analysis_categories':
             self.create_analysis_categories()
             return
+        if cmd == 'create_cube':
+            self.create_cube()
+            return
+        if cmd == 'rollup':
+            self.rollup()
+            return
         else:
             log.error('Command "%s" not recognized' % (cmd,))
 
@@ -173,8 +195,11 @@ class AnalyticsCommands(command.Command):
 
         # Now run on every status
         id_document_list = self.status_base.get_document_ids(offset=offset)
-        for status_id_doc in id_document_list:
-            task_queue.put(status_id_doc)
+
+        # Every task is a batch of id_doc fetched in one request
+        batches = list(documents.chunks(id_document_list, self.status_base.batch_size))
+        for id_list in batches:
+            task_queue.put(id_list)
 
         for i in range(processes):
             # Permite o processamento paralelo dos status
@@ -182,18 +207,18 @@ class AnalyticsCommands(command.Command):
 
         # Process responses
         log.debug("Processing responses")
-        for i in range(len(id_document_list)):
-            status_dict = done_queue.get()
-
-            # Add retry loop if connection errors
-            try:
-                self.analytics_base.process_response(status_dict=status_dict, id_doc=self.id_doc)
-                retry = False
-            except ConnectionError as e:
-                log.error("CONNECTION ERROR: connection error on %s\n%s", self.id_doc, e.message)
-                # Wait one second and retry
-                time.sleep(1)
-                self.analytics_base.process_response(status_dict=status_dict, id_doc=self.id_doc)
+        for i in range(len(batches)):
+            status_list = done_queue.get()
+
+            for status_dict in status_list:
+                # Add retry loop if connection errors
+                try:
+                    self.analytics_base.process_response(status_dict=status_dict, id_doc=self.id_doc)
+                except (ConnectionError, Timeout) as e:
+                    log.error("CONNECTION ERROR: connection error on %s\n%s", self.id_doc, e.message)
+                    # Wait one second and retry
+                    time.sleep(1)
+                    self.analytics_base.process_response(status_dict=status_dict, id_doc=self.id_doc)
 
         # Tell child processes to stop
         for i in range(processes):
@@ -207,35 +232,41 @@ class AnalyticsCommands(command.Command):
             result = self.process_status(func)
             output.put(result)
 
-    def process_status(self, status_id_doc):
+    def process_status(self, id_list):
         """
         Process status
-        :param id_doc: id_doc for analytics
-        :param status_id_doc: Status id_doc
-        :return: True or False
+        :param id_list: Batch of status id_doc
+        :return: List with one status dict or None for every status
         """
+        select = ['id_doc', 'positives', 'negatives']
         try:
-            result = self.status_base.get_document(status_id_doc)
-        except ConnectionError as e:
-            log.error("CONNECTION ERROR: Error processing %s\n%s", status_id_doc, e.message)
+            status_list = self.status_base.get_documents(id_list, select=select)
+        except (ConnectionError, Timeout) as e:
+            log.error("CONNECTION ERROR: Error processing batch starting at %s\n%s", id_list[0], e.message)
             time.sleep(1)
-            result = self.status_base.get_document(status_id_doc)
+            status_list = self.status_base.get_documents(id_list, select=select)
 
-        # JSON
-        status_dict = conv.document2dict(self.status_base.lbbase, result)
-        # Manually add id_doc
-        status_dict['_metadata'] = dict()
-        status_dict['_metadata']['id_doc'] = status_id_doc
+        saida = list()
+        for status_id_doc, status_dict in zip(id_list, status_list):
+            if status_dict is None:
+                saida.append(None)
+                continue
 
-        # Add status to analytics if positives are bigger than negatives
-        update = False
-        if status_dict.get('positives') is not None or status_dict.get('negatives') is not None:
-            update = True
+            # Manually add id_doc
+            status_dict['_metadata'] = dict()
+            status_dict['_metadata']['id_doc'] = status_id_doc
 
-        if update:
-            return status_dict
-        else:
-            return None
+            # Add status to analytics if positives are bigger than negatives
+            update = False
+            if status_dict.get('positives') is not None or status_dict.get('negatives') is not None:
+                update = True
+
+            if update:
+                saida.append(status_dict)
+            else:
+                saida.append(None)
+
+        return saida
 
     def create_analysis_categories(self, offset=0):
         """
@@ -268,3 +299,51 @@ class AnalyticsCommands(command.Command):
         )
 
         return result
+
+    def create_cube(self):
+        """
+        Create analytics cube for dates on command line
+        """
+        # Get starting date
+        if self.options.start is None:
+            raise StandardError("Start date is mandatory (-s)")
+        else:
+            start_date = datetime.datetime.strptime(self.options.start, "%Y-%m-%d")
+
+        # Get end date
+        if self.options.end is None:
+            end_date = datetime.datetime.now()
+        else:
+            end_date = datetime.datetime.strptime(self.options.end, "%Y-%m-%d")
+
+        self.status_base.documentrest.response_object = False
+        cube = self.analytics_base.create_cube(start_date, end_date)
+        log.info("Cube created. Status by state: %s", cube.by_state())
+
+        return cube
+
+    def rollup(self):
+        """
+        Update daily rollups for dates on command line
+        """
+        # Get starting date
+        if self.options.start is None:
+            raise StandardError("Start date is mandatory (-s)")
+        else:
+            start_date = datetime.datetime.strptime(self.options.start, "%Y-%m-%d")
+
+        # Get end date
+        if self.options.end is None:
+            end_date = datetime.datetime.now()
+        else:
+            end_date = datetime.datetime.strptime(self.options.end, "%Y-%m-%d")
+
+        self.status_base.documentrest.response_object = False
+        days = self.analytics_base.update_rollups(
+            start_date,
+            end_date,
+            recompute=self.options.recompute
+        )
+        log.info("Rollups computed for %s days", len(days))
+
+        return days
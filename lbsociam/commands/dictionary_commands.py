@@ -4,6 +4,8 @@ __author__ = 'eduardo'
 
 import logging
 import os
+import json
+import itertools
 from paste.script import command
 from lbsociam.model import dictionary, lbstatus
 from lbsociam.lib import dictionary as dictionary_lib
@@ -21,6 +23,9 @@ class DictionaryCommands(command.Command):
         paster dictionary create_base
             - Create dictionary base
 
+        paster dictionary benchmark_filter -n <number of status>
+            - Measure token filter throughput on stored status tokens
+
     The commands should be run from the LBSociam directory.
 
     """
@@ -42,6 +47,14 @@ class DictionaryCommands(command.Command):
         help='File to use in dictionary serialization'
     )
 
+    parser.add_option(
+        '-n', '--number',
+        action='store',
+        dest='number',
+        help='Number of status used in benchmarks',
+        default=1000
+    )
+
     def __init__(self, name):
         """
         Constructor method
@@ -80,6 +93,9 @@ class DictionaryCommands(command.Command):
         if cmd == 'dict_file':
             self.dict_file()
             return
+        if cmd == 'benchmark_filter':
+            self.benchmark_filter()
+            return
         else:
             log.error('Command "%s" not recognized' % (cmd,))
 
@@ -132,7 +148,7 @@ class DictionaryCommands(command.Command):
 
             outfile = dic_dir + '/' + self.options.outfile
             log.debug("Saving results on file %s", outfile)
-            result = dictionary_lib.insert_from_status(self.status_base, outfile)
+            result = dictionary_lib.insert_from_status(self.status_base, outfile=outfile)
 
         return result
 
@@ -152,4 +168,22 @@ class DictionaryCommands(command.Command):
         log.debug("Saving results on file %s", outfile)
         result = dictionary_lib.create_from_status(self.status_base, outfile)
 
-        return result
\ No newline at end of file
+        return result
+
+    def benchmark_filter(self):
+        """
+        Measure token filter throughput
+        """
+        status_list = itertools.islice(
+            self.status_base.iter_documents(select=['tokens']),
+            int(self.options.number)
+        )
+        token_list = list()
+        for elm in status_list:
+            if elm.get('tokens') is not None:
+                token_list += elm['tokens']
+
+        result = dictionary_lib.benchmark_filter(token_list)
+        print(json.dumps(result))
+
+        return result
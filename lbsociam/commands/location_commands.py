@@ -3,14 +3,17 @@
 __author__ = 'eduardo'
 
 import logging
+import json
 from paste.script import command
 from lbsociam.model import location
 from liblightbase.lbbase.struct import Base
 from liblightbase.lbsearch.search import *
 from lbsociam.model import lbstatus
 from lbsociam.model import dictionary as dicbase
+from lbsociam.lib import documents
+from lbsociam.lib import location as liblocation
 from multiprocessing import Queue, Process
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, HTTPError, Timeout
 
 log = logging.getLogger()
 
@@ -23,6 +26,9 @@ class LocationCommands(command.Command):
         paster crime create_base
             - Create crime base
 
+        paster location geo_deferred
+            - Search locations deferred while Google Maps was not available
+
     The commands should be run from the LBSociam directory.
 
     """
@@ -91,6 +97,9 @@ class LocationCommands(command.Command):
         if cmd == 'geo_status':
             self.geo_status()
             return
+        if cmd == 'geo_deferred':
+            self.geo_deferred()
+            return
         else:
             log.error('Command "%s" not recognized' % (cmd,))
 
@@ -154,8 +163,10 @@ class LocationCommands(command.Command):
 
         id_document_list = self.status_base.get_document_ids(offset=offset)
 
-        for id_doc in id_document_list:
-            task_queue.put(id_doc)
+        # Every task is a batch of id_doc fetched in one request
+        batches = list(documents.chunks(id_document_list, self.status_base.batch_size))
+        for id_list in batches:
+            task_queue.put(id_list)
 
         for i in range(processes):
             # Permite o processamento paralelo dos tokens
@@ -163,7 +174,7 @@ class LocationCommands(command.Command):
 
         # Process responses
         log.debug("Processing responses")
-        for i in range(processes):
+        for i in range(len(batches)):
             result = done_queue.get()
             log.info("Processing finished %s", result)
 
@@ -173,22 +184,72 @@ class LocationCommands(command.Command):
 
         return
 
+    def geo_deferred(self):
+        """
+        Search deferred locations and update their status
+        """
+        self.status_base.documentrest.response_object = False
+
+        # Make sure we don't have to validate returned structures from base
+        self.status_base.metaclass.__valreq__ = False
+
+        id_document_list = sorted(set(liblocation.resolve_deferred(self.location_base)))
+        log.info("LOCATION: %s deferred status found", len(id_document_list))
+
+        for id_list in documents.chunks(id_document_list, self.status_base.batch_size):
+            result = self.process_geo(id_list)
+            log.info("Processing finished %s", result)
+
+        log.info("LOCATION: cache stats %s", liblocation.cache_stats())
+
+        return
+
     def geo_worker(self, inp, output):
         for func in iter(inp.get, 'STOP'):
             result = self.process_geo(func)
             output.put(result)
 
-    def process_geo(self, id_doc):
+        log.info("LOCATION: cache stats %s", liblocation.cache_stats())
+
+    def process_geo(self, id_list):
         """
         Process tokens
-        :param id_doc: Document id_doc to be processed
+        :param id_list: Batch of document id_doc to be processed
         :return: True or False
         """
         try:
-            result = self.status_base.process_geo(id_doc)
-        except ConnectionError as e:
-            log.error("CONNECTION ERROR: Error processing id_doc = %s\n%s", id_doc, e.message)
+            status_list = self.status_base.get_documents(id_list)
+        except (ConnectionError, Timeout) as e:
+            log.error("CONNECTION ERROR: Error fetching batch starting at id_doc = %s\n%s", id_list[0], e.message)
+            # Try again
+            return self.process_geo(id_list)
+
+        found = list()
+        for id_doc, status_dict in zip(id_list, status_list):
+            if status_dict is None:
+                continue
+
+            # Manually add id_doc
+            status_dict['_metadata'] = dict()
+            status_dict['_metadata']['id_doc'] = id_doc
+            found.append(status_dict)
+
+        result = len(found) == len(id_list)
+        try:
+            found = self.status_base.process_geo_batch(found)
+        except (ConnectionError, Timeout) as e:
+            log.error("CONNECTION ERROR: Error processing batch starting at id_doc = %s\n%s", id_list[0], e.message)
             # Try again
-            result = self.process_geo(id_doc)
+            return self.process_geo(id_list)
+
+        for status_dict in found:
+            id_doc = status_dict.pop('_metadata')['id_doc']
+            try:
+                self.status_base.documentrest.update(id_doc, json.dumps(status_dict))
+            except HTTPError as e:
+                log.error("Error updating document id = %s\n%s", id_doc, e.message)
+                result = False
+
+        self.status_base.touch(found)
 
-        return result
\ No newline at end of file
+        return result
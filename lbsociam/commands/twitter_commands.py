@@ -7,17 +7,19 @@ import datetime
 import sys
 import lbsociam
 import json
+import itertools
 from paste.script import command
 from liblightbase import lbrest
 from lbsociam.model import lbtwitter
 from lbsociam.model import lbstatus
 from lbsociam.model import dictionary as dicbase
+from lbsociam.model import converter
 from liblightbase.lbbase.struct import Base
 from liblightbase.lbsearch.search import *
 from liblightbase.lbutils import conv
-from ..lib import srl, dictionary, location
+from ..lib import srl, dictionary, location, documents, lda, geostage
 from multiprocessing import Queue, Process
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 
 log = logging.getLogger()
 
@@ -32,6 +34,21 @@ class TwitterCommands(command.Command):
         paster lbtwitter clean -c <path to config file>
             - Remove all data from twitter
 
+        paster lbtwitter benchmark_conv -n <number of status>
+            - Compare compiled status converter with liblightbase conv
+
+        paster lbtwitter train_lda
+            - Train events LDA model and save a new version on data_dir/lda
+
+        paster lbtwitter benchmark_lda
+            - Compare training time and coherence for LDA engines
+
+        paster lbtwitter update_lda
+            - Update LDA model with status stored after the last version
+
+        paster lbtwitter recategorize -s <YYYY-MM-DD> -e <YYYY-MM-DD>
+            - Find category again for status stored on the date range
+
     The commands should be run from the LBSociam directory.
 
     """
@@ -84,6 +101,22 @@ class TwitterCommands(command.Command):
         default=None
     )
 
+    parser.add_option(
+        '-s', '--start',
+        action='store',
+        dest='start',
+        help='Start date',
+        default=None
+    )
+
+    parser.add_option(
+        '-e', '--end',
+        action='store',
+        dest='end',
+        help='End date',
+        default=None
+    )
+
     parser.add_option(
         '-k', '--tokenize',
         action='store',
@@ -152,6 +185,26 @@ class TwitterCommands(command.Command):
         if cmd == 'hashtags_twitter':
             self.hashtags_twitter()
 
+            return
+        if cmd == 'benchmark_conv':
+            self.benchmark_conv()
+
+            return
+        if cmd == 'train_lda':
+            self.train_lda()
+
+            return
+        if cmd == 'benchmark_lda':
+            self.benchmark_lda()
+
+            return
+        if cmd == 'update_lda':
+            self.update_lda()
+
+            return
+        if cmd == 'recategorize':
+            self.recategorize()
+
             return
         else:
             log.error('Command "%s" not recognized' % (cmd,))
@@ -259,8 +312,13 @@ class TwitterCommands(command.Command):
 
         id_document_list = self.status_base.get_document_ids(offset=offset)
 
-        for id_doc in id_document_list:
-            task_queue.put(id_doc)
+        # Load SRL model before forking so workers don't load it again
+        srl.load_tagger()
+
+        # Every task is a batch of id_doc fetched in one request
+        batches = list(documents.chunks(id_document_list, self.status_base.batch_size))
+        for id_list in batches:
+            task_queue.put(id_list)
 
         # if collection.result_count > (offset+processes):
             # Call the same function again increasing offset
@@ -272,7 +330,7 @@ class TwitterCommands(command.Command):
 
         # Process responses
         log.debug("Processing responses")
-        for i in range(processes):
+        for i in range(len(batches)):
             result = done_queue.get()
             log.info("Processing finished %s", result)
 
@@ -284,22 +342,77 @@ class TwitterCommands(command.Command):
 
     # Function run by worker processes
     def worker(self, inp, output):
+        # Geocoding runs on threads while this process tags the next status
+        geo_stage = geostage.GeoStage(
+            self.status_base,
+            concurrency=self.status_base.geo_concurrency,
+            queue_size=self.status_base.geo_queue_size,
+            retries=self.status_base.geo_retries,
+            retry_interval=self.status_base.geo_retry_interval
+        ).start()
+
         for func in iter(inp.get, 'STOP'):
-            result = self.process_tokens(func)
+            result = self.process_tokens(func, geo_stage=geo_stage)
             output.put(result)
 
-    def process_tokens(self, id_doc):
+        geo_stage.join()
+
+    def process_tokens(self, id_list, geo_stage=None):
         """
         Process tokens
-        :param id_doc: Document id_doc to be processed
+        :param id_list: Batch of document id_doc to be processed
+        :param geo_stage: GeoStage receiving status for geocoding. None to geocode on this process
         :return: True or False
         """
         try:
-            result = self.status_base.process_tokens(id_doc, update=False)
-        except ConnectionError as e:
-            log.error("CONNECTION ERROR: Error processing id_doc = %s\n%s", id_doc, e.message)
+            status_list = self.status_base.get_documents(id_list)
+        except (ConnectionError, Timeout) as e:
+            log.error("CONNECTION ERROR: Error fetching batch starting at id_doc = %s\n%s", id_list[0], e.message)
             # Try again
-            result = self.process_tokens(id_doc)
+            return self.process_tokens(id_list, geo_stage)
+
+        # Tag the batch texts with the process tagger
+        tokenized_list = srl.srl_tokenize_list(
+            [elm.get('text') if elm is not None else None for elm in status_list],
+            cache=self.status_base.srl_cache
+        )
+
+        # Tokens created by other processes since the last batch
+        self.dictionary_base.refresh_index()
+
+        # Dictionary frequencies for the whole batch are written together
+        aggregator = dictionary.FrequencyAggregator(
+            self.dictionary_base,
+            max_tokens=self.status_base.frequency_flush_size,
+            max_age=self.status_base.frequency_flush_interval
+        )
+
+        result = True
+        for id_doc, status_dict, tokenized in zip(id_list, status_list, tokenized_list):
+            if status_dict is None:
+                result = False
+                continue
+
+            try:
+                processed = self.status_base.process_tokens(
+                    id_doc,
+                    update=False,
+                    status_dict=status_dict,
+                    tokenized=tokenized,
+                    aggregator=aggregator,
+                    geo_stage=geo_stage
+                )
+            except (ConnectionError, Timeout) as e:
+                log.error("CONNECTION ERROR: Error processing id_doc = %s\n%s", id_doc, e.message)
+                # Try again
+                processed = self.status_base.process_tokens(id_doc, update=False, geo_stage=geo_stage)
+
+            result = result and processed
+
+        aggregator.flush()
+
+        # Rollups for the batch days are computed again
+        self.status_base.touch(status_list)
 
         return result
 
@@ -328,8 +441,10 @@ class TwitterCommands(command.Command):
 
         id_document_list = self.status_base.get_document_ids(offset=offset)
 
-        for id_doc in id_document_list:
-            task_queue.put(id_doc)
+        # Every task is a batch of id_doc fetched in one request
+        batches = list(documents.chunks(id_document_list, self.status_base.batch_size))
+        for id_list in batches:
+            task_queue.put(id_list)
 
         # if collection.result_count > (offset+processes):
             # Call the same function again increasing offset
@@ -341,7 +456,7 @@ class TwitterCommands(command.Command):
 
         # Process responses
         log.debug("Processing responses")
-        for i in range(processes):
+        for i in range(len(batches)):
             result = done_queue.get()
             log.info("Processing finished %s", result)
 
@@ -356,17 +471,120 @@ class TwitterCommands(command.Command):
             result = self.process_hashtags(func)
             output.put(result)
 
-    def process_hashtags(self, id_doc):
+    def process_hashtags(self, id_list):
         """
         Process tokens
-        :param id_doc: Document id_doc to be processed
+        :param id_list: Batch of document id_doc to be processed
         :return: True or False
         """
         try:
-            result = self.status_base.process_hashtags(id_doc)
-        except ConnectionError as e:
-            log.error("CONNECTION ERROR: Error processing id_doc = %s\n%s", id_doc, e.message)
+            status_list = self.status_base.get_documents(id_list)
+        except (ConnectionError, Timeout) as e:
+            log.error("CONNECTION ERROR: Error fetching batch starting at id_doc = %s\n%s", id_list[0], e.message)
             # Try again
-            result = self.process_hashtags(id_doc)
+            return self.process_hashtags(id_list)
+
+        result = True
+        for id_doc, status_dict in zip(id_list, status_list):
+            if status_dict is None:
+                result = False
+                continue
+
+            try:
+                processed = self.status_base.process_hashtags(id_doc, status_dict=status_dict)
+            except (ConnectionError, Timeout) as e:
+                log.error("CONNECTION ERROR: Error processing id_doc = %s\n%s", id_doc, e.message)
+                # Try again
+                processed = self.status_base.process_hashtags(id_doc)
+
+            result = result and processed is not False
+
+        return result
+
+    def benchmark_conv(self):
+        """
+        Compare compiled status converter with liblightbase conv
+        """
+        id_list = itertools.islice(
+            self.status_base.iter_documents(select=['id_doc']),
+            int(self.options.number)
+        )
+        document_list = [self.status_base.get_document(elm['_metadata']['id_doc']) for elm in id_list]
+
+        result = converter.benchmark(self.status_base.converter, document_list)
+        print(json.dumps(result))
+
+        return result
+
+    def train_lda(self):
+        """
+        Train a new LDA model version
+        """
+        model = lda.train_model(self.status_base)
+        log.info("LDA model version %s saved with %s documents", model.version, model.meta['num_docs'])
+
+        return model
+
+    def benchmark_lda(self):
+        """
+        Compare LDA training engines
+        """
+        result = lda.benchmark_engines(self.status_base)
+        print(json.dumps(result))
+
+        return result
+
+    def update_lda(self):
+        """
+        Update LDA model incrementally
+        """
+        model = lda.update_model(self.status_base)
+        log.info("LDA model version %s covers status up to id_doc = %s",
+                 model.version, model.meta['last_id_doc'])
+
+        return model
+
+    def recategorize(self):
+        """
+        Find category again for status on date range
+        """
+        # Get start date
+        if self.options.start is None:
+            raise StandardError("Start date is mandatory (-s)")
+        else:
+            start_date = datetime.datetime.strptime(self.options.start, "%Y-%m-%d")
+
+        # Get end date
+        if self.options.end is None:
+            end_date = datetime.datetime.now()
+        else:
+            end_date = datetime.datetime.strptime(self.options.end, "%Y-%m-%d")
+
+        status_list = self.status_base.iter_documents(
+            select=['id_doc', 'events_tokens', 'search_term', 'inclusion_date', 'inclusion_datetime'],
+            start_date=start_date,
+            end_date=end_date
+        )
+
+        total = 0
+        while True:
+            batch = list(itertools.islice(status_list, self.status_base.page_size))
+            if not batch:
+                break
+
+            self.status_base.classify_batch(batch)
+            for status_dict in batch:
+                if not status_dict.get('category'):
+                    continue
+
+                self.status_base.update_path(
+                    status_dict['_metadata']['id_doc'],
+                    'category',
+                    json.dumps(status_dict['category'])
+                )
+
+            self.status_base.touch(batch)
+            total += len(batch)
+            log.info("Categories updated for %s status", total)
 
-        return result
\ No newline at end of file
+        return total
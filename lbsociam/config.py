@@ -45,4 +45,19 @@ def load_config():
 
     cache = CacheManager(**parse_cache_config_options(cache_opts))
 
-    return config
\ No newline at end of file
+    return config
+
+
+def get_option(config, section, option, default=None):
+    """
+    Get optional configuration value
+    :param config: ConfigParser instance
+    :param section: Configuration section
+    :param option: Option name
+    :param default: Value returned when option is not set
+    :return: Option value or default
+    """
+    if config.has_option(section, option):
+        return config.get(section, option)
+
+    return default
@@ -0,0 +1,295 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import json
+import time
+import errno
+import random
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger()
+
+
+def make_key(*parts):
+    """
+    Build content address from key parts
+    :param parts: Strings identifying the content
+    :return: SHA1 hex digest
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        h.update(str(part))
+        h.update('\0')
+
+    return h.hexdigest()
+
+
+class DiskCache(object):
+    """
+    Content addressed JSON cache stored on disk.
+
+    Every entry is one file named after the key hash. Files are written to
+    a temporary name and renamed, so concurrent workers never read a
+    partial entry. When max_entries is set the oldest files by mtime are
+    removed once the directory grows past the limit, comparing only a
+    sample of the entries.
+    """
+    def __init__(self, path, max_entries=None, ttl=None, check_interval=1000, sample_size=1000):
+        """
+        Building method
+        :param path: Cache directory
+        :param max_entries: Maximum number of entries. None for no limit
+        :param ttl: Entry lifetime in seconds. None for no expiration
+        :param check_interval: Writes between size checks
+        :param sample_size: Minimum entries compared by mtime on eviction
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.sample_size = sample_size
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                # Another worker may have created it
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def filename(self, key):
+        """
+        File for this key
+        :param key: Key string
+        :return: Full path
+        """
+        return os.path.join(self.path, make_key(key) + '.json')
+
+    def get(self, key, default=None):
+        """
+        Get cached value
+        :param key: Key string
+        :param default: Returned on cache miss
+        :return: Cached value or default
+        """
+        filename = self.filename(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(filename) > self.ttl:
+                self.misses += 1
+                self.remove(filename)
+                return default
+
+            with open(filename, 'r') as fd:
+                value = json.load(fd)
+        except (IOError, OSError):
+            self.misses += 1
+            return default
+        except ValueError as e:
+            log.error("CACHE: invalid entry %s\n%s", filename, e)
+            self.misses += 1
+            self.remove(filename)
+            return default
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Store value atomically
+        :param key: Key string
+        :param value: JSON serializable value
+        """
+        filename = self.filename(key)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.rename(tmp, filename)
+        except (IOError, OSError) as e:
+            log.error("CACHE: error writing entry %s\n%s", filename, e)
+            self.remove(tmp)
+            return
+
+        self.writes += 1
+        if self.max_entries is not None and self.writes % self.check_interval == 0:
+            self.evict()
+
+    def remove(self, filename):
+        """
+        Remove file ignoring concurrent removals
+        :param filename: Full path
+        """
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        List of (mtime, filename) for every entry
+        """
+        saida = list()
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+
+            filename = os.path.join(self.path, name)
+            try:
+                saida.append((os.path.getmtime(filename), filename))
+            except OSError:
+                continue
+
+        return saida
+
+    def evict(self):
+        """
+        Remove old entries above max_entries.
+
+        Only file names are listed. Modification time is read for a random
+        sample twice as big as the excess, at least sample_size, and the
+        oldest entries of the sample are removed. Workers never stat the
+        whole directory.
+
+        :return: Number of entries removed
+        """
+        names = [name for name in os.listdir(self.path) if name.endswith('.json')]
+        extra = len(names) - self.max_entries
+        if extra <= 0:
+            return 0
+
+        sample_size = max(self.sample_size, 2 * extra)
+        if len(names) > sample_size:
+            names = random.sample(names, sample_size)
+
+        entries = list()
+        for name in names:
+            filename = os.path.join(self.path, name)
+            try:
+                entries.append((os.path.getmtime(filename), filename))
+            except OSError:
+                continue
+
+        entries.sort()
+        extra = min(extra, len(entries))
+        for mtime, filename in entries[:extra]:
+            self.remove(filename)
+
+        self.evictions += extra
+        log.debug("CACHE: %s entries evicted from %s", extra, self.path)
+
+        return extra
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+        for mtime, filename in self.entries():
+            self.remove(filename)
+
+    def stats(self):
+        """
+        Counters for this process
+        :return: dict
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / total if total > 0 else 0.0
+        }
+
+
+class LRUCache(object):
+    """
+    In-process least recently used cache.
+
+    Entries may carry their own expiration time, used for values that
+    must be looked up again after a while. Safe to share between threads.
+    """
+    def __init__(self, max_entries=10000):
+        """
+        Building method
+        :param max_entries: Maximum number of entries
+        """
+        self.max_entries = max_entries
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """
+        Get cached value and mark it as recently used
+        :param key: Key
+        :param default: Returned on cache miss
+        :return: Cached value or default
+        """
+        with self.lock:
+            try:
+                value, expires = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and time.time() > expires:
+                self.misses += 1
+                return default
+
+            self.data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value
+        :param key: Key
+        :param value: Any value
+        :param ttl: Entry lifetime in seconds. None for no expiration
+        """
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, expires)
+
+            while len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        """
+        Counters for this process
+        :return: dict
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.data),
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / total if total > 0 else 0.0
+        }
@@ -2,17 +2,17 @@
 # -*- coding: utf-8 -*-
 __author__ = 'eduardo'
 import logging
-from beaker.cache import cache_region
-from lbsociam.model.corpus import EventsCorpus
+from lbsociam.model.corpus import MmEventsCorpus
 
 log = logging.getLogger()
 
-@cache_region('long_term')
-def get_events_corpus(status_base):
+
+def load_events_corpus(status_base):
     """
-    Get cached events corpus
-    :return: EventsCorpus object instance
+    Load events corpus from disk with the status added since last update
+    :return: MmEventsCorpus object instance
     """
-    log.debug("EVENTS CORPUS: fetch events corpus from base %s", status_base.lbbase.metadata.name)
-    c = EventsCorpus(status_base=status_base)
+    log.debug("EVENTS CORPUS: update events corpus from base %s", status_base.schema.name)
+    c = MmEventsCorpus(status_base=status_base)
+    c.update()
     return c
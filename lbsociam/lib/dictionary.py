@@ -5,58 +5,137 @@ __author__ = 'eduardo'
 import os
 import sys
 import logging
-import requests
 import nltk
 import re
 import json
 import string
+import time
 from liblightbase.lbsearch.search import *
 from lbsociam.model import dictionary
+from lbsociam.lib import session
 from gensim import corpora, models
 from multiprocessing import Process, Queue
 from liblightbase.lbutils import conv
-from requests.exceptions import HTTPError, ConnectionError
+from requests.exceptions import HTTPError, ConnectionError, Timeout
 
 log = logging.getLogger()
 
 
+class TokenFilter(object):
+    """
+    Stopwords and punctuation filter built once per process
+    """
+    extra_stopwords = ('http', 'pro', 'https', 't.', 'co')
+
+    def __init__(self, stopwords=None, min_length=3):
+        """
+        Building method
+        :param stopwords: Stopword list. Defaults to NLTK portuguese stopwords
+        :param min_length: Minimum token length
+        """
+        if stopwords is None:
+            stopwords = nltk.corpus.stopwords.words('portuguese')
+
+        self.stopwords = frozenset(list(stopwords) + list(self.extra_stopwords))
+        self.min_length = min_length
+        self.word_re = re.compile(r'\w+')
+        self.table = string.maketrans("", "")
+        self.unicode_table = dict((ord(c), None) for c in string.punctuation)
+
+    def is_valid(self, word):
+        """
+        Check if word is a valid token
+        :param word: Token
+        :return: True or False
+        """
+        return word not in self.stopwords and \
+            self.word_re.match(word) is not None and \
+            len(word) >= self.min_length
+
+    def strip_punctuation(self, word):
+        """
+        Remove punctuations from word
+        :param word: Token
+        :return: Token without punctuations
+        """
+        if isinstance(word, unicode):
+            return word.translate(self.unicode_table)
+
+        return word.translate(self.table, string.punctuation)
+
+    def filter_tokens(self, tokens):
+        """
+        Keep valid tokens and remove punctuations
+        :param tokens: List of tokens
+        :return: List of valid tokens
+        """
+        is_valid = self.is_valid
+        strip = self.strip_punctuation
+        return [strip(text) for text in tokens if is_valid(text)]
+
+
+# Token filter for this process. NLTK data is available only after config load
+_token_filter = None
+
+
+def get_token_filter():
+    """
+    Get the process token filter
+    :return: TokenFilter instance
+    """
+    global _token_filter
+    if _token_filter is None:
+        _token_filter = TokenFilter()
+
+    return _token_filter
+
+
 def valid_word(word):
     """
     Apply processing to word and return valid word
     :return: True if it is valid or False if it is not
         If a list is supplied, return a list of valid tokens or empty list
     """
-    # Processing modules
-    stopwords = set(nltk.corpus.stopwords.words('portuguese'))
-    stopwords.update(['http', 'pro', 'https', 't.', 'co'])
-    table = string.maketrans("", "")
-    loc = re.LOCALE
-    if isinstance(loc, int):
-        re.LOCALE = 4
-    else:
-        re.LOCALE = 'pt_BR.UTF-8'
+    token_filter = get_token_filter()
 
     # Validate list or single word
     if type(word) == list:
-        saida = list()
+        return token_filter.filter_tokens(word)
 
-        for text in word:
-            if text not in stopwords and \
-                    re.match(r'\w+', text) and \
-                    len(text) > 2:
+    return token_filter.is_valid(word)
 
-                # Remove punctuations
-                text = text.translate(table, string.punctuation)
-                saida.append(text)
 
-        return saida
+def benchmark_filter(token_list, repeat=5):
+    """
+    Compare token filter with building stopwords and tables on every call
+    :param token_list: Tokens to validate
+    :param repeat: Number of passes over the tokens
+    :return: dict with tokens per second
+    """
+    t0 = time.time()
+    for i in range(repeat):
+        for word in token_list:
+            stopwords = set(nltk.corpus.stopwords.words('portuguese'))
+            stopwords.update(TokenFilter.extra_stopwords)
+            table = string.maketrans("", "")
+            word not in stopwords and re.match(r'\w+', word) and len(word) > 2
+    per_call = time.time() - t0
+
+    token_filter = get_token_filter()
+    t0 = time.time()
+    for i in range(repeat):
+        token_filter.filter_tokens(token_list)
+    compiled = time.time() - t0
+
+    total = len(token_list) * repeat
+    saida = {
+        'tokens': total,
+        'per_call_tps': total / per_call if per_call > 0 else None,
+        'filter_tps': total / compiled if compiled > 0 else None
+    }
+    log.info("TOKENS: %s tokens. per call setup = %.3fs filter = %.3fs", total, per_call, compiled)
 
-    if word not in stopwords and \
-            re.match(r'\w+', word) and \
-            len(word) > 2:
-        return True
-    else:
-        return False
+    return saida
 
 
 def status_to_document(status_list):
@@ -83,13 +162,19 @@ def create_from_documents(documents):
     return corpora.Dictionary(documents)
 
 
-def create_from_status(lbstatus, outfile=None, offset=0):
+def create_from_status(lbstatus, outfile=None, offset=0, page_size=None, save_interval=None):
     """
     Create dicitonary object from LBStatus Base
 
+    Status are streamed page by page, so the stack depth and memory used
+    don't depend on the base size. When an outfile is supplied the
+    dictionary is saved every save_interval status and at the end.
+
     :param lbstatus: LBStatus instance
     :param outfile: File to write out results
     :param offset: Start number
+    :param page_size: Status fetched per request. Defaults to config corpus_page_size
+    :param save_interval: Status processed between saves. Defaults to config corpus_save_interval
     :return: Gensim Dictionary object instance
     """
     # try:
@@ -98,69 +183,53 @@ def create_from_status(lbstatus, outfile=None, offset=0):
     #     log.error("You have to supply a status instance\n%s", e)
     #     return
 
-    # Stopwords and punctuations removal
-    stopwords = nltk.corpus.stopwords.words('portuguese')
-    re.LOCALE = 'pt_BR.UTF-8'
+    if page_size is None:
+        page_size = lbstatus.corpus_page_size
 
-    # Now return all the documents collection and parse it
-    orderby = OrderBy(asc=['id_doc'])
-    select = ['id_doc', 'arg_structures']
-    search = Search(
-        select=select,
-        limit=10,
-        offset=offset,
-        order_by=orderby
-    )
-    url = lbstatus.documentrest.rest_url
-    url += "/" + lbstatus.lbbase._metadata.name + "/doc"
-    vars = {
-        '$$': search._asjson()
-    }
+    if save_interval is None:
+        save_interval = lbstatus.corpus_save_interval
 
-    # Envia requisição para o REST
-    response = requests.get(url, params=vars)
-    collection = response.json()
+    select = ['id_doc', 'arg_structures', 'search_term']
     dic = corpora.Dictionary()
-    #print(collection)
-    for i in range(0, 10):
-        try:
-            result = collection['results'][i]
-        except IndexError:
-            break
+    token_filter = get_token_filter()
+    argument_re = re.compile('A[0-9]')
+
+    processed = 0
+    t0 = time.time()
+    for result in lbstatus.iter_documents(select=select, page_size=page_size, offset=offset):
+        processed += 1
+
         # Adiciona documentos ao dicionário
         if result.get('arg_structures') is not None:
             # Search for the events as argument
             tokens = list()
-            tokens.append(result.get('search_term'))
+            if result.get('search_term') is not None:
+                tokens.append(result.get('search_term'))
             for structure in result['arg_structures']:
                 for argument in structure['argument']:
-                    argument_name = argument['argument_name']
-                    log.debug("Looking for string as argument in argument_name = %s", argument_name)
-
-                    if re.match('A[0-9]', argument_name) is not None:
-                        log.debug("String match for argument_name = %s", argument_name)
-                        saida = valid_word(argument['argument_value'])
-
+                    if argument_re.match(argument['argument_name']) is not None:
                         # Add only valid tokens
-                        tokens += saida
+                        tokens += token_filter.filter_tokens(argument['argument_value'])
 
             dic.add_documents([tokens])
         else:
             log.error("Tokens não encontrados para o documento %s", result['_metadata']['id_doc'])
-            continue
 
-    if collection['result_count'] > (offset+10):
-        # Call the same function again increasing offset
-        create_from_status(
-            lbstatus=lbstatus,
-            outfile=outfile,
-            offset=(offset+10)
-        )
-    else:
-        if outfile is not None:
-            dic.save(outfile)
-        else:
-            return dic
+        if processed % save_interval == 0:
+            elapsed = time.time() - t0
+            log.info("DICTIONARY: %s status processed. %.1f status/s. %s tokens",
+                     processed, processed / elapsed if elapsed > 0 else 0, len(dic))
+            if outfile is not None:
+                dic.save(outfile)
+
+    elapsed = time.time() - t0
+    log.info("DICTIONARY: finished with %s status in %.2fs. %.1f status/s. %s tokens",
+             processed, elapsed, processed / elapsed if elapsed > 0 else 0, len(dic))
+
+    if outfile is not None:
+        dic.save(outfile)
+
+    return dic
 
 
 def insert_from_status(lbstatus,
@@ -182,11 +251,10 @@ def insert_from_status(lbstatus,
     dic_base.create_base()
 
     # Lust send the GET request
-    rest_url = lbstatus.documentrest.rest_url
-    rest_url += "/" + lbstatus.lbbase._metadata.name + "/doc/"
+    rest_url = lbstatus.schema.doc_url + "/"
 
     id_status_list = lbstatus.get_document_ids()
-    if id_status_list is None:
+    if not id_status_list:
         log.error("No status found. Import some status first")
         return False
 
@@ -194,7 +262,7 @@ def insert_from_status(lbstatus,
         params = dict(
             status_id=elm,
             outfile=outfile,
-            rest_url=rest_url + elm
+            rest_url=rest_url + str(elm)
         )
         task_queue.put(params)
 
@@ -208,29 +276,44 @@ def insert_from_status(lbstatus,
         if os.path.exists(outfile):
             dic.load(outfile)
 
+    # Workers only count tokens. Frequencies are written from here
+    aggregator = FrequencyAggregator(
+        dic_base,
+        max_tokens=lbstatus.frequency_flush_size,
+        max_age=lbstatus.frequency_flush_interval
+    )
+
     max_size = lbstatus.max_size
     # Merge results with this dictionary
     log.debug("Processing results from dictionary creation")
     for i in range(len(id_status_list)):
         # Update status after processing
         processed = done_queue.get()
+        if processed is None:
+            continue
+
         dic2 = processed['dic']
         result = processed['status']
+        status_id = result['_metadata']['id_doc']
+        aggregator.merge(processed['counts'])
 
-        status_dict = conv.document2dict(lbstatus.lbbase, result)
+        status_dict = lbstatus.converter.document2dict(result)
         try:
-            retorno = lbstatus.documentrest.update(params['status_id'], json.dumps(status_dict))
+            retorno = lbstatus.documentrest.update(status_id, json.dumps(status_dict))
         except HTTPError as e:
-            log.error("Error updating document id = %d\n%s" % (params['status_id'], e.message))
+            log.error("Error updating document id = %s\n%s" % (status_id, e.message))
+
+        aggregator.flush_if_needed()
 
         dic.merge_with(dic2)
-        log.debug("111111111111111111111: Novo dicionário %s", dic)
         if outfile is not None:
             # Serialize if it grows bigger than the amount of size
             if sys.getsizeof(dic, 0) >= max_size:
                 log.info("Serializing dict as it reached max size %s", max_size)
                 dic.save(outfile)
 
+    aggregator.flush()
+
     if outfile is not None:
         dic.save(outfile)
 
@@ -241,87 +324,253 @@ def insert_from_status(lbstatus,
     return True
 
 
-def process_tokens_dict(status_dict, dictionary_base, update=True):
+# RSLP stemmer for this process. Rules are loaded from NLTK data on creation
+_stemmer = None
+
+
+def get_stemmer():
+    """
+    Get the process RSLP stemmer
+    :return: RSLPStemmer instance
+    """
+    global _stemmer
+    if _stemmer is None:
+        _stemmer = nltk.stem.RSLPStemmer()
+
+    return _stemmer
+
+
+class FrequencyAggregator(object):
+    """
+    Accumulate dictionary frequency changes and write them in bulk.
+
+    Every token keeps its stem and the set of status id_doc where it was
+    found. On flush the known tokens are looked up on the token index, and
+    only the ones missing from it or having their frequency increased are
+    searched on base. Missing tokens are created and existing tokens get
+    their frequency increased by the number of new status, with one
+    request per token instead of one per occurrence.
+    """
+    def __init__(self, dictionary_base=None, max_tokens=1000, max_age=30):
+        """
+        Building method
+        :param dictionary_base: DictionaryBase instance. None only collects counts
+        :param max_tokens: Flush when this many tokens are pending
+        :param max_age: Flush when the oldest pending change has this many seconds
+        """
+        self.dictionary_base = dictionary_base
+        self.max_tokens = max_tokens
+        self.max_age = max_age
+        # token -> [stem, set of status id_doc, update]
+        self.entries = dict()
+        # token -> document dict or None, as found on base
+        self.known = dict()
+        self.started = time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, token, stem, status_id, update=True):
+        """
+        Count token found on status
+        :param token: Token
+        :param stem: Token stem
+        :param status_id: Status id_doc
+        :param update: Increase frequency if token is already on base
+        """
+        entry = self.entries.get(token)
+        if entry is None:
+            if not self.entries:
+                self.started = time.time()
+            entry = [stem, set(), False]
+            self.entries[token] = entry
+
+        entry[1].add(status_id)
+        entry[2] = entry[2] or update
+
+    def merge(self, counts):
+        """
+        Merge counts exported by another aggregator
+        :param counts: Return from export
+        """
+        for token, (stem, status_ids, update) in counts.items():
+            for status_id in status_ids:
+                self.add(token, stem, status_id, update)
+
+    def export(self):
+        """
+        Pending counts as plain structures, so they can go through a Queue
+        :return: dict token -> (stem, list of status id_doc, update)
+        """
+        return dict(
+            (token, (entry[0], list(entry[1]), entry[2])) for token, entry in self.entries.items()
+        )
+
+    def lookup(self, token_list):
+        """
+        Load tokens from the token index or base, keeping results for the aggregator lifetime
+        :param token_list: List of tokens
+        """
+        missing = [token for token in set(token_list) if token not in self.known]
+        if not missing or self.dictionary_base is None:
+            return
+
+        found = self.dictionary_base.get_by_tokens(missing)
+        for token in missing:
+            self.known[token] = found.get(token)
+
+    def exists(self, token):
+        """
+        True if token is on base or waiting to be created
+        """
+        return token in self.entries or self.known.get(token) is not None
+
+    def should_flush(self):
+        """
+        Check size and time thresholds
+        """
+        if not self.entries or self.dictionary_base is None:
+            return False
+
+        return len(self.entries) >= self.max_tokens or \
+            time.time() - self.started >= self.max_age
+
+    def flush_if_needed(self):
+        """
+        Flush only when a threshold is reached
+        :return: Number of tokens written
+        """
+        if self.should_flush():
+            return self.flush()
+
+        return 0
+
+    def flush(self):
+        """
+        Write pending changes to dictionary base
+        :return: Number of tokens written
+        """
+        if not self.entries or self.dictionary_base is None:
+            return 0
+
+        self.lookup(self.entries.keys())
+
+        # The index has no status list and may hold frequencies older than
+        # other writers, so tokens being increased are read from base
+        updated = [token for token, entry in self.entries.items()
+                   if entry[2] and self.known.get(token) is not None]
+        if updated:
+            self.known.update(self.dictionary_base.search_tokens(updated))
+
+        written = 0
+        for token, (stem, status_ids, update) in self.entries.items():
+            document = self.known.get(token)
+            if document is None:
+                dic_elm = dictionary.Dictionary(
+                    token=token,
+                    stem=stem,
+                    dic_base=self.dictionary_base
+                )
+                # Only the first status is stored. status_list never grows,
+                # so token documents keep a fixed size
+                dic_elm.frequency = len(status_ids) if update else 1
+                dic_elm.status_list = [min(status_ids)]
+
+                id_doc = dic_elm.create_dictionary()
+                if id_doc is not None:
+                    self.known[token] = dict(
+                        _metadata=dict(id_doc=id_doc),
+                        token=token,
+                        stem=stem,
+                        frequency=dic_elm.frequency,
+                        status_list=dic_elm.status_list
+                    )
+                written += 1
+            elif update:
+                status_list = document.get('status_list') or list()
+                delta = len(status_ids.difference(status_list))
+                if delta == 0:
+                    continue
+
+                frequency = (document.get('frequency') or 0) + delta
+                self.dictionary_base.update_frequency(
+                    document['_metadata']['id_doc'],
+                    frequency,
+                    token=token
+                )
+                document['frequency'] = frequency
+                log.debug("Token repetido: %s. Frequencia atualizada para %s", token, frequency)
+                written += 1
+
+        log.debug("DICTIONARY: %s tokens written from %s pending", written, len(self.entries))
+        self.entries = dict()
+        self.started = time.time()
+
+        return written
+
+
+def process_tokens_dict(status_dict, dictionary_base, update=True, aggregator=None):
+    """
+    Find events tokens on status and count them on dictionary
+
+    :param status_dict: Status dict with _metadata
+    :param dictionary_base: DictionaryBase instance
+    :param update: Whether we should update dictionary frequency or not
+    :param aggregator: FrequencyAggregator shared by many status. When it is
+        not supplied changes for this status are written before returning
+    :return: dict with Gensim Dictionary and status
+    """
     dic = corpora.Dictionary()
-    stemmer = nltk.stem.RSLPStemmer()
+    stemmer = get_stemmer()
+    status_id = status_dict['_metadata']['id_doc']
 
-    if status_dict.get('tokens') is not None:
-            # Search for the events as argument
-            tokens = list()
-            for structure in status_dict.get('arg_structures'):
-                for argument in structure.get('argument'):
-                    argument_name = argument['argument_name']
-                    log.debug("Looking for string as argument in argument_name = %s", argument_name)
-
-                    if re.match('A[0-9]', argument_name) is not None:
-                        log.debug("String match for argument_name = %s", argument_name)
-                        for elm in argument['argument_value']:
-
-                            # Check valid tokens
-                            if valid_word(elm):
-                                # Find element and update frequency
-                                stem = stemmer.stem(elm)
-                                dic_elm = dictionary.Dictionary(
-                                    token=elm,
-                                    stem=stem,
-                                    dic_base=dictionary_base
-                                )
-                                id_doc = dic_elm.get_id_doc()
-                                if id_doc is None:
-                                    dic_elm.frequency = 1
-                                    dic_elm.status_list = [status_dict['_metadata']['id_doc']]
-                                    document = dic_elm.create_dictionary()
-                                elif update:
-                                    # Try to update frequency
-                                    try:
-                                        if status_dict['_metadata']['id_doc'] not in dic_elm.status_list:
-                                            dic_elm.frequency += 1
-                                            # dic_elm.status_list.append(status_dict['_metadata']['id_doc'])
-                                    except AttributeError:
-                                        # No frequency yet
-                                        dic_elm.frequency = 1
-                                        # dic_elm.status_list = [status_dict['_metadata']['id_doc']]
-                                    document = dic_elm.update(id_doc)
-                                    log.debug("Token repetido: %s. Frequencia atualizada para %s", elm, dic_elm.frequency)
-
-                                else:
-                                    tokens.append(elm)
-                            else:
-                                log.debug("Invalid tokens in %s", elm)
-
-            # Add tokens back to status object
-            status_dict['events_tokens'] = tokens
+    local = aggregator is None
+    if local:
+        aggregator = FrequencyAggregator(dictionary_base)
 
-            dic.add_documents([tokens])
+    # Valid tokens found as arguments
+    candidates = list()
+    if status_dict.get('tokens') is not None:
+        # Search for the events as argument
+        for structure in status_dict.get('arg_structures'):
+            for argument in structure.get('argument'):
+                argument_name = argument['argument_name']
+
+                if re.match('A[0-9]', argument_name) is not None:
+                    for elm in argument['argument_value']:
+                        # Check valid tokens
+                        if valid_word(elm):
+                            candidates.append(elm)
+                        else:
+                            log.debug("Invalid tokens in %s", elm)
     else:
-        log.error("Tokens não encontrados para o documento %s", status_dict['_metadata']['id_doc'])
+        log.error("Tokens não encontrados para o documento %s", status_id)
+
+    search_term = status_dict['search_term']
+    if not update:
+        # Events tokens are the ones already known
+        aggregator.lookup(candidates + [search_term])
+
+    tokens = list()
+    for elm in candidates:
+        if not update and aggregator.exists(elm):
+            tokens.append(elm)
+        else:
+            aggregator.add(elm, stemmer.stem(elm), status_id, update)
+
+    if status_dict.get('tokens') is not None:
+        # Add tokens back to status object
+        status_dict['events_tokens'] = tokens
+        dic.add_documents([tokens])
 
     # Add search term on dictionary
-    elm = status_dict['search_term']
-    stem = stemmer.stem(elm)
-    dic_elm = dictionary.Dictionary(
-        token=elm,
-        stem=stem,
-        dic_base=dictionary_base
-    )
-    id_doc = dic_elm.get_id_doc()
-    if id_doc is None:
-        dic_elm.frequency = 1
-        dic_elm.status_list = [status_dict['_metadata']['id_doc']]
-        document = dic_elm.create_dictionary()
-    elif update:
-        # Try to update frequency
-        try:
-            if status_dict['_metadata']['id_doc'] not in dic_elm.status_list:
-                dic_elm.frequency += 1
-                # dic_elm.status_list = [id_doc]
-                # dic_elm.status_list.append(status_dict['_metadata']['id_doc'])
-        except AttributeError:
-            # No frequency yet
-            dic_elm.frequency = 1
-            # dic_elm.status_list = [status_dict['_metadata']['id_doc']]
-        document = dic_elm.update(id_doc)
-        log.debug("Token repetido: %s. Frequencia atualizada para %s", elm, dic_elm.frequency)
+    if update or not aggregator.exists(search_term):
+        aggregator.add(search_term, stemmer.stem(search_term), status_id, update)
+
+    if local:
+        aggregator.flush()
+    else:
+        aggregator.flush_if_needed()
 
     return {
         'dic': dic,
@@ -332,14 +581,14 @@ def process_tokens_dict(status_dict, dictionary_base, update=True):
 def process_tokens(params):
     """
     Process the documents
-    :return: Dictionary object
+    :return: Dictionary object and token counts
     """
     # Try to find doc
     try:
-        response = requests.get(
+        response = session.get(
             url=params['rest_url']
         )
-    except ConnectionError as e:
+    except (ConnectionError, Timeout) as e:
         log.error("Connection error trying to get document id = %s\n%s", params['status_id'], e.message)
         return None
 
@@ -349,7 +598,10 @@ def process_tokens(params):
 
     result = response.json()
 
-    response = process_tokens_dict(result, params['dictionary_base'])
+    # Only count here. The parent process writes merged frequencies
+    aggregator = FrequencyAggregator()
+    response = process_tokens_dict(result, None, aggregator=aggregator)
+    response['counts'] = aggregator.export()
 
     return response
 
@@ -389,14 +641,13 @@ def create_file(lbstatus, outfile, offset=0):
         offset=offset,
         order_by=orderby
     )
-    url = lbstatus.documentrest.rest_url
-    url += "/" + lbstatus.lbbase._metadata.name + "/doc"
+    url = lbstatus.schema.doc_url
     vars = {
         '$$': search._asjson()
     }
 
     # Envia requisição para o REST
-    response = requests.get(url, params=vars)
+    response = session.get(url, params=vars)
     collection = response.json()
     dic = corpora.Dictionary()
 
@@ -0,0 +1,213 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import logging
+import datetime
+from liblightbase.lbsearch.search import *
+from lbsociam.lib import session
+
+log = logging.getLogger()
+
+
+def date_literal(start_date, end_date=None):
+    """
+    Build inclusion_datetime filter for searches
+    :param start_date: Start date
+    :param end_date: End date. Defaults to now
+    :return: SQL literal or None if there is no start date
+    """
+    if start_date is None:
+        return None
+
+    if end_date is None:
+        # Default to now
+        end_date = datetime.datetime.now()
+
+    return """inclusion_datetime between '%s'::date and '%s'::date""" % (
+        start_date.strftime("%Y-%m-%d"),
+        end_date.strftime("%Y-%m-%d")
+    )
+
+
+def iter_documents(base,
+                   select=None,
+                   page_size=1000,
+                   literal=None,
+                   start_date=None,
+                   end_date=None,
+                   offset=0,
+                   last_id_doc=None):
+    """
+    Stream documents from a LB Base using keyset pagination.
+
+    Every page asks for documents with id_doc bigger than the last one
+    seen, so the cost of each request does not grow with the scan position
+    and only one page is kept in memory at a time.
+
+    :param base: Base instance with documentrest and lbbase attributes
+    :param select: Fields to be returned. Defaults to the whole document
+    :param page_size: Documents fetched per request
+    :param literal: Extra SQL filter
+    :param start_date: Filter by inclusion_datetime starting on this date
+    :param end_date: Filter by inclusion_datetime ending on this date
+    :param offset: Documents skipped on the first page
+    :param last_id_doc: Start scan after this id_doc
+    :return: Generator of document dicts
+    """
+    # id_doc is the pagination key, so it has to come back on every result
+    if select is not None and '*' not in select and 'id_doc' not in select:
+        select = ['id_doc'] + list(select)
+
+    filters = list()
+    if literal:
+        filters.append(literal)
+
+    dates = date_literal(start_date, end_date)
+    if dates is not None:
+        filters.append(dates)
+
+    orderby = OrderBy(asc=['id_doc'])
+    url = base.schema.doc_url
+
+    while True:
+        conditions = list(filters)
+        if last_id_doc is not None:
+            conditions.append("id_doc > %d" % int(last_id_doc))
+
+        search = Search(
+            select=select,
+            limit=page_size,
+            offset=offset,
+            order_by=orderby,
+            literal=" and ".join(conditions)
+        )
+        params = {
+            '$$': search._asjson()
+        }
+
+        # Envia requisição para o REST
+        response = session.get(url, params=params)
+        collection = response.json()
+
+        results = collection.get('results')
+        if results is None:
+            log.error("SCAN: Error searching base %s\n%s", base.schema.name, collection)
+            return
+
+        for document in results:
+            yield document
+
+        if len(results) < page_size:
+            # Last page
+            return
+
+        last_id_doc = results[-1]['_metadata']['id_doc']
+        offset = 0
+
+
+def chunks(id_list, size):
+    """
+    Split list in chunks
+    :param id_list: List to be split
+    :param size: Maximum chunk size
+    :return: Generator of lists
+    """
+    for i in range(0, len(id_list), size):
+        yield id_list[i:i + size]
+
+
+def get_documents(base, id_list, select=None, chunk_size=500):
+    """
+    Fetch many documents with a few id_doc in (...) searches
+
+    :param base: Base instance with documentrest and lbbase attributes
+    :param id_list: List of id_doc to fetch
+    :param select: Fields to be returned. Defaults to the whole document
+    :param chunk_size: Maximum number of id_doc in one search
+    :return: List of document dicts in id_list order. None for missing documents
+    """
+    if select is not None and '*' not in select and 'id_doc' not in select:
+        select = ['id_doc'] + list(select)
+
+    orderby = OrderBy(asc=['id_doc'])
+    url = base.schema.doc_url
+
+    found = dict()
+    for chunk in chunks(list(id_list), chunk_size):
+        literal = "id_doc in (%s)" % ",".join([str(int(id_doc)) for id_doc in chunk])
+        search = Search(
+            select=select,
+            limit=len(chunk),
+            order_by=orderby,
+            literal=literal
+        )
+        params = {
+            '$$': search._asjson()
+        }
+
+        # Envia requisição para o REST
+        response = session.get(url, params=params)
+        collection = response.json()
+
+        results = collection.get('results')
+        if results is None:
+            log.error("BULK: Error searching base %s\n%s", base.schema.name, collection)
+            continue
+
+        for document in results:
+            found[int(document['_metadata']['id_doc'])] = document
+
+    saida = list()
+    for id_doc in id_list:
+        document = found.get(int(id_doc))
+        if document is None:
+            log.error("BULK: Document id_doc = %s not found", id_doc)
+        saida.append(document)
+
+    return saida
+
+
+def iter_processed(base, field, state, max_scans=10):
+    """
+    Stream documents with field set that were not read yet.
+
+    Documents are processed out of id_doc order, so a document read before
+    field is set is kept as pending and fetched again on the next scans.
+    It is dropped after max_scans scans without field.
+
+    :param base: Base instance with iter_documents and get_documents methods
+    :param field: Field set when the document is processed
+    :param state: dict with last_id_doc, the last id_doc scanned, and pending,
+        a dict id_doc -> number of scans for documents read without field.
+        It is changed in place while documents are read
+    :param max_scans: Scans before a pending document is dropped
+    :return: Generator of document dicts
+    """
+    # JSON state files turn id_doc keys into strings
+    pending = dict((int(id_doc), scans) for id_doc, scans in (state.get('pending') or dict()).items())
+    state['pending'] = dict()
+
+    id_list = sorted(pending)
+    if id_list:
+        for id_doc, document in zip(id_list, base.get_documents(id_list, select=[field])):
+            if document is None:
+                continue
+
+            if document.get(field) is not None:
+                yield document
+                continue
+
+            scans = pending[id_doc] + 1
+            if scans < max_scans:
+                state['pending'][str(id_doc)] = scans
+            else:
+                log.error("SCAN: Document id_doc = %s still without %s after %s scans",
+                          id_doc, field, scans)
+
+    for document in base.iter_documents(select=[field], last_id_doc=state.get('last_id_doc')):
+        state['last_id_doc'] = document['_metadata']['id_doc']
+        if document.get(field) is not None:
+            yield document
+        else:
+            state['pending'][str(document['_metadata']['id_doc'])] = 1
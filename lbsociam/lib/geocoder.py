@@ -0,0 +1,215 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import csv
+import logging
+import numpy
+from scipy.spatial import cKDTree
+
+log = logging.getLogger()
+
+# Mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+# brasil_city fields read from the gazetteer. Other columns are ignored
+CITY_FIELDS = (
+    'city_id',
+    'city_name',
+    'city_state_id',
+    'state_name',
+    'state_short_name',
+    'state_slug',
+    'city_slug',
+    'city_lat',
+    'city_lng'
+)
+INTEGER_FIELDS = ('city_id', 'city_state_id')
+
+# Geocoders for this process by gazetteer file
+_geocoders = dict()
+
+
+def to_xyz(lat, lng):
+    """
+    Convert coordinates to points on the unit sphere
+    :param lat: Latitude in degrees. Number or array
+    :param lng: Longitude in degrees. Number or array
+    :return: Array with x, y, z on the last axis
+    """
+    lat = numpy.radians(numpy.asarray(lat, dtype=numpy.float64))
+    lng = numpy.radians(numpy.asarray(lng, dtype=numpy.float64))
+    cos_lat = numpy.cos(lat)
+
+    return numpy.stack([cos_lat * numpy.cos(lng), cos_lat * numpy.sin(lng), numpy.sin(lat)], axis=-1)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance
+    :return: Distance in meters. Number or array
+    """
+    lat1, lng1, lat2, lng2 = [
+        numpy.radians(numpy.asarray(elm, dtype=numpy.float64)) for elm in (lat1, lng1, lat2, lng2)
+    ]
+    a = numpy.sin((lat2 - lat1) / 2.0) ** 2 + \
+        numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lng2 - lng1) / 2.0) ** 2
+
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0.0, 1.0)))
+
+
+class Geocoder(object):
+    """
+    Offline reverse geocoder for Brazilian cities.
+
+    City coordinates are indexed as points on the unit sphere, where the
+    straight line nearest neighbour is also the great circle nearest
+    neighbour. Distances returned are haversine meters.
+    """
+    def __init__(self, cities):
+        """
+        Building method
+        :param cities: List of dicts with brasil_city fields
+        """
+        self.cities = list(cities)
+        self.lat = numpy.array([float(city['city_lat']) for city in self.cities])
+        self.lng = numpy.array([float(city['city_lng']) for city in self.cities])
+        self.tree = cKDTree(to_xyz(self.lat, self.lng))
+
+        # Radians used by batch queries, as one row to broadcast over points
+        self.lat_rad = numpy.radians(self.lat)[numpy.newaxis, :]
+        self.lng_rad = numpy.radians(self.lng)[numpy.newaxis, :]
+        self.cos_lat = numpy.cos(self.lat_rad)
+
+    def __len__(self):
+        return len(self.cities)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load gazetteer CSV file with a header line.
+
+        city_name, city_lat and city_lng columns are mandatory. The other
+        brasil_city fields are copied when available.
+
+        :param filename: CSV file
+        :return: Geocoder instance
+        """
+        cities = list()
+        with open(filename, 'rb') as fd:
+            for row in csv.DictReader(fd):
+                city = dict()
+                for field in CITY_FIELDS:
+                    value = row.get(field)
+                    if value is None or value == '':
+                        continue
+
+                    if field in INTEGER_FIELDS:
+                        value = int(value)
+                    elif field in ('city_lat', 'city_lng'):
+                        value = float(value)
+                    else:
+                        value = value.decode('utf-8')
+                    city[field] = value
+
+                cities.append(city)
+
+        log.info("GEOCODER: %s cities loaded from %s", len(cities), filename)
+
+        return cls(cities)
+
+    def city(self, index, distance):
+        """
+        brasil_city structure for city
+        :param index: City position
+        :param distance: Distance in meters
+        :return: brasil_city dict
+        """
+        saida = dict(self.cities[index])
+        saida['city_distance'] = float(distance)
+
+        return saida
+
+    def nearest(self, lat, lng, max_distance=None):
+        """
+        Find nearest city
+        :param lat: Latitude
+        :param lng: Longitude
+        :param max_distance: Max distance (Meters) to consider
+        :return: brasil_city dict or None if it is too far
+        """
+        chord, index = self.tree.query(to_xyz(lat, lng))
+        distance = haversine(lat, lng, self.lat[index], self.lng[index])
+        if max_distance is not None and distance > float(max_distance):
+            log.debug("Distance = %s bigger than maximum = %s", distance, max_distance)
+            return None
+
+        return self.city(index, distance)
+
+    def nearest_batch(self, lat, lng, max_distance=None, tile_size=256):
+        """
+        Find nearest city for many points with vectorized haversine.
+
+        Points are processed in tiles of tile_size rows, so the distance
+        matrix never has more than tile_size * number of cities elements.
+
+        :param lat: Array of latitudes
+        :param lng: Array of longitudes
+        :param max_distance: Max distance (Meters) to consider
+        :param tile_size: Points compared against every city at once
+        :return: Tuple of city index array, with -1 when too far, and distance array
+        """
+        lat = numpy.radians(numpy.asarray(lat, dtype=numpy.float64))
+        lng = numpy.radians(numpy.asarray(lng, dtype=numpy.float64))
+        total = len(lat)
+        indexes = numpy.empty(total, dtype=numpy.int64)
+        distances = numpy.empty(total, dtype=numpy.float64)
+
+        for start in range(0, total, tile_size):
+            end = min(start + tile_size, total)
+            tile_lat = lat[start:end, numpy.newaxis]
+            tile_lng = lng[start:end, numpy.newaxis]
+
+            # Haversine grows with a, so the nearest city has the smallest a
+            a = numpy.sin((self.lat_rad - tile_lat) / 2.0) ** 2 + \
+                numpy.cos(tile_lat) * self.cos_lat * numpy.sin((self.lng_rad - tile_lng) / 2.0) ** 2
+            nearest = a.argmin(axis=1)
+            best = a[numpy.arange(end - start), nearest]
+
+            indexes[start:end] = nearest
+            distances[start:end] = 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(best, 0.0, 1.0)))
+
+        if max_distance is not None:
+            indexes[distances > float(max_distance)] = -1
+
+        return indexes, distances
+
+    def cities_batch(self, lat, lng, max_distance=None, tile_size=256):
+        """
+        brasil_city structure for many points
+        :return: List of brasil_city dicts. None when the city is too far
+        """
+        indexes, distances = self.nearest_batch(lat, lng, max_distance, tile_size)
+
+        saida = list()
+        for index, distance in zip(indexes, distances):
+            if index < 0:
+                saida.append(None)
+            else:
+                saida.append(self.city(index, distance))
+
+        return saida
+
+
+def get_geocoder(filename):
+    """
+    Get geocoder for gazetteer file, loading it once per process
+    :param filename: Gazetteer CSV file
+    :return: Geocoder instance
+    """
+    geocoder = _geocoders.get(filename)
+    if geocoder is None:
+        geocoder = Geocoder.load(filename)
+        _geocoders[filename] = geocoder
+
+    return geocoder
@@ -0,0 +1,188 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import json
+import time
+import Queue
+import logging
+import threading
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+from lbsociam.lib import location
+
+log = logging.getLogger()
+
+
+class GeoStage(object):
+    """
+    Geocoding stage run by a pool of threads.
+
+    SRL workers submit status already stored on base and move on. Threads
+    search the location and Brasil city, waiting on ES, Google Maps and
+    LBGeo, and write location and brasil_city back to the status. The
+    queue is bounded, so submit blocks when geocoding falls behind.
+    Connection errors are retried by the same thread with a growing wait,
+    so a thread never blocks putting its own retry on a full queue.
+    """
+    def __init__(self, status_base, concurrency=4, queue_size=100, retries=3, retry_interval=1.0):
+        """
+        Building method
+        :param status_base: StatusBase instance
+        :param concurrency: Number of threads
+        :param queue_size: Status waiting for a thread
+        :param retries: Retries for status failing with connection errors
+        :param retry_interval: Seconds before first retry. Doubles on every retry
+        """
+        self.status_base = status_base
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.tasks = Queue.Queue(maxsize=queue_size)
+        self.threads = list()
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.found = 0
+        self.errors = 0
+        self.retried = 0
+        self.failed = list()
+        self.changed = list()
+        self.started = None
+
+    def start(self):
+        """
+        Start threads
+        :return: self
+        """
+        self.started = time.time()
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self.run, name='geo-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        return self
+
+    def submit(self, id_doc, status_dict):
+        """
+        Queue status for geocoding. Blocks while the queue is full
+        :param id_doc: Document ID
+        :param status_dict: Status dict with arg_structures
+        """
+        self.tasks.put((id_doc, status_dict))
+        with self.lock:
+            self.submitted += 1
+
+    def run(self):
+        """
+        Thread loop
+        """
+        for task in iter(self.tasks.get, None):
+            id_doc, status_dict = task
+            found = None
+            for attempt in range(self.retries + 1):
+                try:
+                    found = self.process(id_doc, status_dict)
+                    break
+                except (ConnectionError, Timeout, HTTPError) as e:
+                    log.error("GEO: Error processing id_doc = %s on attempt %s\n%s",
+                              id_doc, attempt + 1, e.message)
+                    if attempt == self.retries:
+                        break
+
+                    with self.lock:
+                        self.retried += 1
+                    time.sleep(self.retry_interval * 2 ** attempt)
+                except Exception as e:
+                    # Keep the thread alive for the remaining status
+                    log.exception("GEO: Unexpected error processing id_doc = %s\n%s", id_doc, e)
+                    break
+
+            with self.lock:
+                if found is None:
+                    self.errors += 1
+                    self.failed.append(id_doc)
+                elif found:
+                    self.found += 1
+
+    def process(self, id_doc, status_dict):
+        """
+        Find location and Brasil city for status
+        :param id_doc: Document ID
+        :param status_dict: Status dict
+        :return: True if the location was found
+        """
+        status_dict['_metadata'] = dict()
+        status_dict['_metadata']['id_doc'] = id_doc
+        status_dict = location.get_location(status_dict)
+        if status_dict.get('location') is None:
+            return False
+
+        status_dict = self.status_base.process_geo_dict(
+            id_doc=id_doc,
+            status_dict=status_dict
+        )
+        self.collect(id_doc, status_dict)
+
+        return True
+
+    def collect(self, id_doc, status_dict):
+        """
+        Write geocoding results back to status
+        :param id_doc: Document ID
+        :param status_dict: Status dict with location
+        """
+        self.status_base.update_path(id_doc, 'location', json.dumps(status_dict['location']))
+        if status_dict.get('brasil_city') is not None:
+            self.status_base.update_path(id_doc, 'brasil_city', json.dumps(status_dict['brasil_city']))
+
+            # State counts for the status day changed. Days are recorded
+            # once for every queue of status
+            with self.lock:
+                self.changed.append(dict(
+                    inclusion_date=status_dict.get('inclusion_date'),
+                    inclusion_datetime=status_dict.get('inclusion_datetime')
+                ))
+                if len(self.changed) < self.tasks.maxsize:
+                    return
+                changed, self.changed = self.changed, list()
+
+            self.status_base.touch(changed)
+
+    def join(self):
+        """
+        Wait for every queued status and stop threads
+        :return: Counters dict
+        """
+        for thread in self.threads:
+            self.tasks.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = list()
+        if self.changed:
+            self.status_base.touch(self.changed)
+            self.changed = list()
+
+        saida = self.stats()
+        log.info("GEO: stage finished %s", saida)
+        if self.failed:
+            log.error("GEO: status not geocoded: %s", self.failed)
+
+        return saida
+
+    def stats(self):
+        """
+        Counters for this stage
+        :return: dict
+        """
+        elapsed = time.time() - self.started if self.started is not None else 0.0
+        with self.lock:
+            return {
+                'submitted': self.submitted,
+                'found': self.found,
+                'errors': self.errors,
+                'retried': self.retried,
+                'pending': self.tasks.qsize(),
+                'elapsed': elapsed
+            }
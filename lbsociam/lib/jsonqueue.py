@@ -0,0 +1,101 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import json
+import fcntl
+import logging
+
+log = logging.getLogger()
+
+
+class JsonQueue(object):
+    """
+    Queue of JSON entries shared by every worker process.
+
+    Every entry is one JSON line appended under an exclusive lock, so
+    entries from all workers are kept.
+    """
+    def __init__(self, path):
+        """
+        Building method
+        :param path: Queue file
+        """
+        self.path = path
+
+    def put(self, **entry):
+        """
+        Append entry
+        """
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(entry) + '\n')
+
+    def parse(self, data):
+        """
+        Entries on file contents
+        :param data: File contents
+        :return: List of dicts
+        """
+        saida = list()
+        for line in data.splitlines():
+            try:
+                saida.append(json.loads(line))
+            except ValueError as e:
+                log.error("QUEUE: invalid entry %s on %s\n%s", line, self.path, e)
+
+        return saida
+
+    def read(self):
+        """
+        Every entry, keeping them on the queue
+        :return: Tuple with list of dicts and the size read, to be given to remove
+        """
+        if not os.path.exists(self.path):
+            return list(), 0
+
+        with open(self.path, 'r') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data = f.read()
+
+        return self.parse(data), len(data)
+
+    def remove(self, size):
+        """
+        Remove entries returned by read. Entries appended after read are kept
+        :param size: Size returned by read
+        """
+        if size == 0 or not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(size)
+            data = f.read()
+            f.seek(0)
+            f.write(data)
+            f.truncate()
+
+    def take(self):
+        """
+        Remove and return every entry
+        :return: List of dicts
+        """
+        if not os.path.exists(self.path):
+            return list()
+
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data = f.read()
+            f.seek(0)
+            f.truncate()
+
+        return self.parse(data)
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+
+        with open(self.path, 'r') as f:
+            return sum(1 for line in f)
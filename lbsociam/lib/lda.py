@@ -1,29 +1,497 @@
 #!/usr/env python
 # -*- coding: utf-8 -*-
 __author__ = 'eduardo'
+import os
+import re
+import json
 import time
+import errno
+import fcntl
+import shutil
 import logging
-import operator
+import tempfile
+import datetime
+import numpy
 from beaker.cache import cache_region
 from gensim.models import ldamodel
-from . import corpus
+from gensim.corpora import dictionary
+try:
+    from gensim.models import ldamulticore
+except ImportError:
+    # Available from gensim 0.10.2
+    ldamulticore = None
+try:
+    from gensim.models.coherencemodel import CoherenceModel
+except ImportError:
+    # Available from gensim 0.13
+    CoherenceModel = None
+from . import corpus, documents
+from .cache import make_key
 
 log = logging.getLogger()
 
+# Models loaded on this process by store path and number of topics
+_models = dict()
 
-@cache_region('long_term')
-def get_lda(c, n_topics=4):
+
+class StoredModel(object):
     """
-    Get LDA model
-    :param n_topics: Number of topics to use in model
+    LDA model and dictionary loaded from the model store
+    """
+    def __init__(self, lda, dic, meta):
+        """
+        Building method
+        :param lda: LdaModel instance
+        :param dic: Gensim Dictionary
+        :param meta: Model metadata
+        """
+        self.lda = lda
+        self.dic = dic
+        self.meta = meta
+
+    @property
+    def version(self):
+        return self.meta['version']
+
+    @property
+    def n_topics(self):
+        return self.meta['n_topics']
+
+
+class LdaModelStore(object):
+    """
+    Versioned LDA models saved on data_dir/lda/v<N>.
+
+    Every version directory holds the model, the gensim Dictionary and a
+    meta.json file with the corpus fingerprint. Versions are written to a
+    temporary directory and renamed, so readers never see a partial model.
+    """
+    version_re = re.compile(r'^v([0-9]+)$')
+
+    def __init__(self, data_dir):
+        """
+        Building method
+        :param data_dir: LBSociam data dir
+        """
+        self.path = os.path.join(data_dir, 'lda')
+        self.lock_file = os.path.join(self.path, 'lock')
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def version_dir(self, version):
+        """
+        Directory for model version
+        """
+        return os.path.join(self.path, 'v%d' % version)
+
+    def versions(self):
+        """
+        Saved versions
+        :return: Sorted list of version numbers
+        """
+        saida = list()
+        for name in os.listdir(self.path):
+            match = self.version_re.match(name)
+            if match is not None:
+                saida.append(int(match.group(1)))
+
+        return sorted(saida)
+
+    def read_meta(self, version):
+        """
+        Read version metadata
+        :param version: Version number
+        :return: Metadata dict
+        """
+        with open(os.path.join(self.version_dir(version), 'meta.json'), 'r') as fd:
+            return json.load(fd)
+
+    def latest(self, n_topics=None):
+        """
+        Latest saved version
+        :param n_topics: Only consider models with this number of topics
+        :return: Version number or None
+        """
+        for version in reversed(self.versions()):
+            if n_topics is None:
+                return version
+
+            try:
+                meta = self.read_meta(version)
+            except (IOError, ValueError) as e:
+                log.error("LDA: invalid model version %s\n%s", version, e)
+                continue
+
+            if meta.get('n_topics') == n_topics:
+                return version
+
+        return None
+
+    def save(self, lda, dic, **meta):
+        """
+        Save new model version
+        :param lda: LdaModel instance
+        :param dic: Gensim Dictionary
+        :param meta: Extra metadata
+        :return: StoredModel instance
+        """
+        tmp = tempfile.mkdtemp(dir=self.path, prefix='tmp')
+        lda.save(os.path.join(tmp, 'lda.model'))
+        dic.save(os.path.join(tmp, 'dictionary'))
+
+        while True:
+            versions = self.versions()
+            version = versions[-1] + 1 if versions else 1
+            meta['version'] = version
+            meta['n_topics'] = lda.num_topics
+            meta['created'] = datetime.datetime.now().isoformat()
+            with open(os.path.join(tmp, 'meta.json'), 'w') as fd:
+                json.dump(meta, fd)
+
+            try:
+                os.rename(tmp, self.version_dir(version))
+                break
+            except OSError as e:
+                # Another process saved this version first
+                if not os.path.isdir(self.version_dir(version)):
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    raise
+
+        log.info("LDA: model version %s saved on %s", version, self.path)
+
+        return StoredModel(lda, dic, meta)
+
+    def load(self, version=None, mmap='r'):
+        """
+        Load model version. Arrays are memory mapped by default
+        :param version: Version number. Defaults to latest
+        :param mmap: Memory map mode. None loads a writable copy
+        :return: StoredModel instance or None
+        """
+        if version is None:
+            version = self.latest()
+            if version is None:
+                return None
+
+        path = self.version_dir(version)
+        lda = ldamodel.LdaModel.load(os.path.join(path, 'lda.model'), mmap=mmap)
+        dic = dictionary.Dictionary.load(os.path.join(path, 'dictionary'))
+
+        return StoredModel(lda, dic, self.read_meta(version))
+
+
+def get_store(status_base):
+    """
+    Model store on the status base data dir
+    :return: LdaModelStore instance
+    """
+    return LdaModelStore(status_base.lbsociam_data_dir)
+
+
+def corpus_fingerprint(c):
+    """
+    Identify the corpus a model was trained with
     :param c: Corpus object
+    :return: Fingerprint string
+    """
+    return make_key(
+        c.status_base.schema.name,
+        c.last_id_doc,
+        c.dic.num_docs,
+        c.dic.num_pos,
+        c.dic.num_nnz
+    )
+
+
+def build_lda(bow_corpus,
+              dic,
+              n_topics=4,
+              engine='single',
+              workers=None,
+              passes=1,
+              chunksize=2000):
+    """
+    Train LDA model with the selected engine
+    :param bow_corpus: Bag of words corpus
+    :param dic: Gensim Dictionary
+    :param n_topics: Number of topics to use in model
+    :param engine: single for LdaModel or multicore for LdaMulticore
+    :param workers: LdaMulticore worker processes. None uses cpu count - 1
+    :param passes: Passes over the corpus
+    :param chunksize: Documents in each training chunk
     :return: LDA model
     """
-    lda = ldamodel.LdaModel(c.corpus, id2word=c.dic, num_topics=n_topics)
-    return lda
+    if engine == 'multicore':
+        if ldamulticore is not None:
+            return ldamulticore.LdaMulticore(
+                bow_corpus,
+                id2word=dic,
+                num_topics=n_topics,
+                workers=workers,
+                passes=passes,
+                chunksize=chunksize
+            )
+
+        log.error("LDA: LdaMulticore is not available on this gensim version. Using LdaModel")
+
+    return ldamodel.LdaModel(
+        bow_corpus,
+        id2word=dic,
+        num_topics=n_topics,
+        passes=passes,
+        chunksize=chunksize
+    )
+
+
+def engine_options(status_base):
+    """
+    LDA training options from config
+    :param status_base: StatusBase instance
+    :return: dict with build_lda keyword arguments
+    """
+    return dict(
+        engine=status_base.lda_engine,
+        workers=status_base.lda_workers,
+        passes=status_base.lda_passes,
+        chunksize=status_base.lda_chunksize
+    )
+
+
+def train_model(status_base, n_topics=4, store=None):
+    """
+    Train events LDA model and save a new version
+    :param status_base: StatusBase instance
+    :param n_topics: Number of topics
+    :param store: LdaModelStore instance
+    :return: StoredModel instance
+    """
+    if store is None:
+        store = get_store(status_base)
+
+    t0 = time.time()
+    c = corpus.load_events_corpus(status_base)
+    t1 = time.time() - t0
+    log.debug("LDA: Time to generate Corpus: %s seconds", t1)
+
+    t0 = time.time()
+    options = engine_options(status_base)
+    lda = build_lda(c.corpus, c.dic, n_topics, **options)
+    t1 = time.time() - t0
+    log.info("LDA: Time to train model in base %s for %s topics with %s engine: %s seconds",
+             status_base.schema.name,
+             n_topics,
+             options['engine'],
+             t1)
+
+    model = store.save(
+        lda,
+        c.dic,
+        base=status_base.schema.name,
+        fingerprint=corpus_fingerprint(c),
+        last_id_doc=c.last_id_doc,
+        pending=c.pending,
+        num_docs=c.dic.num_docs,
+        updates=0,
+        engine=options['engine']
+    )
+    _models[(store.path, n_topics)] = (model, time.time())
+
+    return model
+
+
+def extend_vocabulary(lda, dic):
+    """
+    Grow model topic-word matrices for tokens added to the dictionary
+    :param lda: LdaModel instance
+    :param dic: Extended gensim Dictionary
+    :return: Number of new terms
+    """
+    new_terms = len(dic) - lda.num_terms
+    if new_terms <= 0:
+        return 0
+
+    state = lda.state
+    state.sstats = numpy.hstack([state.sstats, numpy.zeros((lda.num_topics, new_terms))])
+
+    # Word prior may be a scalar or one value per term
+    for owner in (lda, state):
+        eta = getattr(owner, 'eta', None)
+        if isinstance(eta, numpy.ndarray):
+            if eta.ndim == 1:
+                owner.eta = numpy.hstack([eta, numpy.repeat(eta.mean(), new_terms)])
+            else:
+                owner.eta = numpy.hstack([eta, numpy.repeat(eta.mean(axis=1)[:, numpy.newaxis], new_terms, axis=1)])
+
+    lda.num_terms = len(dic)
+    lda.id2word = dic
+    lda.expElogbeta = numpy.exp(state.get_Elogbeta())
+
+    return new_terms
+
+
+def update_model(status_base, n_topics=4, store=None):
+    """
+    Update latest model with status added after its watermark.
+
+    Only status with id_doc bigger than the model last_id_doc and status
+    still pending SRL on the last update are read.
+    New tokens extend the Dictionary and the model matrices, and the model
+    is trained with LdaModel.update. A full retrain happens instead when
+    there is no model yet, when the new tokens are more than
+    lda_retrain_ratio of the vocabulary or when lda_max_updates
+    incremental versions were saved since the last full training.
+
+    :param status_base: StatusBase instance
+    :param n_topics: Number of topics
+    :param store: LdaModelStore instance
+    :return: StoredModel instance
+    """
+    if store is None:
+        store = get_store(status_base)
+
+    version = store.latest(n_topics)
+    if version is None:
+        log.info("LDA: no model found on %s. Training first version", store.path)
+        return train_model(status_base, n_topics, store)
+
+    # Arrays are changed in place, so they can't be memory mapped
+    model = store.load(version, mmap=None)
+    updates = model.meta.get('updates', 0)
+    if updates >= status_base.lda_max_updates:
+        log.info("LDA: %s incremental updates since last training. Retraining", updates)
+        return train_model(status_base, n_topics, store)
+
+    # Status still waiting for SRL are kept as pending and read again
+    scan = dict(
+        last_id_doc=model.meta.get('last_id_doc'),
+        pending=model.meta.get('pending')
+    )
+    texts = [document['events_tokens']
+             for document in documents.iter_processed(status_base, 'events_tokens', scan)]
+
+    if not texts:
+        log.info("LDA: no new status after id_doc = %s", model.meta.get('last_id_doc'))
+        return model
+
+    dic = model.dic
+    known_terms = len(dic)
+    dic.add_documents(texts)
+    new_terms = len(dic) - known_terms
+    if known_terms == 0 or float(new_terms) / known_terms > status_base.lda_retrain_ratio:
+        log.info("LDA: %s new tokens for %s known. Retraining", new_terms, known_terms)
+        return train_model(status_base, n_topics, store)
+
+    t0 = time.time()
+    lda = model.lda
+    extend_vocabulary(lda, dic)
+    lda.update([dic.doc2bow(text) for text in texts])
+    log.info("LDA: model updated with %s status and %s new tokens in %s seconds",
+             len(texts), new_terms, time.time() - t0)
+
+    model = store.save(
+        lda,
+        dic,
+        base=status_base.schema.name,
+        fingerprint=make_key(model.meta['fingerprint'], scan['last_id_doc'], len(texts)),
+        last_id_doc=scan['last_id_doc'],
+        pending=scan['pending'],
+        num_docs=model.meta.get('num_docs', 0) + len(texts),
+        updates=updates + 1,
+        parent=model.version
+    )
+    _models[(store.path, n_topics)] = (model, time.time())
+
+    return model
+
+
+def get_model(status_base, n_topics=4):
+    """
+    Get LDA model from store, training the first version if there is none.
+
+    The first version is trained under a lock on the store, so forked
+    workers starting on an empty store train only one model.
+
+    Loaded models are kept for this process. The store is checked again for
+    newer versions every lda_check_interval seconds.
+
+    :param status_base: StatusBase instance
+    :param n_topics: Number of topics
+    :return: StoredModel instance
+    """
+    store = get_store(status_base)
+    key = (store.path, n_topics)
+    cached = _models.get(key)
+    if cached is not None:
+        model, checked = cached
+        if time.time() - checked < status_base.lda_check_interval:
+            return model
+
+        version = store.latest(n_topics)
+        if version is None or version == model.version:
+            _models[key] = (model, time.time())
+            return model
+    else:
+        version = store.latest(n_topics)
+
+    if version is None:
+        # Only one worker trains the first version. The others wait for it
+        with open(store.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            version = store.latest(n_topics)
+            if version is None:
+                log.info("LDA: no model found on %s. Training first version", store.path)
+                return train_model(status_base, n_topics, store)
+
+    model = store.load(version)
+    _models[key] = (model, time.time())
+    log.debug("LDA: loaded model version %s from %s", version, store.path)
+
+    return model
+
+
+def benchmark_engines(status_base, n_topics=4, engines=('single', 'multicore')):
+    """
+    Train one model for each engine on the events corpus
+    :param status_base: StatusBase instance
+    :param n_topics: Number of topics
+    :param engines: Engines to compare
+    :return: dict engine -> training seconds and u_mass coherence
+    """
+    c = corpus.load_events_corpus(status_base)
+    bow_corpus = c.corpus
+    options = engine_options(status_base)
+
+    saida = dict()
+    for engine in engines:
+        options['engine'] = engine
+        t0 = time.time()
+        lda = build_lda(bow_corpus, c.dic, n_topics, **options)
+        elapsed = time.time() - t0
+
+        coherence = None
+        if CoherenceModel is not None:
+            coherence = CoherenceModel(
+                model=lda,
+                corpus=bow_corpus,
+                dictionary=c.dic,
+                coherence='u_mass'
+            ).get_coherence()
+
+        saida[engine] = {
+            'seconds': elapsed,
+            'coherence': coherence
+        }
+        log.info("LDA: %s engine trained in %.2fs. u_mass coherence = %s", engine, elapsed, coherence)
+
+    saida['documents'] = len(bow_corpus)
+
+    return saida
 
 
-@cache_region('long_term')
 def crime_topics(
         status_base,
         crimes_base,
@@ -32,19 +500,21 @@ def crime_topics(
     Generate crime topics
     :return: dict with term frequency calculated by LDA
     """
-    t0 = time.clock()
-    c = corpus.get_events_corpus(status_base)
-    t1 = time.clock() - t0
-    log.debug("TOPICS: Time to generate Corpus for topics: %s seconds", t1)
+    model = get_model(status_base, n_topics)
 
-    t0 = time.clock()
-    lda = get_lda(c, n_topics)
-    t1 = time.clock() - t0
-    log.debug("TOPICS: Time to generate LDA Model in base %s for %s topics: %s seconds",
-              status_base.lbbase.metadata.name,
-              n_topics,
-              t1)
+    model_key = "%s:%s" % (model.version, model.meta['fingerprint'])
 
+    return model_topics(model_key, model, status_base, crimes_base, n_topics)
+
+
+@cache_region('long_term')
+def model_topics(model_key, model, status_base, crimes_base, n_topics):
+    """
+    Crime topics for a model version
+    :param model_key: Model version and fingerprint, used as cache key
+    :return: dict with term frequency calculated by LDA
+    """
+    lda = model.lda
     topics_list = lda.show_topics(num_topics=n_topics, formatted=False)
     base_info = status_base.get_base()
     total_status = int(base_info['result_count'])
@@ -77,12 +547,12 @@ def crime_topics(
 
             # Get category if we didn't find it yet
             if saida[i].get('category') is None:
-                category = crimes_base.get_token_by_name(word)
+                category = crimes_base.get_category_by_token(word)
                 if category is None:
                     continue
                 if category['category_name'] not in found_categories:
                     found_categories.append(category['category_name'])
-                    saida[i]['category'] = crimes_base.get_token_by_name(word)
+                    saida[i]['category'] = category
 
                     # Finish searching
                     continue
@@ -92,33 +562,54 @@ def crime_topics(
     return saida
 
 
-@cache_region('long_term')
 def get_category(status,
                  status_base,
                  crimes_base,
                  n_topics=4):
+    """
+    Find status category with the stored LDA model
+    :param status: Status dict
+    :param status_base: StatusBase instance used to train the model
+    :param crimes_base: CrimesBase instance
+    :param n_topics: Number of topics
+    :return: Status dict with category
+    """
+    return classify_batch([status], status_base, crimes_base, n_topics)[0]
 
-    t0 = time.clock()
-    c = corpus.get_events_corpus(status_base)
-    t1 = time.clock() - t0
-    log.debug("CATEGORY: Time to generate Corpus: %s seconds", t1)
-
-    t0 = time.clock()
-    lda = get_lda(c, n_topics)
-    t1 = time.clock() - t0
-    log.debug("CATEGORY: Time to generate LDA Model in base %s for %s topics: %s seconds",
-              status_base.lbbase.metadata.name,
-              n_topics,
-              t1)
-
-    # Produce sorted list of probabilities
-    if status.get('events_tokens') is not None:
-        vec_bow = c.dic.doc2bow(status['events_tokens'])
-    else:
-        # Use search term when it is not possible to use events tokens
-        vec_bow = c.dic.doc2bow([status['search_term']])
-    vec_lda = lda[vec_bow]
-    sorted_vec_lda = sorted(vec_lda, key=operator.itemgetter(1), reverse=True)
+
+def classify_batch(status_list,
+                   status_base,
+                   crimes_base,
+                   n_topics=4):
+    """
+    Find category for many status with one inference call.
+
+    The bag of words for every status goes to LdaModel.inference at once,
+    and the topic with the highest probability is taken from the normalized
+    gamma matrix.
+
+    :param status_list: List of status dicts
+    :param status_base: StatusBase instance used to train the model
+    :param crimes_base: CrimesBase instance
+    :param n_topics: Number of topics
+    :return: List of status dicts with category
+    """
+    if not status_list:
+        return status_list
+
+    model = get_model(status_base, n_topics)
+
+    bow_list = list()
+    for status in status_list:
+        if status.get('events_tokens') is not None:
+            bow_list.append(model.dic.doc2bow(status['events_tokens']))
+        else:
+            # Use search term when it is not possible to use events tokens
+            bow_list.append(model.dic.doc2bow([status.get('search_term') or '']))
+
+    gamma, sstats = model.lda.inference(bow_list)
+    theta = gamma / gamma.sum(axis=1)[:, numpy.newaxis]
+    topic_ids = theta.argmax(axis=1)
 
     # Get categories
     category_list = crime_topics(
@@ -127,18 +618,19 @@ def get_category(status,
         n_topics
     )
 
-    # This will the topic with highest probability
-    category_index = sorted_vec_lda[0][0]
-    category = category_list[category_index]
+    for i, status in enumerate(status_list):
+        # This will the topic with highest probability
+        category_index = int(topic_ids[i])
+        category = category_list[category_index]
 
-    if category.get('category') is not None:
-        # Add this category back to status
-        status['category'] = {
-            'category_id_doc': category['category']['_metadata']['id_doc'],
-            'category_probability': sorted_vec_lda[0][1]
-        }
-    else:
-        log.error("CATEGORY: Not found for status id = %s", status['_metadata']['id_doc'])
-        status['category'] = {}
+        if category.get('category') is not None:
+            # Add this category back to status
+            status['category'] = {
+                'category_id_doc': category['category']['_metadata']['id_doc'],
+                'category_probability': float(theta[i, category_index])
+            }
+        else:
+            log.error("CATEGORY: Not found for status id = %s", status.get('_metadata', {}).get('id_doc'))
+            status['category'] = {}
 
-    return status
\ No newline at end of file
+    return status_list
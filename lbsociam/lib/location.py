@@ -5,15 +5,276 @@ __author__ = 'eduardo'
 import logging
 import json
 import re
+import os
 import time
 from lbsociam.model import gmaps
 from googlemaps.exceptions import ApiError, TransportError, Timeout, _RetriableRequest
 from lbsociam.model import location as loc
+from lbsociam.lib.cache import DiskCache, LRUCache
 
 log = logging.getLogger()
 
-# Wakeup time if Search APi is sleeping
-wakeup_time = None
+# Location cache for this process
+_cache = None
+
+# Location fields kept on cache entries
+LOCATION_FIELDS = ('latitude', 'longitude', 'location_name', 'id_location')
+
+# Characters ignored when comparing location strings
+PUNCTUATION = re.compile(r'[^\w\s]', re.UNICODE)
+
+
+class MapsUnavailable(Exception):
+    """
+    Google Maps could not answer. Not the same as location not found
+    """
+    pass
+
+
+def normalize(name):
+    """
+    Normalize location string used as cache key
+    :param name: Location string
+    :return: Lowercase string without punctuation and with collapsed whitespace
+    """
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+
+    return u' '.join(PUNCTUATION.sub(u' ', name.lower()).split())
+
+
+class LocationCache(object):
+    """
+    Layered cache for location strings.
+
+    Lookups go through an in-process LRU, a disk cache shared by every
+    worker, the locations base and finally Google Maps. Strings not found
+    anywhere are stored as negative entries that expire after negative_ttl
+    seconds, so they are not searched again on every status.
+    """
+    def __init__(self, path, max_entries=10000, disk_entries=None, negative_ttl=86400):
+        """
+        Building method
+        :param path: Disk cache directory
+        :param max_entries: Entries kept in memory
+        :param disk_entries: Entries kept on disk. None for no limit
+        :param negative_ttl: Seconds before a location not found is searched again
+        """
+        self.memory = LRUCache(max_entries)
+        self.disk = DiskCache(path, max_entries=disk_entries)
+        self.negative_ttl = negative_ttl
+        self.counters = {
+            'lookups': 0,
+            'memory': 0,
+            'disk': 0,
+            'base': 0,
+            'maps': 0,
+            'not_found': 0,
+            'unavailable': 0
+        }
+
+    def entry(self, result):
+        """
+        Cache entry for search result
+        :param result: Location dict or None if not found
+        :return: dict with result and expiration time
+        """
+        if result is None:
+            return {
+                'result': None,
+                'expires': time.time() + self.negative_ttl
+            }
+
+        return {
+            'result': dict((key, result[key]) for key in LOCATION_FIELDS if result.get(key) is not None),
+            'expires': None
+        }
+
+    def remember(self, key, entry):
+        """
+        Store entry on memory
+        """
+        ttl = None
+        if entry['expires'] is not None:
+            ttl = entry['expires'] - time.time()
+
+        self.memory.set(key, entry, ttl=ttl)
+
+    def fetch(self, location_base, name, id_doc=None):
+        """
+        Search location on base and Google Maps
+        :param location_base: LocationBase instance
+        :param name: Location string
+        :param id_doc: Status id_doc deferred with the lookup if Google Maps is not available
+        :return: Cache entry or None if Google Maps is not available
+        """
+        result = location_base.get_location(name)
+        if result is not None:
+            self.counters['base'] += 1
+            return self.entry(result)
+
+        try:
+            result = maps_geocode(name)
+        except MapsUnavailable:
+            self.counters['unavailable'] += 1
+            gmaps.get_maps().deferred.put(location=name, id_doc=id_doc)
+            return None
+
+        if result is None:
+            self.counters['not_found'] += 1
+            return self.entry(None)
+
+        self.counters['maps'] += 1
+        # This is the string used on search
+        result['city'] = name
+        id_doc = location_base.add_location(result)
+        log.debug("New location stored. id_doc = %s", id_doc)
+        result['id_location'] = id_doc
+
+        return self.entry(result)
+
+    def search(self, location_base, name, id_doc=None):
+        """
+        Find location going through every tier
+        :param location_base: LocationBase instance
+        :param name: Location string
+        :param id_doc: Status id_doc deferred with the lookup if Google Maps is not available
+        :return: Location dict or None
+        """
+        key = normalize(name)
+        if not key:
+            return None
+
+        self.counters['lookups'] += 1
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.counters['memory'] += 1
+            return entry['result']
+
+        entry = self.disk.get(key)
+        if entry is not None and entry['expires'] is not None and time.time() > entry['expires']:
+            entry = None
+
+        if entry is not None:
+            self.counters['disk'] += 1
+        else:
+            entry = self.fetch(location_base, name, id_doc)
+            if entry is None:
+                return None
+            self.disk.set(key, entry)
+
+        self.remember(key, entry)
+
+        return entry['result']
+
+    def stats(self):
+        """
+        Counters for this process
+        :return: dict with lookups resolved by every tier and their ratio
+        """
+        saida = dict(self.counters)
+        lookups = self.counters['lookups']
+        for tier in ('memory', 'disk', 'base', 'maps', 'not_found'):
+            saida[tier + '_ratio'] = float(self.counters[tier]) / lookups if lookups > 0 else 0.0
+        saida['memory_cache'] = self.memory.stats()
+        saida['disk_cache'] = self.disk.stats()
+
+        return saida
+
+
+def get_cache(location_base):
+    """
+    Get the process location cache
+    :param location_base: LocationBase instance with configuration
+    :return: LocationCache instance
+    """
+    global _cache
+    path = os.path.join(location_base.lbsociam_data_dir, 'location_cache')
+    if _cache is None or _cache.disk.path != path:
+        _cache = LocationCache(
+            path,
+            max_entries=location_base.location_cache_size,
+            disk_entries=location_base.location_disk_cache_size,
+            negative_ttl=location_base.location_negative_ttl
+        )
+
+    return _cache
+
+
+def cache_stats():
+    """
+    Location cache counters for this process
+    :return: dict. Empty if the cache was not used
+    """
+    if _cache is None:
+        return dict()
+
+    return _cache.stats()
+
+
+def search_location(location_base, location, cache=True, id_doc=None):
+    """
+    Find coordinates for location string
+    :param location_base: LocationBase instance
+    :param location: Location string
+    :param cache: Use cache to store and retrieve results
+    :param id_doc: Status id_doc deferred with the lookup if Google Maps is not available
+    :return: Location dict or None
+    """
+    if cache:
+        return get_cache(location_base).search(location_base, location, id_doc)
+
+    return maps_search(location)
+
+
+def resolve_deferred(location_base):
+    """
+    Search again lookups deferred while Google Maps was not available.
+    Lookups still not possible are deferred again.
+
+    :param location_base: LocationBase instance
+    :return: List of status id_doc with a location found
+    """
+    deferred = gmaps.get_maps().deferred
+    entries = deferred.take()
+    log.info("LOCATION: %s deferred lookups", len(entries))
+
+    cache = get_cache(location_base)
+    saida = list()
+    for i, entry in enumerate(entries):
+        unavailable = cache.counters['unavailable']
+        result = cache.search(location_base, entry['location'], entry.get('id_doc'))
+        if cache.counters['unavailable'] > unavailable:
+            # Still not available. Keep remaining lookups
+            for elm in entries[i + 1:]:
+                deferred.put(**elm)
+            log.info("LOCATION: Google Maps not available. %s lookups deferred", len(entries) - i)
+            break
+
+        if result is not None and entry.get('id_doc') is not None:
+            saida.append(entry['id_doc'])
+
+    return saida
+
+
+def set_location(status, result, loc_origin):
+    """
+    Copy search result to status location
+    :param status: status dict
+    :param result: Location dict
+    :param loc_origin: Location source
+    :return: status with location
+    """
+    status['location']['latitude'] = result['latitude']
+    status['location']['longitude'] = result['longitude']
+    status['location']['city'] = result['location_name']
+    if result.get('id_location') is not None:
+        status['location']['id_location'] = result['id_location']
+
+    # Register source
+    status['location']['loc_origin'] = loc_origin
+
+    return status
 
 
 def get_location(status, cache=True):
@@ -28,6 +289,7 @@ def get_location(status, cache=True):
     source = source[0]
     status['location'] = dict()
     location_base = loc.LocationBase()
+    id_doc = status['_metadata']['id_doc']
 
     geo = source.get('_geo')
     if geo is not None:
@@ -54,33 +316,10 @@ def get_location(status, cache=True):
         return status
 
     location = source.get('_location')
-    if location is not None:
-        # Check for empty string
-        if location:
-            # Try to use cache first
-            if cache:
-                result = location_base.get_location(location)
-                if result is None:
-                    result = maps_search(location)
-                    if result is not None:
-                        # This is the string used on search
-                        result['city'] = location
-                        id_doc = location_base.add_location(result)
-                        log.debug("New location stored. id_doc = %s", id_doc)
-                        status['location']['id_location'] = id_doc
-
-            else:
-                result = maps_search(location)
-
-            if result is not None:
-                status['location']['latitude'] = result['latitude']
-                status['location']['longitude'] = result['longitude']
-                status['location']['city'] = result['location_name']
-
-                # Register source
-                status['location']['loc_origin'] = 'location'
-
-                return status
+    if location:
+        result = search_location(location_base, location, cache, id_doc)
+        if result is not None:
+            return set_location(status, result, 'location')
 
     # Focus: use SRL to find location
     for structure in status['arg_structures']:
@@ -92,29 +331,9 @@ def get_location(status, cache=True):
                 # Convert list os values to string
                 location = " ".join(argument['argument_value'])
                 log.info("LOCATION: string match for argument_name = %s. Location = %s", argument_name, location)
-                # Try to use cache first
-                if cache:
-                    result = location_base.get_location(location)
-                    if result is None:
-                        result = maps_search(location)
-                        if result is not None:
-                            # This is the string used on search
-                            result['city'] = location
-                            id_doc = location_base.add_location(result)
-                            log.debug("New location stored. id_doc = %s", id_doc)
-                            status['location']['id_location'] = id_doc
-                else:
-                    result = maps_search(argument['argument_value'])
-
+                result = search_location(location_base, location, cache, id_doc)
                 if result is not None:
-                    status['location']['latitude'] = result['latitude']
-                    status['location']['longitude'] = result['longitude']
-                    status['location']['city'] = result['location_name']
-
-                    # Register source
-                    status['location']['loc_origin'] = 'srl'
-
-                    return status
+                    return set_location(status, result, 'srl')
 
     # Last try: consider user location
     user = source.get('_user')
@@ -144,32 +363,10 @@ def get_location(status, cache=True):
             return status
 
         location = user.get('_location')
-        if location is not None:
-            # Check for empty string
-            if location:
-                # Try to use cache first
-                if cache:
-                    result = location_base.get_location(location)
-                    if result is None:
-                        result = maps_search(location)
-                        if result is not None:
-                            # This is the string used on search
-                            result['city'] = location
-                            id_doc = location_base.add_location(result)
-                            log.debug("New location stored. id_doc = %s", id_doc)
-                            status['location']['id_location'] = id_doc
-                else:
-                    result = maps_search(location)
-
-                if result is not None:
-                    status['location']['latitude'] = result['latitude']
-                    status['location']['longitude'] = result['longitude']
-                    status['location']['city'] = result['location_name']
-
-                    # Register source
-                    status['location']['loc_origin'] = 'user_location'
-
-                    return status
+        if location:
+            result = search_location(location_base, location, cache, id_doc)
+            if result is not None:
+                return set_location(status, result, 'user_location')
 
     # If I'm here, it was not possible to find the location
     log.error("LOCATION: Location not found for status id = %s", status['_metadata']['id_doc'])
@@ -184,20 +381,29 @@ def maps_search(location):
     :param location: text location identified
     :return: dict with latitude and longitude
     """
+    try:
+        return maps_geocode(location)
+    except MapsUnavailable:
+        return None
+
+
+def maps_geocode(location):
+    """
+    Search for location in Google Maps API
+    :param location: text location identified
+    :return: dict with latitude and longitude. None if not found
+    :raise MapsUnavailable: API is sleeping or could not be reached
+    """
     log.debug("SEARCH: location %s", location)
 
-    if wakeup_time is not None:
-        # Check if it is time to wakeup
-        now = time.time()
-        if now > wakeup_time:
-            log.info("LOCATION: Waking up at %s", time.ctime())
-            # Set sleep time to None
-            set_wakeup_time(None)
-        else:
-            log.debug("Wakeup time %s not reached at %s", time.ctime(wakeup_time), time.ctime())
-            return None
+    maps = gmaps.get_maps()
+    if not maps.quota.consume():
+        log.debug("LOCATION: Quota not available at %s", time.ctime())
+        raise MapsUnavailable()
+
+    # Wait for this process rate limit
+    maps.bucket.acquire()
 
-    maps = gmaps.GMaps()
     try:
         result = maps.client.geocode(location)
 
@@ -205,13 +411,11 @@ def maps_search(location):
             return None
 
     except _RetriableRequest as e:
-        log.error("LOCATION: Limite de API excedido. Esperando 24h...")
+        log.error("LOCATION: Limite de API excedido. Esperando %s segundos...", maps.gmaps_quota_sleep)
         log.error(e.message)
-        log.info("LOCATION: Sleeping at %s", time.ctime())
-        # This will make it sleep 24 hours
-        w_time = time.time() + 86400
-        set_wakeup_time(w_time)
-        return None
+        # Every worker sleeps
+        maps.quota.sleep(maps.gmaps_quota_sleep)
+        raise MapsUnavailable()
 
     except ApiError as e:
         log.error("LOCATION: Location not found\n%s", e)
@@ -219,11 +423,11 @@ def maps_search(location):
 
     except TransportError as e:
         log.error("LOCATION: Location not found\n%s", e)
-        return None
+        raise MapsUnavailable()
 
     except Timeout as e:
         log.error("LOCATION: Location not found\n%s", e)
-        return None
+        raise MapsUnavailable()
 
     # As a start, select first random result
     try:
@@ -250,7 +454,3 @@ def maps_search(location):
 
     return result_dict
 
-
-def set_wakeup_time(w_time):
-    global wakeup_time
-    wakeup_time = w_time
\ No newline at end of file
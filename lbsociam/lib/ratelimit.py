@@ -0,0 +1,165 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import json
+import time
+import fcntl
+import logging
+import datetime
+import threading
+
+log = logging.getLogger()
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter for this process.
+
+    Tokens are added at rate per second up to capacity. Every request
+    takes one token, waiting for it when the bucket is empty. Threads
+    share the bucket.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        Building method
+        :param rate: Tokens added per second. None for no limit
+        :param capacity: Maximum tokens stored. Defaults to rate
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Add tokens for the time elapsed since last refill
+        """
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, block=True):
+        """
+        Take one token
+        :param block: Wait for the token when the bucket is empty
+        :return: True if the token was taken
+        """
+        if self.rate is None:
+            return True
+
+        with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                if not block:
+                    return False
+
+                time.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+
+            self.tokens -= 1
+            return True
+
+
+class SharedQuota(object):
+    """
+    API quota shared by every worker process.
+
+    State is a small JSON file changed under an exclusive lock. It holds
+    requests made today and the time when requests may start again after
+    the API reported the quota was exceeded.
+    """
+    def __init__(self, path, daily_limit=None):
+        """
+        Building method
+        :param path: State file
+        :param daily_limit: Maximum requests per day. None for no limit
+        """
+        self.path = path
+        self.daily_limit = daily_limit
+
+    def update(self, func):
+        """
+        Change state under lock
+        :param func: Function receiving the state dict. It may change it in place
+        :return: Function return
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data = f.read()
+            try:
+                state = json.loads(data) if data else dict()
+            except ValueError as e:
+                log.error("QUOTA: invalid state file %s\n%s", self.path, e)
+                state = dict()
+
+            result = func(state)
+
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+            f.flush()
+
+        return result
+
+    def state(self):
+        """
+        Current state
+        :return: dict
+        """
+        return self.update(lambda state: dict(state))
+
+    def consume(self):
+        """
+        Register one request if quota is available
+        :return: True if the request may be made
+        """
+        def consume(state):
+            now = time.time()
+            wakeup_time = state.get('wakeup_time')
+            if wakeup_time is not None:
+                if now < wakeup_time:
+                    return False
+
+                log.info("QUOTA: Waking up at %s", time.ctime())
+                state['wakeup_time'] = None
+
+            today = datetime.date.today().isoformat()
+            if state.get('day') != today:
+                state['day'] = today
+                state['requests'] = 0
+
+            if self.daily_limit is not None and state['requests'] >= self.daily_limit:
+                log.error("QUOTA: Daily limit of %s requests reached", self.daily_limit)
+                state['wakeup_time'] = next_day()
+                return False
+
+            state['requests'] += 1
+            return True
+
+        return self.update(consume)
+
+    def sleep(self, seconds):
+        """
+        Stop every worker for some time
+        :param seconds: Seconds to sleep
+        """
+        wakeup_time = time.time() + seconds
+        log.info("QUOTA: Sleeping until %s", time.ctime(wakeup_time))
+
+        def sleep(state):
+            state['wakeup_time'] = wakeup_time
+
+        self.update(sleep)
+
+
+def next_day():
+    """
+    Timestamp for the start of next day
+    """
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    return time.mktime(tomorrow.timetuple())
+
@@ -0,0 +1,145 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger()
+
+# HTTP pool settings. Loaded from [lbgenerator] section by LBSociam
+settings = dict(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=0,
+    connect_timeout=5.0,
+    timeout=60.0
+)
+
+# One session per process
+_session = None
+_pid = None
+
+
+class TimeoutSession(requests.Session):
+    """
+    Session applying a default timeout to every request
+    """
+    def __init__(self, timeout=None):
+        """
+        Building method
+        :param timeout: Default timeout. Float or (connect, read) tuple
+        """
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        """
+        Send request with default timeout if none is supplied
+        """
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+def configure(**kwargs):
+    """
+    Change pool settings. The session is rebuilt only if something changed
+    :param kwargs: Values to replace in settings
+    :return: True if settings changed
+    """
+    changed = False
+    for key, value in kwargs.items():
+        if value is None:
+            continue
+
+        if settings.get(key) != value:
+            settings[key] = value
+            changed = True
+
+    if changed:
+        reset()
+
+    return changed
+
+
+def reset():
+    """
+    Drop the current session. Next call builds a new one
+    """
+    global _session, _pid
+    if _session is not None and _pid == os.getpid():
+        _session.close()
+
+    _session = None
+    _pid = None
+
+
+def get_session():
+    """
+    Get the process session
+    :return: Pooled requests session
+    """
+    global _session, _pid
+    pid = os.getpid()
+    if _session is None or _pid != pid:
+        # A forked worker must not share the parent sockets
+        log.debug("SESSION: creating HTTP session for process %s", pid)
+        _session = build_session()
+        _pid = pid
+
+    return _session
+
+
+def build_session():
+    """
+    Build a new pooled session from settings
+    :return: TimeoutSession instance
+    """
+    s = TimeoutSession(
+        timeout=(settings['connect_timeout'], settings['timeout'])
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings['pool_connections'],
+        pool_maxsize=settings['pool_maxsize'],
+        max_retries=settings['max_retries']
+    )
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    s.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+
+    return s
+
+
+def get(url, **kwargs):
+    """
+    GET request using process session
+    """
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """
+    POST request using process session
+    """
+    return get_session().post(url, **kwargs)
+
+
+def put(url, **kwargs):
+    """
+    PUT request using process session
+    """
+    return get_session().put(url, **kwargs)
+
+
+def delete(url, **kwargs):
+    """
+    DELETE request using process session
+    """
+    return get_session().delete(url, **kwargs)
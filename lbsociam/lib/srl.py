@@ -2,29 +2,159 @@
 # -*- coding: utf-8 -*-
 __author__ = 'eduardo'
 
+import os
 import nlpnet
+import nlpnet.config
 import logging
 import nltk
 import re
 from . import dictionary
+from .cache import DiskCache, make_key
 
 log = logging.getLogger()
 
+# SRL tagger for this process. Loading the network is expensive
+_tagger = None
 
-def srl_tokenize(text):
+# SRL result cache and model version for this process
+_cache = None
+_model_version = None
+
+
+def get_tagger():
+    """
+    Get the process SRL tagger, loading the model on first use
+    :return: nlpnet SRLTagger instance
+    """
+    global _tagger
+    if _tagger is None:
+        log.debug("SRL: loading nlpnet SRL model")
+        _tagger = nlpnet.SRLTagger()
+
+    return _tagger
+
+
+def load_tagger():
+    """
+    Load tagger in the parent process before starting workers, so
+    forked processes share the model pages copy-on-write
+    :return: nlpnet SRLTagger instance
+    """
+    return get_tagger()
+
+
+def model_version():
+    """
+    Identify SRL model files, so cached results are dropped when the
+    model changes
+    :return: Version string
+    """
+    global _model_version
+    if _model_version is None:
+        stamps = [str(getattr(nlpnet, '__version__', ''))]
+        data_dir = getattr(nlpnet.config, 'data_dir', None)
+        if data_dir and os.path.isdir(data_dir):
+            for name in sorted(os.listdir(data_dir)):
+                if not name.startswith('srl'):
+                    continue
+                st = os.stat(os.path.join(data_dir, name))
+                stamps.append("%s:%d:%d" % (name, st.st_size, int(st.st_mtime)))
+
+        _model_version = make_key(*stamps)
+
+    return _model_version
+
+
+def get_cache(path, max_entries=None):
+    """
+    Get the process SRL result cache
+    :param path: Cache directory
+    :param max_entries: Maximum number of cached results
+    :return: DiskCache instance
+    """
+    global _cache
+    if _cache is None or _cache.path != path:
+        _cache = DiskCache(path, max_entries=max_entries)
+
+    return _cache
+
+
+def normalize(text):
+    """
+    Normalize text used as cache key
+    :param text: Status text
+    :return: Lowercase text with collapsed whitespace
+    """
+    return u' '.join(text.lower().split())
+
+
+def cache_key(text):
+    """
+    Cache key for text and current model
+    """
+    return model_version() + ':' + normalize(text)
+
+
+def srl_tokenize(text, cache=None):
     """
     SRL tokenize text
     :param text: Text to get tokens extracted
+    :param cache: DiskCache instance with previous results
     :return: Dict in following format:
         {
             'tokens': tokens,
             'arg_structures': arg_structures
         }
     """
+    if cache is not None:
+        key = cache_key(text)
+        saida = cache.get(key)
+        if saida is not None:
+            return saida
+
     text = text.lower()
-    tagger = nlpnet.SRLTagger()
+    tagger = get_tagger()
     sent = tagger.tag(text)
+    saida = srl_result(sent)
+
+    if cache is not None:
+        cache.set(key, saida)
+
+    return saida
 
+
+def srl_tokenize_list(texts, cache=None):
+    """
+    SRL tokenize a list of texts one at a time with the process tagger.
+    nlpnet tags one text per call, so texts are not tagged together. Cached
+    results are used and cache stats are logged once for the list
+    :param texts: List of texts
+    :param cache: DiskCache instance with previous results
+    :return: List with one dict per text, in the same format as srl_tokenize
+    """
+    saida = list()
+    for text in texts:
+        if not text:
+            saida.append({
+                'tokens': [],
+                'arg_structures': []
+            })
+            continue
+
+        saida.append(srl_tokenize(text, cache=cache))
+
+    if cache is not None:
+        log.debug("SRL: cache stats %s", cache.stats())
+
+    return saida
+
+
+def srl_result(sent):
+    """
+    Build tokens and arg structures from tagged sentences
+    :param sent: List of nlpnet tagged sentences
+    :return: Dict with tokens and arg_structures
+    """
     arg_structures = []
     tokens = []
     for elm in sent:
@@ -52,4 +182,4 @@ def srl_tokenize(text):
     return {
         'tokens': tokens,
         'arg_structures': arg_structures
-    }
\ No newline at end of file
+    }
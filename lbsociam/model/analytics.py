@@ -1,11 +1,14 @@
 #!/usr/env python
 # -*- coding: utf-8 -*-
 __author__ = 'eduardo'
+import os
 import time
 import logging
 import datetime
-import requests
 import json
+import tempfile
+import itertools
+import numpy
 from requests.exceptions import HTTPError
 from lbsociam import LBSociam
 from lbsociam.model import lbstatus
@@ -16,14 +19,588 @@ from liblightbase.lbbase.lbstruct.field import *
 from liblightbase.lbbase.content import Content
 from liblightbase.lbutils import conv
 from liblightbase.lbsearch.search import *
+from lbsociam.lib import documents, session
+from lbsociam.model import schema
 from pyramid.response import Response
 from operator import itemgetter
 from multiprocessing import Queue, Process
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 
 
 log = logging.getLogger()
 
+# Brazilian states on the analytics cube state axis
+UF_LIST = (
+    'AC', 'AL', 'AM', 'AP', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MG', 'MS', 'MT', 'PA',
+    'PB', 'PE', 'PI', 'PR', 'RJ', 'RN', 'RO', 'RR', 'RS', 'SC', 'SE', 'SP', 'TO'
+)
+
+# Date formats found on status inclusion_date and inclusion_datetime
+DATE_FORMATS = ("%d/%m/%Y", "%d/%m/%Y %H:%M:%S", "%Y-%m-%d", "%Y-%m-%d %H:%M:%S")
+
+# Analytics cube for this process and the file modification time it was loaded from
+_cube = None
+_cube_mtime = None
+
+
+def parse_day(value):
+    """
+    Day for date value
+    :param value: date, datetime or string in one of DATE_FORMATS
+    :return: datetime.date or None if it can't be parsed
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, datetime.datetime):
+        return value.date()
+
+    if isinstance(value, datetime.date):
+        return value
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+
+    log.debug("Invalid date %s", value)
+    return None
+
+
+def day_range(start_date, end_date):
+    """
+    Every day on interval
+    :param start_date: First day
+    :param end_date: Last day
+    :return: Generator of datetime.date
+    """
+    day = parse_day(start_date)
+    end_date = parse_day(end_date)
+    while day <= end_date:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def is_crime(status_dict):
+    """
+    Status was classified as crime or not
+    """
+    return status_dict.get('positives') is not None or status_dict.get('negatives') is not None
+
+
+def is_positive(status_dict):
+    """
+    Status has more positives than negatives
+    """
+    if status_dict.get('positives') is None:
+        return False
+
+    if status_dict.get('negatives') is None:
+        return True
+
+    return status_dict['positives'] > status_dict['negatives']
+
+
+class CategoryCounts(object):
+    """
+    Status count by state and crime category.
+
+    Workers count their batch of status and the parent merges the partial
+    counts, so the analytics document is written only at checkpoints.
+    """
+    def __init__(self):
+        """
+        Building method
+        """
+        self.counts = dict()
+        self.total_status = 0
+
+    def __len__(self):
+        return self.total_status
+
+    def add(self, status_dict):
+        """
+        Count status if it has state and category
+        :param status_dict: Status dict with brasil_city and category
+        :return: True if the status was counted
+        """
+        if status_dict is None:
+            log.debug("Empty status!!!")
+            return False
+
+        if status_dict.get('brasil_city') is None:
+            log.debug("Brasil City not found for status ID = %s", status_dict['_metadata']['id_doc'])
+            return False
+
+        if status_dict.get('category') is None:
+            log.debug("Category not found for status ID = %s", status_dict['_metadata']['id_doc'])
+            return False
+
+        if status_dict['category'].get('category_id_doc') is None:
+            log.debug("Category ID not found for status ID = %s", status_dict['_metadata']['id_doc'])
+            return False
+
+        key = (status_dict['brasil_city']['state_short_name'], status_dict['category']['category_id_doc'])
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.total_status += 1
+
+        return True
+
+    def merge(self, other):
+        """
+        Add counts from another instance
+        :param other: CategoryCounts instance
+        """
+        for key, value in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+        self.total_status += other.total_status
+
+    def add_state_list(self, state_list):
+        """
+        Add counts from analytics state group
+        :param state_list: List of state dicts with category list
+        """
+        for state in state_list:
+            for cat in state['category']:
+                key = (state['state_uf'], cat['category_id_doc'])
+                self.counts[key] = self.counts.get(key, 0) + cat['category_status']
+                self.total_status += cat['category_status']
+
+    def state_list(self):
+        """
+        Counts as the analytics state group
+        :return: List of state dicts with category list
+        """
+        states = dict()
+        for (uf, category_id_doc), value in self.counts.items():
+            states.setdefault(uf, list()).append({
+                'category_id_doc': category_id_doc,
+                'category_status': value
+            })
+
+        saida = list()
+        for uf in sorted(states.keys()):
+            saida.append({
+                'state_uf': uf,
+                'category': sorted(states[uf], key=itemgetter('category_id_doc'))
+            })
+
+        return saida
+
+
+class AnalyticsCube(object):
+    """
+    Status count by state, crime category and day.
+
+    Counts are held on a dense NumPy array with axes for UF, category and
+    day, filled in bulk and queried with vectorized sums. Categories not
+    known yet are appended to the category axis. The stored cube is filled
+    from the daily rollups and its days are replaced whenever their
+    rollups are computed again.
+    """
+    def __init__(self, start_date, end_date, categories=(), ufs=UF_LIST, data=None):
+        """
+        Building method
+        :param start_date: First day
+        :param end_date: Last day
+        :param categories: Category id_doc list
+        :param ufs: UF list
+        :param data: Counts array. Defaults to zeros
+        """
+        self.start_date = parse_day(start_date)
+        self.end_date = parse_day(end_date)
+        self.ufs = list(ufs)
+        self.categories = list(categories)
+        self.uf_index = dict((uf, i) for i, uf in enumerate(self.ufs))
+        self.category_index = dict((category, i) for i, category in enumerate(self.categories))
+
+        if data is None:
+            days = (self.end_date - self.start_date).days + 1
+            data = numpy.zeros((len(self.ufs), len(self.categories), days), dtype=numpy.int64)
+        self.data = data
+
+    @property
+    def days(self):
+        """
+        Number of days
+        """
+        return self.data.shape[2]
+
+    def day_index(self, day):
+        """
+        Position of day on the day axis
+        """
+        return (parse_day(day) - self.start_date).days
+
+    def covers(self, start_date, end_date):
+        """
+        Check if cube has every day on interval
+        """
+        return self.start_date <= parse_day(start_date) and parse_day(end_date) <= self.end_date
+
+    def add_categories(self, categories):
+        """
+        Append unknown categories to category axis
+        :param categories: Category id_doc list
+        """
+        new = list()
+        for category in categories:
+            if category not in self.category_index:
+                self.category_index[category] = len(self.categories)
+                self.categories.append(category)
+                new.append(category)
+
+        if new:
+            extra = numpy.zeros((len(self.ufs), len(new), self.days), dtype=self.data.dtype)
+            self.data = numpy.concatenate([self.data, extra], axis=1)
+
+    def add(self, ufs, categories, days):
+        """
+        Count status in bulk. Unknown UF and days out of the cube are ignored
+        :param ufs: UF for every status
+        :param categories: Category id_doc for every status
+        :param days: Day for every status
+        :return: Number of status counted
+        """
+        self.add_categories(categories)
+        uf_index = numpy.array([self.uf_index.get(uf, -1) for uf in ufs], dtype=numpy.int64)
+        category_index = numpy.array([self.category_index[category] for category in categories], dtype=numpy.int64)
+        day_index = numpy.array([(day - self.start_date).days for day in days], dtype=numpy.int64)
+
+        valid = (uf_index >= 0) & (day_index >= 0) & (day_index < self.days)
+        numpy.add.at(self.data, (uf_index[valid], category_index[valid], day_index[valid]), 1)
+
+        return int(valid.sum())
+
+    def add_status(self, status_list):
+        """
+        Count status dicts
+        :param status_list: Status dicts with brasil_city, category and inclusion date
+        :return: Number of status counted
+        """
+        ufs = list()
+        categories = list()
+        days = list()
+        for status_dict in status_list:
+            if status_dict is None or status_dict.get('brasil_city') is None:
+                continue
+
+            if status_dict.get('category') is None or status_dict['category'].get('category_id_doc') is None:
+                continue
+
+            day = parse_day(status_dict.get('inclusion_date') or status_dict.get('inclusion_datetime'))
+            if day is None:
+                continue
+
+            ufs.append(status_dict['brasil_city']['state_short_name'])
+            categories.append(status_dict['category']['category_id_doc'])
+            days.append(day)
+
+        if not ufs:
+            return 0
+
+        return self.add(ufs, categories, days)
+
+    @classmethod
+    def from_status(cls, status_iter, start_date, end_date, categories=(), chunk_size=10000):
+        """
+        Build cube from status stream
+        :param status_iter: Iterable of status dicts
+        :param start_date: First day
+        :param end_date: Last day
+        :param categories: Category id_doc list
+        :param chunk_size: Status counted at once
+        :return: AnalyticsCube instance
+        """
+        cube = cls(start_date, end_date, categories)
+        status_iter = iter(status_iter)
+        total = 0
+        while True:
+            chunk = list(itertools.islice(status_iter, chunk_size))
+            if not chunk:
+                break
+
+            total += cube.add_status(chunk)
+            log.debug("CUBE: %s status counted", total)
+
+        return cube
+
+    @classmethod
+    def from_rollups(cls, store, start_date, end_date):
+        """
+        Build cube from daily rollups
+        :param store: RollupStore instance
+        :param start_date: First day
+        :param end_date: Last day
+        :return: AnalyticsCube instance
+        """
+        cube = cls(start_date, end_date)
+        for day in day_range(start_date, end_date):
+            rollup = store.get(day)
+            if rollup is not None:
+                cube.set_day(day, rollup['state'])
+
+        return cube
+
+    def set_day(self, day, state_list):
+        """
+        Replace counts for one day. Days out of the cube are ignored
+        :param day: Day
+        :param state_list: List of state dicts with category list, as on rollups
+        :return: True if the day is on the cube
+        """
+        index = self.day_index(day)
+        if index < 0 or index >= self.days:
+            return False
+
+        self.add_categories([cat['category_id_doc'] for state in state_list for cat in state['category']])
+        self.data[:, :, index] = 0
+        for state in state_list:
+            i = self.uf_index.get(state['state_uf'])
+            if i is None:
+                continue
+
+            for cat in state['category']:
+                self.data[i, self.category_index[cat['category_id_doc']], index] = cat['category_status']
+
+        return True
+
+    def window(self, start_date=None, end_date=None):
+        """
+        Counts for interval
+        :param start_date: First day. Defaults to cube start
+        :param end_date: Last day. Defaults to cube end
+        :return: Array view with UF, category and day axes
+        """
+        start = 0 if start_date is None else max(0, self.day_index(start_date))
+        end = self.days if end_date is None else min(self.days, self.day_index(end_date) + 1)
+
+        return self.data[:, :, start:max(start, end)]
+
+    def by_state(self, start_date=None, end_date=None):
+        """
+        Status by UF
+        :return: dict with UF as key
+        """
+        totals = self.window(start_date, end_date).sum(axis=(1, 2))
+        return dict((self.ufs[i], int(totals[i])) for i in numpy.nonzero(totals)[0])
+
+    def by_category(self, start_date=None, end_date=None):
+        """
+        Status by category
+        :return: dict with category id_doc as key
+        """
+        totals = self.window(start_date, end_date).sum(axis=(0, 2))
+        return dict((self.categories[i], int(totals[i])) for i in numpy.nonzero(totals)[0])
+
+    def state_category(self, start_date=None, end_date=None):
+        """
+        Status by category and UF
+        :return: dict with total_status and UF counts for every category id_doc
+        """
+        matrix = self.window(start_date, end_date).sum(axis=2)
+        saida = {
+            'total_status': int(matrix.sum())
+        }
+        for i, j in zip(*numpy.nonzero(matrix)):
+            saida.setdefault(self.categories[j], dict())[self.ufs[i]] = int(matrix[i, j])
+
+        return saida
+
+    def daily(self, uf=None, category=None):
+        """
+        Status by day
+        :param uf: Only this UF
+        :param category: Only this category id_doc
+        :return: Array with one count for every day
+        """
+        data = self.data
+        if uf is not None:
+            data = data[[self.uf_index[uf]], :, :]
+        if category is not None:
+            data = data[:, [self.category_index[category]], :]
+
+        return data.sum(axis=(0, 1))
+
+    def rolling(self, window, uf=None, category=None):
+        """
+        Status on the last window days for every day
+        :param window: Number of days
+        :param uf: Only this UF
+        :param category: Only this category id_doc
+        :return: Array with one sum for every day
+        """
+        cumsum = numpy.concatenate([[0], numpy.cumsum(self.daily(uf, category))])
+        end = numpy.arange(1, self.days + 1)
+
+        return cumsum[end] - cumsum[numpy.maximum(end - window, 0)]
+
+    def save(self, filename):
+        """
+        Store cube on npz file
+        :param filename: File name
+        """
+        meta = {
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            'ufs': self.ufs,
+            'categories': self.categories
+        }
+
+        path = os.path.dirname(filename)
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+        fd, tmp = tempfile.mkstemp(dir=path or None, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez_compressed(f, data=self.data, meta=numpy.array(json.dumps(meta)))
+        os.rename(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load cube from npz file
+        :param filename: File name
+        :return: AnalyticsCube instance
+        """
+        with numpy.load(filename) as f:
+            meta = json.loads(str(f['meta']))
+            data = f['data']
+
+        return cls(
+            meta['start_date'],
+            meta['end_date'],
+            categories=meta['categories'],
+            ufs=meta['ufs'],
+            data=data
+        )
+
+
+class RollupStore(object):
+    """
+    Daily analytics stored as one JSON file per day.
+
+    Every rollup has totals, positives and state by category counts for
+    one day. total_status counts only status with state and category, as
+    the state group, the cube and the category analysis. total_all,
+    total_crimes and total_positives count every status of the day.
+    state.json keeps the last status id_doc already considered, and days
+    of status changed later are read from the status base changed days,
+    so only days with new or changed status are computed again.
+    """
+    def __init__(self, path):
+        """
+        Building method
+        :param path: Rollups directory
+        """
+        self.path = path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def filename(self, day):
+        """
+        File for day
+        """
+        return os.path.join(self.path, parse_day(day).isoformat() + '.json')
+
+    def read(self, filename):
+        """
+        Read JSON file
+        :return: dict or None if not available
+        """
+        try:
+            with open(filename, 'r') as fd:
+                return json.load(fd)
+        except (IOError, OSError):
+            return None
+        except ValueError as e:
+            log.error("ROLLUP: invalid file %s\n%s", filename, e)
+            return None
+
+    def write(self, filename, value):
+        """
+        Write JSON file atomically
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.rename(tmp, filename)
+
+    def get(self, day):
+        """
+        Rollup for day
+        :return: Rollup dict or None if not computed
+        """
+        return self.read(self.filename(day))
+
+    def exists(self, day):
+        """
+        Check if rollup for day was computed
+        """
+        return os.path.exists(self.filename(day))
+
+    def save(self, rollup):
+        """
+        Store rollup
+        :param rollup: Rollup dict with day
+        """
+        self.write(self.filename(rollup['day']), rollup)
+
+    def state(self):
+        """
+        Last status id_doc considered
+        :return: dict
+        """
+        state = self.read(os.path.join(self.path, 'state.json'))
+        if state is None:
+            state = {'last_id_doc': None}
+
+        return state
+
+    def save_state(self, state):
+        """
+        Store state
+        """
+        self.write(os.path.join(self.path, 'state.json'), state)
+
+    def missing(self, start_date, end_date):
+        """
+        Days on interval without rollup
+        :return: List of datetime.date
+        """
+        return [day for day in day_range(start_date, end_date) if not self.exists(day)]
+
+    def sum(self, start_date, end_date):
+        """
+        Sum rollups on interval
+        :param start_date: First day
+        :param end_date: Last day
+        :return: Analysis dict with totals and state group
+        """
+        saida = {
+            'analysis_date': parse_day(start_date).isoformat(),
+            'analysis_end_date': parse_day(end_date).isoformat(),
+            'total_status': 0,
+            'total_all': 0,
+            'total_crimes': 0,
+            'total_positives': 0
+        }
+
+        counts = CategoryCounts()
+        for day in day_range(start_date, end_date):
+            rollup = self.get(day)
+            if rollup is None:
+                continue
+
+            for key in ('total_status', 'total_all', 'total_crimes', 'total_positives'):
+                saida[key] += rollup.get(key, 0)
+            counts.add_state_list(rollup['state'])
+
+        saida['state'] = counts.state_list()
+
+        return saida
+
 
 class AnalyticsBase(LBSociam):
     """
@@ -51,8 +628,32 @@ class AnalyticsBase(LBSociam):
         else:
             self.status_base = status_base
 
+    @property
+    def schema_key(self):
+        """
+        Identification of this base on schema registry
+        """
+        return 'analytics', 'analytics'
+
+    @property
+    def schema(self):
+        """
+        Base schema built once per process
+        """
+        return schema.registry.get(
+            self.schema_key,
+            self.build_lbbase,
+            self.lbgenerator_rest_url
+        )
+
     @property
     def lbbase(self):
+        """
+        Cached LB Base object
+        """
+        return self.schema.lbbase
+
+    def build_lbbase(self):
         """
         Generate LB Base object
         :return:
@@ -282,7 +883,7 @@ class AnalyticsBase(LBSociam):
         """
         Retorna metaclass para essa base
         """
-        return self.lbbase.metaclass()
+        return self.schema.metaclass()
 
     def create_base(self):
         """
@@ -315,21 +916,61 @@ class AnalyticsBase(LBSociam):
         """
         response = self.baserest.update(self.lbbase)
         if response.status_code == 200:
+            # Make sure the next access gets the new structure
+            schema.registry.invalidate(self.schema_key)
             return True
         else:
             raise IOError('Error updating LB Base structure')
 
+    def iter_documents(self,
+                       select=None,
+                       page_size=None,
+                       literal=None,
+                       offset=0,
+                       last_id_doc=None):
+        """
+        Stream analytics documents page by page ordered by id_doc
+
+        :param select: Fields to be returned. Defaults to the whole document
+        :param page_size: Documents fetched per request. Defaults to config page_size
+        :param literal: Extra SQL filter
+        :param offset: Documents skipped on the first page
+        :param last_id_doc: Start scan after this id_doc
+        :return: Generator of document dicts
+        """
+        if page_size is None:
+            page_size = self.page_size
+
+        return documents.iter_documents(
+            self,
+            select=select,
+            page_size=page_size,
+            literal=literal,
+            offset=offset,
+            last_id_doc=last_id_doc
+        )
+
     def get_document(self, id_doc):
         """
         Get document by ID on base
         """
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc/' + str(id_doc)
-        response = requests.get(url)
+        url = self.schema.doc_url + '/' + str(id_doc)
+        response = session.get(url)
         if response.status_code > 300:
             return None
 
         return response.json()
 
+    def get_documents(self, id_list, select=None):
+        """
+        Fetch many analytics documents in bulk
+
+        :param id_list: List of id_doc to fetch
+        :param select: Fields to be returned. Defaults to the whole document
+        :return: List of document dicts in id_list order. None for missing documents
+        """
+        return documents.get_documents(self, id_list, select=select)
+
     def update_document(self, id_doc, new_document):
         """
         Update document
@@ -344,13 +985,13 @@ class AnalyticsBase(LBSociam):
         Update base in proposed path
         """
         response = Response(content_type='application/json')
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc/' + id_doc
+        url = self.schema.doc_url + '/' + id_doc
         url = url + '/' + path
         params = {
             'value': value
         }
 
-        result = requests.put(
+        result = session.put(
             url=url,
             data=params
         )
@@ -427,85 +1068,144 @@ class AnalyticsBase(LBSociam):
 
         return True
 
-    def process_response_categories(self, status_dict, id_doc):
-        # Get actual analytics
+    def write_categories(self, id_doc, counts):
+        """
+        Store state and category counts on analytics document
+        :param id_doc: Analytics document ID
+        :param counts: CategoryCounts with every status counted so far
+        :return: Update result or None on errors
+        """
         entry_dict = self.get_document(id_doc)
+        entry_dict['state'] = counts.state_list()
+        entry_dict['total_status'] = counts.total_status
 
-        # Manually add id_doc
-        entry_dict['_metadata'] = dict()
-        entry_dict['_metadata']['id_doc'] = id_doc
+        try:
+            result = self.update_document(id_doc, entry_dict)
+        except (ConnectionError, Timeout) as e:
+            log.error("Error updating analytics id = %s\n%s", id_doc, e.message)
+            # Wait one second and try again
+            time.sleep(1)
+            result = self.write_categories(id_doc, counts)
+        except HTTPError as e:
+            log.error("Error updating analytics id = %s\n%s", id_doc, e.message)
+            result = None
 
-        # Check mandatory attributes on status
-        if status_dict is None:
-            log.debug("Empty status!!!")
-            return False
+        return result
 
-        if status_dict.get('brasil_city') is None:
-            log.debug("Brasil City not found for status ID = %s", status_dict['_metadata']['id_doc'])
-            return False
+    @property
+    def rollups(self):
+        """
+        Daily rollups store
+        """
+        return RollupStore(os.path.join(self.lbsociam_data_dir, 'rollups'))
 
-        if status_dict.get('category') is None:
-            log.debug("Category not found for status ID = %s", status_dict['_metadata']['id_doc'])
-            return False
+    def compute_rollup(self, day):
+        """
+        Count status for one day
+        :param day: Day
+        :return: Rollup dict
+        """
+        day = parse_day(day)
+        rollup = {
+            'day': day.isoformat(),
+            'total_all': 0,
+            'total_crimes': 0,
+            'total_positives': 0
+        }
 
-        if status_dict['category'].get('category_id_doc') is None:
-            log.debug("Category ID not found for status ID = %s", status_dict['_metadata']['id_doc'])
-            return False
+        # Search goes to next day and status are filtered by their own date
+        status_iter = self.status_base.iter_documents(
+            select=['id_doc', 'positives', 'negatives', 'brasil_city', 'category',
+                    'inclusion_date', 'inclusion_datetime'],
+            start_date=day,
+            end_date=day + datetime.timedelta(days=1)
+        )
 
-        # Now build statistics for the attributes
-        if entry_dict.get('state') is None:
-            entry_dict['state'] = list()
+        counts = CategoryCounts()
+        for status_dict in status_iter:
+            if parse_day(status_dict.get('inclusion_date') or status_dict.get('inclusion_datetime')) != day:
+                continue
 
-        # Now try to find specific state
-        try:
-            uf = (item for item in entry_dict['state'] if item['state_uf'] == status_dict['brasil_city']['state_short_name']).next()
-            state_index = entry_dict['state'].index(uf)
-
-            # Now try to find category
-            try:
-                cat = (item for item in entry_dict['state'][state_index]['category'] if item['category_id_doc'] == status_dict['category']['category_id_doc']).next()
-                cat_index = entry_dict['state'][state_index]['category'].index(cat)
-
-                # Finally update category frequency
-                log.debug("Increasing count. Status = %s Category = %s", status_dict['_metadata']['id_doc'], status_dict['category']['category_id_doc'])
-                entry_dict['state'][state_index]['category'][cat_index]['category_status'] += 1
-
-            except StopIteration as e:
-                entry_dict['state'][state_index]['category'].append({
-                    'category_id_doc': status_dict['category']['category_id_doc'],
-                    'category_status': 1
-                })
-
-        except StopIteration as e:
-            # In this case there is no available
-            entry_dict['state'].append({
-                'state_uf': status_dict['brasil_city']['state_short_name'],
-                'category': [{
-                    'category_id_doc': status_dict['category']['category_id_doc'],
-                    'category_status': 1
-                }]
-            })
+            rollup['total_all'] += 1
+            if is_crime(status_dict):
+                rollup['total_crimes'] += 1
+            if is_positive(status_dict):
+                rollup['total_positives'] += 1
+            counts.add(status_dict)
 
-        entry_dict['total_status'] += 1
+        # Same status counted on the cube and on the category analysis
+        rollup['total_status'] = counts.total_status
+        rollup['state'] = counts.state_list()
+        rollup['updated'] = time.time()
 
-        # Finally update entry back on status
-        try:
-            result = self.update_document(id_doc, entry_dict)
-        except ConnectionError as e:
-            log.error("Error updating analytics id = %s\n%s", id_doc, e.message)
-            # Wait one second and try again
-            time.sleep(1)
-            result = self.process_response_categories(status_dict, id_doc)
-        except HTTPError as e:
-            log.error("Error updating status\n%s", e.message)
-            result = None
+        return rollup
 
-        if result is None:
-            log.error("Error updating total status positives and negatives")
+    def touched_days(self, last_id_doc=None):
+        """
+        Days with status added after last_id_doc
+        :param last_id_doc: Last status id_doc already considered
+        :return: Tuple with set of days and the new last id_doc
+        """
+        days = set()
+        for status_dict in self.status_base.iter_documents(
+                select=['id_doc', 'inclusion_date', 'inclusion_datetime'],
+                last_id_doc=last_id_doc):
+            last_id_doc = status_dict['_metadata']['id_doc']
+            day = parse_day(status_dict.get('inclusion_date') or status_dict.get('inclusion_datetime'))
+            if day is not None:
+                days.add(day)
+
+        return days, last_id_doc
+
+    def update_rollups(self, start_date, end_date=None, recompute=False):
+        """
+        Compute rollups missing on interval and every rollup with new or changed status
+        :param start_date: First day
+        :param end_date: Last day. Defaults to today
+        :param recompute: Compute every day on interval again
+        :return: List of days computed
+        """
+        if end_date is None:
+            end_date = datetime.datetime.now()
 
-        log.info("Processing finished %s", result)
+        store = self.rollups
+        state = store.state()
+
+        # Days with new status and days with status changed after they were added
+        touched, last_id_doc = self.touched_days(state['last_id_doc'])
+        # Changed days are removed only after every rollup is saved
+        changed, changed_size = self.status_base.changed_days.read()
+        for entry in changed:
+            touched.update(parse_day(day) for day in entry.get('days', list()))
+        touched.discard(None)
+
+        # Days without rollup are computed when requested, so only stored ones matter
+        days = set(day for day in touched if store.exists(day))
+        if recompute:
+            days.update(day_range(start_date, end_date))
+        else:
+            days.update(store.missing(start_date, end_date))
 
-        return True
+        rollups = list()
+        for day in sorted(days):
+            rollup = self.compute_rollup(day)
+            store.save(rollup)
+            rollups.append(rollup)
+            log.info("ROLLUP: %s computed. Total status = %s", rollup['day'], rollup['total_status'])
+
+        state['last_id_doc'] = last_id_doc
+        store.save_state(state)
+        self.status_base.changed_days.remove(changed_size)
+
+        # Keep stored cube in line with the rollups
+        if rollups and os.path.exists(self.cube_file):
+            cube = AnalyticsCube.load(self.cube_file)
+            changed = [cube.set_day(rollup['day'], rollup['state']) for rollup in rollups]
+            if any(changed):
+                cube.save(self.cube_file)
+                log.info("CUBE: %s days updated on %s", sum(changed), self.cube_file)
+
+        return sorted(days)
 
     def get_latest_analysis(self, start_date, end_date=None):
         """
@@ -524,6 +1224,11 @@ class AnalyticsBase(LBSociam):
                 # Default to now
                 end_date = datetime.datetime.now()
 
+            # Sum daily rollups when every day is available
+            store = self.rollups
+            if not store.missing(start_date, end_date):
+                return store.sum(start_date, end_date)
+
             # Use search by inclusion_datetime
             literal = """analysis_date <= '%s'::date and
                          to_date(document->>'analysis_end_date'::text, 'YYYY-MM-DD HH24:MI:SS') <= '%s'::date """ % (
@@ -540,14 +1245,13 @@ class AnalyticsBase(LBSociam):
             order_by=orderby,
             literal=literal
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         response_json = response.json()
         results = response_json['results']
         if len(results) == 0:
@@ -566,10 +1270,61 @@ class AnalyticsBase(LBSociam):
 
             return escolhido
 
+    @property
+    def cube_file(self):
+        """
+        Analytics cube file
+        """
+        return os.path.join(self.lbsociam_data_dir, 'analytics', 'cube.npz')
+
+    def create_cube(self, start_date, end_date=None):
+        """
+        Fill cube from daily rollups and store it
+        :param start_date: First day
+        :param end_date: Last day. Defaults to today
+        :return: AnalyticsCube instance
+        """
+        if end_date is None:
+            end_date = datetime.datetime.now()
+
+        # Every day on the cube comes from an up to date rollup
+        self.update_rollups(start_date, end_date)
+        cube = AnalyticsCube.from_rollups(self.rollups, start_date, end_date)
+        cube.save(self.cube_file)
+        log.info("CUBE: %s status stored on %s", int(cube.data.sum()), self.cube_file)
+
+        return cube
+
+    def get_cube(self):
+        """
+        Stored analytics cube, loaded again when the file changes
+        :return: AnalyticsCube instance or None if it was not created
+        """
+        global _cube, _cube_mtime
+        try:
+            mtime = os.path.getmtime(self.cube_file)
+        except OSError:
+            return None
+
+        if _cube is None or _cube_mtime != mtime:
+            _cube = AnalyticsCube.load(self.cube_file)
+            _cube_mtime = mtime
+
+        return _cube
+
     def get_state_analysis(self, start_date, end_date=None):
         """
         Get state analysis
         """
+        if end_date is None:
+            end_date = datetime.datetime.now()
+
+        # Answer from cube when it has every day. Its days are replaced
+        # whenever their rollups are computed again
+        cube = self.get_cube()
+        if cube is not None and cube.covers(start_date, end_date):
+            return cube.state_category(start_date, end_date)
+
         analysis = self.get_latest_analysis(
             start_date=start_date,
             end_date=end_date
@@ -630,32 +1385,30 @@ class AnalyticsBase(LBSociam):
             start_date=start_date,
             end_date=end_date
         )
-        for status_id_doc in id_document_list:
-            task_queue.put(status_id_doc)
+
+        # Every task is a batch of id_doc fetched in one request
+        batches = list(documents.chunks(id_document_list, self.batch_size))
+        for id_list in batches:
+            task_queue.put(id_list)
 
         for i in range(processes):
             # Permite o processamento paralelo dos status
             Process(target=self.worker_categories, args=(task_queue, done_queue)).start()
 
-        # Process responses
+        # Merge partial counts from workers
         log.debug("Processing responses")
-        for i in range(len(id_document_list)):
-            status_dict = done_queue.get()
-
-            # Add retry loop if connection errors
-            try:
-                self.process_response_categories(
-                    status_dict=status_dict,
-                    id_doc=id_doc
-                )
-            except ConnectionError as e:
-                log.error("CONNECTION ERROR: connection error on %s\n%s", id_doc, e.message)
-                # Wait one second and retry
-                time.sleep(1)
-                self.process_response_categories(
-                    status_dict=status_dict,
-                    id_doc=id_doc
-                )
+        counts = CategoryCounts()
+        written = 0
+        for i in range(len(batches)):
+            counts.merge(done_queue.get())
+
+            if self.analytics_checkpoint and len(counts) - written >= self.analytics_checkpoint:
+                result = self.write_categories(id_doc, counts)
+                written = len(counts)
+                log.info("Checkpoint: %s status counted. Result = %s", written, result)
+
+        result = self.write_categories(id_doc, counts)
+        log.info("Processing finished: %s status counted. Result = %s", len(counts), result)
 
         # Tell child processes to stop
         for i in range(processes):
@@ -669,29 +1422,33 @@ class AnalyticsBase(LBSociam):
             result = self.process_status_categories(func)
             output.put(result)
 
-    def process_status_categories(self, status_id_doc):
+    def process_status_categories(self, id_list):
         """
         Process status
-        :param status_id_doc: Status id_doc
-        :return: Status dict stored
+        :param id_list: Batch of status id_doc
+        :return: CategoryCounts for the batch
         """
+        select = ['id_doc', 'brasil_city', 'category']
         try:
-            result = self.status_base.get_document(status_id_doc)
-        except ConnectionError as e:
-            log.error("CONNECTION ERROR: Error processing %s\n%s", status_id_doc, e.message)
+            status_list = self.status_base.get_documents(id_list, select=select)
+        except (ConnectionError, Timeout) as e:
+            log.error("CONNECTION ERROR: Error processing batch starting at %s\n%s", id_list[0], e.message)
 
             # Try again in one second
             time.sleep(1)
-            status_dict = self.process_status_categories(status_id_doc)
-            return status_dict
+            return self.process_status_categories(id_list)
 
-        # JSON
-        status_dict = conv.document2dict(self.status_base.lbbase, result)
-        # Manually add id_doc
-        status_dict['_metadata'] = dict()
-        status_dict['_metadata']['id_doc'] = status_id_doc
+        counts = CategoryCounts()
+        for status_id_doc, status_dict in zip(id_list, status_list):
+            if status_dict is None:
+                continue
+
+            # Manually add id_doc
+            status_dict['_metadata'] = dict()
+            status_dict['_metadata']['id_doc'] = status_id_doc
+            counts.add(status_dict)
 
-        return status_dict
+        return counts
 
     def get_analysis(self, limit=10):
         """
@@ -707,14 +1464,13 @@ class AnalyticsBase(LBSociam):
             limit=limit,
             order_by=orderby
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         response_json = response.json()
 
         return response_json
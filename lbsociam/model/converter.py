@@ -0,0 +1,171 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import json
+import time
+import logging
+from liblightbase.lbutils import conv
+from liblightbase.lbbase.lbstruct.group import Group
+
+log = logging.getLogger()
+
+
+class DocumentConverter(object):
+    """
+    Document to dict converter compiled from the base structure.
+
+    The base content is walked only once to build a plan of
+    (name, multivalued, group plan) tuples. Conversion then reads the known
+    fields directly from the dict or document object. Anything the plan
+    doesn't know goes through the generic liblightbase conv path.
+    """
+    def __init__(self, lbbase):
+        """
+        Building method
+        :param lbbase: LB Base object
+        """
+        self.lbbase = lbbase
+        self.plan = self.compile(lbbase.content)
+        self.names = frozenset([elm[0] for elm in self.plan])
+
+    def compile(self, content):
+        """
+        Build conversion plan for base or group content
+        :param content: LB Content object
+        :return: Tuple of (name, multivalued, group plan or None)
+        """
+        plan = list()
+        for struct in content:
+            if isinstance(struct, Group):
+                plan.append((
+                    struct.metadata.name,
+                    struct.metadata.multivalued,
+                    self.compile(struct.content)
+                ))
+            else:
+                plan.append((
+                    struct.name,
+                    struct.multivalued,
+                    None
+                ))
+
+        return tuple(plan)
+
+    def document2dict(self, document):
+        """
+        Convert document to dict
+        :param document: Document dict as returned from REST or document object
+        :return: Document dict
+        """
+        if isinstance(document, dict):
+            for key in document.keys():
+                if key not in self.names and key != '_metadata':
+                    # Unknown field. Let liblightbase validate it
+                    log.debug("CONVERTER: unknown field %s. Using generic conversion", key)
+                    return conv.document2dict(self.lbbase, conv.dict2document(self.lbbase, document))
+
+            return self.convert_dict(document, self.plan)
+
+        try:
+            return self.convert_object(document, self.plan)
+        except AttributeError as e:
+            log.debug("CONVERTER: using generic conversion\n%s", e)
+            return conv.document2dict(self.lbbase, document)
+
+    def document2json(self, document):
+        """
+        Convert document to JSON
+        :param document: Document dict as returned from REST or document object
+        :return: Document JSON
+        """
+        document_dict = self.document2dict(document)
+        try:
+            return json.dumps(document_dict)
+        except TypeError as e:
+            log.debug("CONVERTER: using generic JSON conversion\n%s", e)
+            return conv.document2json(self.lbbase, conv.dict2document(self.lbbase, document_dict))
+
+    def convert_dict(self, document, plan):
+        """
+        Copy known fields from dict
+        """
+        saida = dict()
+        for name, multivalued, group in plan:
+            value = document.get(name)
+            if value is None:
+                continue
+
+            if group is None:
+                if multivalued:
+                    value = list(value)
+                saida[name] = value
+            elif multivalued:
+                saida[name] = [self.convert_dict(elm, group) for elm in value]
+            else:
+                saida[name] = self.convert_dict(value, group)
+
+        return saida
+
+    def convert_object(self, document, plan):
+        """
+        Read known fields from document object
+        """
+        saida = dict()
+        for name, multivalued, group in plan:
+            value = getattr(document, name, None)
+            if value is None:
+                continue
+
+            if group is None:
+                if multivalued:
+                    value = list(value)
+                saida[name] = value
+            elif multivalued:
+                saida[name] = [self.convert_member(elm, group) for elm in value]
+            else:
+                saida[name] = self.convert_member(value, group)
+
+        return saida
+
+    def convert_member(self, value, group):
+        """
+        Group members may come as dicts or objects
+        """
+        if isinstance(value, dict):
+            return self.convert_dict(value, group)
+
+        return self.convert_object(value, group)
+
+
+def benchmark(converter, document_list, repeat=10):
+    """
+    Compare compiled converter against liblightbase conv
+    :param converter: DocumentConverter instance
+    :param document_list: Documents to convert
+    :param repeat: Number of passes over the documents
+    :return: dict with elapsed seconds and speedup
+    """
+    t0 = time.time()
+    for i in range(repeat):
+        for document in document_list:
+            conv.document2dict(converter.lbbase, document)
+    generic = time.time() - t0
+
+    t0 = time.time()
+    for i in range(repeat):
+        for document in document_list:
+            converter.document2dict(document)
+    fast = time.time() - t0
+
+    total = len(document_list) * repeat
+    saida = {
+        'documents': total,
+        'generic': generic,
+        'fast': fast,
+        'speedup': generic / fast if fast > 0 else None
+    }
+    log.info("CONVERTER: %s documents. conv = %.3fs compiled = %.3fs speedup = %s",
+             total, generic, fast, saida['speedup'])
+
+    return saida
@@ -1,8 +1,15 @@
 #!/usr/env python
 # -*- coding: utf-8 -*-
 __author__ = 'eduardo'
+import os
+import json
+import time
+import errno
+import fcntl
 import logging
-from gensim.corpora import dictionary
+import itertools
+from gensim.corpora import dictionary, mmcorpus
+from lbsociam.lib import documents
 
 log = logging.getLogger()
 
@@ -17,18 +24,31 @@ class EventsCorpus(object):
         Building method
         """
         self.status_base = status_base
-        self.events_tokens = status_base.get_events_tokens()
+        self.last_id_doc = None
+        self.events_tokens = self.get_events_tokens()
         self.dic = self.get_dic()
 
     def __iter__(self):
         """
-        When a dictionary loop is requested make one request at a time
-        :return: JSON with dictionary data
+        Stream events tokens from status base one page at a time
+        :return: Bag of words for every status
         """
-        id_list = self.status_base.get_document_ids()
-        for id_doc in id_list:
-            document = self.status_base.get_document(id_doc)
-            yield self.dic.doc2bow(getattr(document, 'events_tokens', None))
+        for document in self.status_base.iter_documents(select=['events_tokens']):
+            if document.get('events_tokens') is not None:
+                yield self.dic.doc2bow(document['events_tokens'])
+
+    def get_events_tokens(self):
+        """
+        Load events tokens, keeping the last id_doc seen
+        :return: List of events tokens
+        """
+        saida = list()
+        for document in self.status_base.iter_documents(select=['events_tokens']):
+            self.last_id_doc = document['_metadata']['id_doc']
+            if document.get('events_tokens') is not None:
+                saida.append(document['events_tokens'])
+
+        return saida
 
     def get_dic(self):
         """
@@ -54,6 +74,139 @@ class EventsCorpus(object):
         return [self.dic.doc2bow(text) for text in self.events_tokens]
 
 
+class MmEventsCorpus(object):
+    """
+    Events corpus serialized on disk as Matrix Market shards.
+
+    Every update streams the status processed since the last update and
+    writes them to new shards of at most shard_size status, extending the
+    dictionary on the way. Iterating reads the shards from disk, so memory
+    use doesn't depend on the corpus size.
+    """
+    shard_size = 10000
+
+    def __init__(self,
+                 status_base,
+                 path=None):
+        """
+        Building method
+        :param status_base: StatusBase instance
+        :param path: Corpus directory. Defaults to data_dir/corpus/events
+        """
+        self.status_base = status_base
+        if path is None:
+            path = os.path.join(status_base.lbsociam_data_dir, 'corpus', 'events')
+        self.path = path
+        self.dic_file = os.path.join(self.path, 'dictionary')
+        self.state_file = os.path.join(self.path, 'state.json')
+        self.lock_file = os.path.join(self.path, 'lock')
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        self.load()
+
+    def __iter__(self):
+        """
+        Stream bag of words from every shard
+        """
+        for shard in self.state['shards']:
+            for bow in mmcorpus.MmCorpus(os.path.join(self.path, shard)):
+                yield bow
+
+    def __len__(self):
+        return self.state['num_docs']
+
+    @property
+    def corpus(self):
+        """
+        Get corpus
+        :return: Streamed corpus
+        """
+        return self
+
+    @property
+    def last_id_doc(self):
+        return self.state['last_id_doc']
+
+    @property
+    def pending(self):
+        return self.state.get('pending') or dict()
+
+    def load(self):
+        """
+        Load state and dictionary from disk
+        """
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as fd:
+                self.state = json.load(fd)
+            self.dic = dictionary.Dictionary.load(self.dic_file)
+        else:
+            self.state = dict(
+                last_id_doc=None,
+                pending=dict(),
+                num_docs=0,
+                shards=list()
+            )
+            self.dic = dictionary.Dictionary()
+
+    def update(self):
+        """
+        Append status processed after the last update as new shards
+        :return: Number of documents added
+        """
+        with open(self.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Another process may have updated the corpus
+            self.load()
+
+            t0 = time.time()
+            num_docs = 0
+            scan = dict(
+                last_id_doc=self.state['last_id_doc'],
+                pending=self.state.get('pending')
+            )
+            stream = documents.iter_processed(self.status_base, 'events_tokens', scan)
+            while True:
+                # The dictionary grows while bags of words are built, so
+                # the shard is written only after the whole chunk is read.
+                # Otherwise the header would have less terms than the shard
+                bows = [self.dic.doc2bow(document['events_tokens'], allow_update=True)
+                        for document in itertools.islice(stream, self.shard_size)]
+                if not bows:
+                    break
+
+                shard = 'shard-%04d.mm' % (len(self.state['shards']) + 1)
+                tmp = os.path.join(self.path, 'tmp-' + shard)
+                mmcorpus.MmCorpus.serialize(tmp, bows, id2word=self.dic)
+                os.rename(tmp + '.index', os.path.join(self.path, shard + '.index'))
+                os.rename(tmp, os.path.join(self.path, shard))
+
+                self.state['shards'].append(shard)
+                self.state['num_docs'] += len(bows)
+                num_docs += len(bows)
+
+            if num_docs > 0:
+                self.dic.save(self.dic_file)
+
+            # Status still waiting for SRL are kept as pending
+            self.state['last_id_doc'] = scan['last_id_doc']
+            self.state['pending'] = scan['pending']
+            with open(self.state_file + '.tmp', 'w') as fd:
+                json.dump(self.state, fd)
+            os.rename(self.state_file + '.tmp', self.state_file)
+
+        log.info("EVENTS CORPUS: %s status added to %s with %s pending in %.2fs",
+                 num_docs, self.path, len(self.state['pending']), time.time() - t0)
+
+        return num_docs
+
+
 class CategoriesCorpus(object):
     """
     Corpus to categories
@@ -4,8 +4,9 @@ __author__ = 'eduardo'
 
 import logging
 import datetime
-import requests
 import json
+import time
+import nltk
 from requests.exceptions import HTTPError
 from lbsociam import LBSociam
 from liblightbase import lbrest
@@ -15,12 +16,70 @@ from liblightbase.lbbase.lbstruct.field import *
 from liblightbase.lbbase.content import Content
 from liblightbase.lbutils import conv
 from liblightbase.lbsearch.search import *
+from lbsociam.lib import documents, session
+from lbsociam.model import schema
 from pyramid.response import Response
 
 
 log = logging.getLogger()
 
 
+class CategoryIndex(object):
+    """
+    Token and stem to crime category map built from all categories
+    """
+    def __init__(self, categories):
+        """
+        Building method
+        :param categories: List of crimes document dicts
+        """
+        stemmer = nltk.stem.RSLPStemmer()
+        self.tokens = dict()
+        self.stems = dict()
+        self.created = time.time()
+
+        for category in categories:
+            for token in self.category_tokens(category):
+                # First category listing the token wins, as in categories order
+                self.tokens.setdefault(token, category)
+                self.stems.setdefault(stemmer.stem(token), category)
+
+        self.stemmer = stemmer
+
+    @staticmethod
+    def category_tokens(category):
+        """
+        Default token and listed tokens for category
+        :param category: Crimes document dict
+        :return: List of normalized tokens
+        """
+        tokens = list()
+        if category.get('default_token'):
+            tokens.append(category['default_token'])
+
+        if type(category.get('tokens')) == list and len(category['tokens']) > 0:
+            tokens += category['tokens'][0].split(',')
+
+        return [token.strip().lower() for token in tokens if token and token.strip()]
+
+    def get(self, word):
+        """
+        Find category for word, trying the token and then its stem
+        :param word: Token
+        :return: Crimes document dict or None
+        """
+        word = word.strip().lower()
+        category = self.tokens.get(word)
+        if category is None:
+            category = self.stems.get(self.stemmer.stem(word))
+
+        return category
+
+
+# Category index for this process
+_category_index = None
+
+
 class CrimesBase(LBSociam):
     """
     Criminal data base
@@ -41,8 +100,32 @@ class CrimesBase(LBSociam):
             response_object=False
         )
 
+    @property
+    def schema_key(self):
+        """
+        Identification of this base on schema registry
+        """
+        return 'crime', 'crime'
+
+    @property
+    def schema(self):
+        """
+        Base schema built once per process
+        """
+        return schema.registry.get(
+            self.schema_key,
+            self.build_lbbase,
+            self.lbgenerator_rest_url
+        )
+
     @property
     def lbbase(self):
+        """
+        Cached LB Base object
+        """
+        return self.schema.lbbase
+
+    def build_lbbase(self):
         """
         Generate LB Base object
         :return:
@@ -172,7 +255,7 @@ class CrimesBase(LBSociam):
         """
         Retorna metaclass para essa base
         """
-        return self.lbbase.metaclass()
+        return self.schema.metaclass()
 
     def create_base(self):
         """
@@ -206,6 +289,9 @@ class CrimesBase(LBSociam):
         """
         response = self.baserest.update(self.lbbase)
         if response.status_code == 200:
+            # Make sure the next access gets the new structure
+            schema.registry.invalidate(self.schema_key)
+            self.invalidate_index()
             return True
         else:
             raise IOError('Error updating LB Base structure')
@@ -223,8 +309,8 @@ class CrimesBase(LBSociam):
             '$$': search._asjson()
         }
 
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc'
-        result = requests.get(
+        url = self.schema.doc_url
+        result = session.get(
             url=url,
             params=params
         )
@@ -232,12 +318,40 @@ class CrimesBase(LBSociam):
 
         return results
 
+    def iter_documents(self,
+                       select=None,
+                       page_size=None,
+                       literal=None,
+                       offset=0,
+                       last_id_doc=None):
+        """
+        Stream crimes documents page by page ordered by id_doc
+
+        :param select: Fields to be returned. Defaults to the whole document
+        :param page_size: Documents fetched per request. Defaults to config page_size
+        :param literal: Extra SQL filter
+        :param offset: Documents skipped on the first page
+        :param last_id_doc: Start scan after this id_doc
+        :return: Generator of document dicts
+        """
+        if page_size is None:
+            page_size = self.page_size
+
+        return documents.iter_documents(
+            self,
+            select=select,
+            page_size=page_size,
+            literal=literal,
+            offset=offset,
+            last_id_doc=last_id_doc
+        )
+
     def get_document(self, id_doc):
         """
         Get document by ID on base
         """
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc/' + str(id_doc)
-        response = requests.get(url)
+        url = self.schema.doc_url + '/' + str(id_doc)
+        response = session.get(url)
         if response.status_code > 300:
             return None
 
@@ -251,14 +365,17 @@ class CrimesBase(LBSociam):
         """
         document = json.dumps(new_document)
         #print(document)
-        return self.documentrest.update(id=id_doc, document=document)
+        result = self.documentrest.update(id=id_doc, document=document)
+        self.invalidate_index()
+
+        return result
 
     def upload_file(self, fileobj):
         """
         Upload file on LB
         """
-        url = self.lbgenerator_rest_url + "/" + self.lbbase._metadata.name + "/file"
-        result = requests.post(
+        url = self.schema.base_url + "/file"
+        result = session.post(
             url=url,
             files={
                 'file': fileobj.file.read()
@@ -271,13 +388,12 @@ class CrimesBase(LBSociam):
         """
         Insert file in document
         """
-        url = self.lbgenerator_rest_url + "/" + self.lbbase._metadata.name + \
-              "/doc/" + id_doc + '/images'
+        url = self.schema.doc_url + "/" + id_doc + '/images'
 
         log.debug("URL para insercao dos atributos da imagem %s", url)
         log.debug(file_dict)
 
-        result = requests.post(
+        result = session.post(
             url=url,
             data={
                 'value': json.dumps(file_dict)
@@ -335,16 +451,17 @@ class CrimesBase(LBSociam):
         Update base in proposed path
         """
         response = Response(content_type='application/json')
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc/' + id_doc
+        url = self.schema.doc_url + '/' + id_doc
         url = url + '/' + path
         params = {
             'value': value
         }
 
-        result = requests.put(
+        result = session.put(
             url=url,
             data=params
         )
+        self.invalidate_index()
 
         if result.status_code >= 300:
             response.status_code = 500
@@ -357,6 +474,37 @@ class CrimesBase(LBSociam):
 
         return response
 
+    @property
+    def category_index(self):
+        """
+        Category index for this process. Built again after
+        category_index_ttl seconds, so changes from other processes show up
+        """
+        global _category_index
+        if _category_index is None or \
+                time.time() - _category_index.created >= self.category_index_ttl:
+            t0 = time.time()
+            _category_index = CategoryIndex(self.get_all())
+            log.debug("CRIMES: category index built with %s tokens in %.2fs",
+                      len(_category_index.tokens), time.time() - t0)
+
+        return _category_index
+
+    def invalidate_index(self):
+        """
+        Drop category index after changes on crimes base
+        """
+        global _category_index
+        _category_index = None
+
+    def get_category_by_token(self, name):
+        """
+        Find category for token without searching the base
+        :param name: Token
+        :return: Crimes document dict or None
+        """
+        return self.category_index.get(name)
+
     def get_crime_by_name(self, name):
         """
         Return a crime by name
@@ -371,8 +519,8 @@ class CrimesBase(LBSociam):
             '$$': search._asjson()
         }
 
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc'
-        result = requests.get(
+        url = self.schema.doc_url
+        result = session.get(
             url=url,
             params=params
         )
@@ -395,8 +543,8 @@ class CrimesBase(LBSociam):
             '$$': search._asjson()
         }
 
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc'
-        result = requests.get(
+        url = self.schema.doc_url
+        result = session.get(
             url=url,
             params=params
         )
@@ -413,8 +561,8 @@ class CrimesBase(LBSociam):
             'q': name
         }
 
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/es/_search'
-        result = requests.get(
+        url = self.schema.search_url
+        result = session.get(
             url=url,
             params=params
         )
@@ -444,14 +592,13 @@ class CrimesBase(LBSociam):
             order_by=orderby,
             offset=0
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
         saida = list()
 
@@ -483,14 +630,13 @@ class CrimesBase(LBSociam):
             order_by=orderby,
             offset=0
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
         saida = list()
 
@@ -569,6 +715,8 @@ class Crimes(crimes_base.metaclass):
             log.error(err.strerror)
             return None
 
+        self.crimes_base.invalidate_index()
+
         return result
 
     def update(self, id_doc):
@@ -579,4 +727,7 @@ class Crimes(crimes_base.metaclass):
         """
         document = self.crimes_to_json()
         #print(document)
-        return self.crimes_base.documentrest.update(id=id_doc, document=document)
\ No newline at end of file
+        result = self.crimes_base.documentrest.update(id=id_doc, document=document)
+        self.crimes_base.invalidate_index()
+
+        return result
\ No newline at end of file
@@ -3,9 +3,9 @@
 __author__ = 'eduardo'
 
 import logging
-import requests
 import time
-from requests.exceptions import HTTPError, ConnectionError
+from array import array
+from requests.exceptions import HTTPError, ConnectionError, Timeout
 from lbsociam import LBSociam
 from liblightbase import lbrest
 from liblightbase.lbbase.struct import Base, BaseMetadata
@@ -14,10 +14,92 @@ from liblightbase.lbbase.lbstruct.field import *
 from liblightbase.lbbase.content import Content
 from liblightbase.lbutils import conv
 from liblightbase.lbsearch.search import *
+from lbsociam.lib import documents, session
+from lbsociam.model import schema
 
 log = logging.getLogger()
 
 
+class TokenIndex(object):
+    """
+    Compact token -> (id_doc, frequency) index.
+
+    Tokens are stored as interned UTF-8 strings mapping to a position on two
+    arrays of machine integers, so the whole vocabulary stays small in memory.
+    """
+    def __init__(self):
+        """
+        Building method
+        """
+        self.positions = dict()
+        self.ids = array('l')
+        self.frequencies = array('l')
+        self.last_id_doc = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, token):
+        return self.key(token) in self.positions
+
+    @staticmethod
+    def key(token):
+        """
+        Index key for token
+        """
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+
+        return intern(token)
+
+    def add(self, token, id_doc, frequency=None):
+        """
+        Add or replace token
+        :param token: Token
+        :param id_doc: Dictionary document id_doc
+        :param frequency: Token frequency
+        """
+        key = self.key(token)
+        id_doc = int(id_doc)
+        frequency = int(frequency or 0)
+
+        position = self.positions.get(key)
+        if position is None:
+            self.positions[key] = len(self.ids)
+            self.ids.append(id_doc)
+            self.frequencies.append(frequency)
+        else:
+            self.ids[position] = id_doc
+            self.frequencies[position] = frequency
+
+        if self.last_id_doc is None or id_doc > self.last_id_doc:
+            self.last_id_doc = id_doc
+
+    def get(self, token):
+        """
+        Find token
+        :param token: Token
+        :return: (id_doc, frequency) or None
+        """
+        position = self.positions.get(self.key(token))
+        if position is None:
+            return None
+
+        return self.ids[position], self.frequencies[position]
+
+    def set_frequency(self, token, frequency):
+        """
+        Change frequency for indexed token
+        """
+        position = self.positions.get(self.key(token))
+        if position is not None:
+            self.frequencies[position] = int(frequency)
+
+
+# Token indexes for this process by dictionary base name
+token_indexes = dict()
+
+
 class DictionaryBase(LBSociam):
     """
     Criminal data base
@@ -44,15 +126,38 @@ class DictionaryBase(LBSociam):
 
     def __iter__(self):
         """
-        When a dictionary loop is requested make one request at a time
-        :return: JSON with dictionary data
+        When a dictionary loop is requested fetch one page at a time
+        :return: Dictionary document dict
         """
-        id_list = self.get_document_ids()
-        for id_doc in id_list:
-            yield self.get_document(id_doc)
+        for document in self.iter_documents():
+            yield document
+
+    @property
+    def schema_key(self):
+        """
+        Identification of this base on schema registry
+        """
+        return 'dictionary', self.dictionary_base
+
+    @property
+    def schema(self):
+        """
+        Base schema built once per process
+        """
+        return schema.registry.get(
+            self.schema_key,
+            self.build_lbbase,
+            self.lbgenerator_rest_url
+        )
 
     @property
     def lbbase(self):
+        """
+        Cached LB Base object
+        """
+        return self.schema.lbbase
+
+    def build_lbbase(self):
         """
         Generate LB Base object
         :return:
@@ -120,7 +225,7 @@ class DictionaryBase(LBSociam):
         """
         Retorna metaclass para essa base
         """
-        return self.lbbase.metaclass()
+        return self.schema.metaclass()
 
     def create_base(self):
         """
@@ -143,6 +248,8 @@ class DictionaryBase(LBSociam):
         """
         response = self.baserest.delete(self.lbbase)
         if response.status_code == 200:
+            # Indexed tokens are gone with the base
+            token_indexes.pop(self.dictionary_base, None)
             return True
         else:
             raise IOError('Error excluding base from LB')
@@ -153,33 +260,46 @@ class DictionaryBase(LBSociam):
         """
         response = self.baserest.update(self.lbbase)
         if response.status_code == 200:
+            # Make sure the next access gets the new structure
+            schema.registry.invalidate(self.schema_key)
             return True
         else:
             raise IOError('Error updating LB Base structure')
 
-    def get_document_ids(self):
+    def iter_documents(self,
+                       select=None,
+                       page_size=None,
+                       literal=None,
+                       offset=0,
+                       last_id_doc=None):
         """
-        Build a lis with all document ID's
+        Stream dictionary documents page by page ordered by id_doc
+
+        :param select: Fields to be returned. Defaults to the whole document
+        :param page_size: Documents fetched per request. Defaults to config page_size
+        :param literal: Extra SQL filter
+        :param offset: Documents skipped on the first page
+        :param last_id_doc: Start scan after this id_doc
+        :return: Generator of document dicts
         """
-        orderby = OrderBy(asc=['id_doc'])
-        select = ['id_doc']
-        search = Search(
+        if page_size is None:
+            page_size = self.page_size
+
+        return documents.iter_documents(
+            self,
             select=select,
-            limit=None,
-            order_by=orderby
+            page_size=page_size,
+            literal=literal,
+            offset=offset,
+            last_id_doc=last_id_doc
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
-        vars = {
-            '$$': search._asjson()
-        }
 
-        # Envia requisição para o REST
-        response = requests.get(url, params=vars)
-        collection = response.json()
+    def get_document_ids(self):
+        """
+        Build a lis with all document ID's
+        """
         saida = list()
-        # Cria uma lista de resultados como ID
-        for results in collection['results']:
+        for results in self.iter_documents(select=['id_doc']):
             saida.append(results['_metadata']['id_doc'])
 
         return saida
@@ -190,33 +310,213 @@ class DictionaryBase(LBSociam):
         """
         return self.documentrest.get(id_doc)
 
+    def get_documents(self, id_list, select=None):
+        """
+        Fetch many dictionary documents in bulk
+
+        :param id_list: List of id_doc to fetch
+        :param select: Fields to be returned. Defaults to the whole document
+        :return: List of document dicts in id_list order. None for missing documents
+        """
+        return documents.get_documents(self, id_list, select=select)
+
+    @property
+    def index(self):
+        """
+        Token index for this base, loaded on first access
+        """
+        index = token_indexes.get(self.dictionary_base)
+        if index is None:
+            index = self.load_index()
+
+        return index
+
+    def load_index(self):
+        """
+        Load token index from base with a streaming scan
+        :return: TokenIndex instance
+        """
+        index = TokenIndex()
+        t0 = time.time()
+        for document in self.iter_documents(select=['id_doc', 'token', 'frequency']):
+            index.add(document['token'], document['_metadata']['id_doc'], document.get('frequency'))
+
+        token_indexes[self.dictionary_base] = index
+        log.info("DICTIONARY: %s tokens indexed in %.2fs", len(index), time.time() - t0)
+
+        return index
+
+    def refresh_index(self, full=False):
+        """
+        Refresh token index for long running processes
+        :param full: Reload everything. Otherwise only tokens created after
+            the last indexed id_doc are added
+        :return: TokenIndex instance
+        """
+        index = token_indexes.get(self.dictionary_base)
+        if full or index is None:
+            return self.load_index()
+
+        for document in self.iter_documents(select=['id_doc', 'token', 'frequency'],
+                                            last_id_doc=index.last_id_doc):
+            index.add(document['token'], document['_metadata']['id_doc'], document.get('frequency'))
+
+        return index
+
+    def index_token(self, token, id_doc, frequency=None):
+        """
+        Add token to index if it is already loaded
+        """
+        index = token_indexes.get(self.dictionary_base)
+        if index is not None:
+            index.add(token, id_doc, frequency)
+
+    def update_frequency(self, id_doc, frequency, token=None):
+        """
+        Update only frequency path on document
+        :param id_doc: Document ID
+        :param frequency: New frequency
+        :param token: Token, to keep the index up to date
+        :return: Response text
+        """
+        url = self.schema.doc_url + '/' + str(id_doc) + '/frequency'
+        params = {
+            'value': frequency
+        }
+        try:
+            response = session.put(
+                url=url,
+                data=params
+            )
+        except (ConnectionError, Timeout) as e:
+            # Try again
+            log.error("DICTIONARY:\n%s", e)
+
+            time.sleep(1)
+            return self.update_frequency(id_doc, frequency, token)
+
+        # Raise any update errors
+        response.raise_for_status()
+
+        if token is not None:
+            index = token_indexes.get(self.dictionary_base)
+            if index is not None:
+                index.set_frequency(token, frequency)
+
+        return response.text
+
     def get_by_token(self, token):
         """
-        Return a crime by name
+        Return a dictionary document by token
+        """
+        return self.get_by_tokens([token]).get(token)
+
+    def search_token(self, token):
+        """
+        Search base for token
         """
         orderby = OrderBy(['token'])
         search = Search(
             limit=1,
             order_by=orderby,
-            literal="document->>'token' = '" + token + "'",
+            literal="document->>'token' = '" + token.replace("'", "''") + "'",
         )
         params = {
             '$$': search._asjson()
         }
 
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc'
-        result = requests.get(
+        url = self.schema.doc_url
+        result = session.get(
             url=url,
             params=params
         )
         results = result.json()
         if len(results['results']) > 0:
             response = results['results'][0]
+            self.index_token(token, response['_metadata']['id_doc'], response.get('frequency'))
         else:
             response = None
 
         return response
 
+    def get_by_tokens(self, token_list, chunk_size=200):
+        """
+        Find many tokens, answering from the token index
+
+        Only tokens missing from the index are searched on base, with one
+        search per chunk. They may have been created by another process
+        after the index was loaded, so found tokens are added to the index.
+
+        :param token_list: List of tokens
+        :param chunk_size: Maximum number of tokens in one search
+        :return: dict token -> document dict. Missing tokens are not returned
+        """
+        index = self.index
+
+        saida = dict()
+        missing = list()
+        for token in set(token_list):
+            entry = index.get(token)
+            if entry is None:
+                missing.append(token)
+                continue
+
+            saida[token] = dict(
+                _metadata=dict(id_doc=entry[0]),
+                token=token,
+                frequency=entry[1]
+            )
+
+        if missing:
+            saida.update(self.search_tokens(missing, chunk_size))
+
+        return saida
+
+    def search_tokens(self, token_list, chunk_size=200):
+        """
+        Search base for many tokens with a few searches
+
+        :param token_list: List of tokens
+        :param chunk_size: Maximum number of tokens in one search
+        :return: dict token -> document dict. Missing tokens are not returned
+        """
+        select = ['id_doc', 'token', 'stem', 'frequency', 'status_list']
+        url = self.schema.doc_url
+
+        saida = dict()
+        for chunk in documents.chunks(list(token_list), chunk_size):
+            literal = "document->>'token' in (%s)" % ",".join(
+                ["'" + token.replace("'", "''") + "'" for token in chunk]
+            )
+            search = Search(
+                select=select,
+                limit=len(chunk),
+                literal=literal
+            )
+            params = {
+                '$$': search._asjson()
+            }
+
+            try:
+                response = session.get(url, params=params)
+            except (ConnectionError, Timeout) as e:
+                # Try again
+                log.error("DICTIONARY:\n%s", e)
+
+                time.sleep(1)
+                return self.search_tokens(token_list, chunk_size)
+
+            results = response.json().get('results')
+            if results is None:
+                log.error("DICTIONARY: Error searching tokens %s", chunk)
+                continue
+
+            for document in results:
+                saida[document['token']] = document
+                self.index_token(document['token'], document['_metadata']['id_doc'], document.get('frequency'))
+
+        return saida
+
     def export(self, outfile, offset=0, limit=100):
         orderby = OrderBy(asc=['id_doc'])
         select = ['id_doc', 'token']
@@ -226,14 +526,13 @@ class DictionaryBase(LBSociam):
             offset=offset,
             order_by=orderby
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
         saida = list()
         # Cria uma lista de resultados como ID
@@ -251,14 +550,13 @@ class DictionaryBase(LBSociam):
             offset=0,
             order_by=orderby
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
 
         return collection
@@ -303,7 +601,7 @@ class Dictionary(dictionary_base.metaclass):
         document = self.dictionary_to_json()
         try:
             result = self.dictionary_base.documentrest.create(document)
-        except ConnectionError as err:
+        except (ConnectionError, Timeout) as err:
             log.error("DICTIONARY:\n%s", err)
 
             # Try to connect again
@@ -316,6 +614,9 @@ class Dictionary(dictionary_base.metaclass):
             # dic = self.dictionary_base.get_by_token(self.token)
             return None
 
+        # Keep process index up to date
+        self.dictionary_base.index_token(self.token, result, getattr(self, 'frequency', None))
+
         return result
 
     def update(self, id_doc):
@@ -326,17 +627,16 @@ class Dictionary(dictionary_base.metaclass):
         """
         document = self.dictionary_to_json()
         # print(document)
-        url = self.dictionary_base.documentrest.rest_url
-        url += "/" + self.dictionary_base.lbbase._metadata.name + "/doc/" + str(id_doc)
+        url = self.dictionary_base.schema.doc_url + '/' + str(id_doc)
         vars = {
             'value': document
         }
         try:
-            response = requests.put(
+            response = session.put(
                 url=url,
                 data=vars
             )
-        except ConnectionError as e:
+        except (ConnectionError, Timeout) as e:
             # Try again
             log.error("DICIONARY:\n%s", e)
 
@@ -350,40 +650,18 @@ class Dictionary(dictionary_base.metaclass):
 
     def get_id_doc(self):
         """
-        Return a crime by name
-        """
-        orderby = OrderBy(['token'])
-        search = Search(
-            limit=1,
-            order_by=orderby,
-            literal="document->>'token' = '" + self.token + "'",
-        )
-        params = {
-            '$$': search._asjson()
-        }
-
-        url = self.dictionary_base.lbgenerator_rest_url + '/' + self.dictionary_base.lbbase.metadata.name + '/doc'
-        try:
-            result = requests.get(
-                url=url,
-                params=params
-            )
-        except ConnectionError as e:
-            # Try again
-            log.error("DICTIONARY:\n%s", e)
+        Return a dictionary id_doc by token.
 
-            time.sleep(1)
-            return self.get_id_doc()
-
-        results = result.json()
-        if results.get('results') is None:
+        Tokens are looked up on the process index. Tokens missing from the
+        index may have been created by another process, so the base is
+        searched before giving up.
+        """
+        document = self.dictionary_base.get_by_token(self.token)
+        if document is None:
             return None
 
-        if len(results['results']) > 0:
-            response = results['results'][0]['_metadata']['id_doc']
-            self.frequency = results['results'][0]['frequency']
-            self.status_list = results['results'][0]['status_list']
-        else:
-            response = None
+        self.frequency = document.get('frequency')
+        if document.get('status_list') is not None:
+            self.status_list = document['status_list']
 
-        return response
\ No newline at end of file
+        return document['_metadata']['id_doc']
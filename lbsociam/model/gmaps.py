@@ -2,9 +2,15 @@
 # -*- coding: utf-8 -*-
 __author__ = 'eduardo'
 
+import os
 from lbsociam import LBSociam
+from lbsociam.lib.ratelimit import TokenBucket, SharedQuota
+from lbsociam.lib.jsonqueue import JsonQueue
 from googlemaps import client
 
+# Client for this process
+_maps = None
+
 
 class GMaps(LBSociam):
     """
@@ -15,4 +21,28 @@ class GMaps(LBSociam):
         Start with APi parameters
         """
         LBSociam.__init__(self)
-        self.client = client.Client(key=self.gmaps_api_key)
\ No newline at end of file
+        self.client = client.Client(key=self.gmaps_api_key)
+
+        # Requests per second for this process
+        self.bucket = TokenBucket(self.gmaps_rate_limit, self.gmaps_rate_burst)
+
+        # Daily quota and sleep time shared by all workers
+        self.quota = SharedQuota(
+            os.path.join(self.lbsociam_data_dir, 'gmaps_quota.json'),
+            daily_limit=self.gmaps_daily_quota
+        )
+
+        # Lookups to be made when quota is available again
+        self.deferred = JsonQueue(os.path.join(self.lbsociam_data_dir, 'gmaps_deferred.jsonl'))
+
+
+def get_maps():
+    """
+    Get Google Maps client for this process
+    :return: GMaps instance
+    """
+    global _maps
+    if _maps is None:
+        _maps = GMaps()
+
+    return _maps
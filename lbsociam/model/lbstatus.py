@@ -1,14 +1,16 @@
 #!/usr/env python
 # -*- coding: utf-8 -*-
 __author__ = 'eduardo'
+import os
+import errno
 import datetime
 import logging
-import requests
 import sys
 import json
 from requests.exceptions import HTTPError
 from lbsociam import LBSociam
-from lbsociam.lib import srl, dictionary, location, lda
+from lbsociam.lib import srl, dictionary, location, lda, documents, session, geocoder, jsonqueue
+from lbsociam.model import schema
 from liblightbase import lbrest
 from liblightbase.lbutils import conv
 from liblightbase.lbbase.struct import Base, BaseMetadata
@@ -26,6 +28,8 @@ class StatusBase(LBSociam):
     """
     Base class to social networks status
     """
+    _changed_days = None
+
     def __init__(self,
                  status_name=None,
                  dic_name=None):
@@ -53,15 +57,38 @@ class StatusBase(LBSociam):
 
     def __iter__(self):
         """
-        When a dictionary loop is requested make one request at a time
-        :return: JSON with dictionary data
+        When a status loop is requested fetch one page at a time
+        :return: Status dict
+        """
+        for document in self.iter_documents():
+            yield document
+
+    @property
+    def schema_key(self):
+        """
+        Identification of this base on schema registry
+        """
+        return 'status', self.status_base
+
+    @property
+    def schema(self):
+        """
+        Base schema built once per process
         """
-        id_list = self.get_document_ids()
-        for id_doc in id_list:
-            yield self.get_document(id_doc)
+        return schema.registry.get(
+            self.schema_key,
+            self.build_lbbase,
+            self.lbgenerator_rest_url
+        )
 
     @property
     def lbbase(self):
+        """
+        Cached LB Base object
+        """
+        return self.schema.lbbase
+
+    def build_lbbase(self):
         """
         Generate LB Base object
         :return:
@@ -542,21 +569,79 @@ class StatusBase(LBSociam):
         """
         Retorna metaclass para essa base
         """
-        return self.lbbase.metaclass()
+        return self.schema.metaclass()
+
+    @property
+    def converter(self):
+        """
+        Compiled document converter for status
+        """
+        return self.schema.converter
+
+    @property
+    def srl_cache(self):
+        """
+        SRL results cache. None if disabled
+        """
+        if not self.srl_cache_enabled:
+            return None
+
+        return srl.get_cache(
+            os.path.join(self.lbsociam_data_dir, 'srl_cache'),
+            max_entries=self.srl_cache_size
+        )
+
+    @property
+    def changed_days(self):
+        """
+        Inclusion dates of status changed after they were added, read when
+        analytics rollups are updated
+        """
+        if self._changed_days is None:
+            path = os.path.join(self.lbsociam_data_dir, 'rollups')
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+            self._changed_days = jsonqueue.JsonQueue(os.path.join(path, 'changed.jsonl'))
+
+        return self._changed_days
+
+    def touch(self, status_list):
+        """
+        Record inclusion dates of changed status, so rollups for those days
+        are computed again. Callers touch a whole batch at once, so every
+        batch adds at most one entry
+        :param status_list: Status dicts with inclusion date
+        """
+        days = set()
+        for status_dict in status_list:
+            if status_dict is None:
+                continue
+
+            day = status_dict.get('inclusion_date') or status_dict.get('inclusion_datetime')
+            if day is not None:
+                days.add(day)
+
+        if days:
+            self.changed_days.put(days=sorted(days))
 
     @property
     def arg_structures(self):
         """
         Metaclass para o grupo
         """
-        return self.lbbase.metaclass('arg_structures')
+        return self.schema.metaclass('arg_structures')
 
     @property
     def argument(self):
         """
         Metaclass para o grupo
         """
-        return self.lbbase.metaclass('argument')
+        return self.schema.metaclass('argument')
 
     def create_base(self):
         """
@@ -589,6 +674,8 @@ class StatusBase(LBSociam):
         """
         response = self.baserest.update(self.lbbase)
         if response.status_code == 200:
+            # Make sure the next access gets the new structure
+            schema.registry.invalidate(self.schema_key)
             return True
         else:
             raise IOError('Error updating LB Base structure')
@@ -598,8 +685,8 @@ class StatusBase(LBSociam):
         Get base
         :return: Base JSON object
         """
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc'
-        response = requests.get(
+        url = self.schema.doc_url
+        response = session.get(
             url=url
         )
 
@@ -608,49 +695,50 @@ class StatusBase(LBSociam):
         else:
             raise IOError('Error getting LB Base structure')
 
-    def get_document_ids(self, offset=0, start_date=None, end_date=None):
-        """
-        Build a lis with all document ID's
-        """
-        orderby = OrderBy(asc=['id_doc'])
-        select = ['id_doc']
-        literal = ""
-
-        # Check if there are date filters
-        if start_date is not None:
-            if end_date is None:
-                # Default to now
-                end_date = datetime.datetime.now()
-
-            # Use search by inclusion_datetime
-            literal = """inclusion_datetime between '%s'::date and '%s'::date""" % (
-                start_date.strftime("%Y-%m-%d"),
-                end_date.strftime("%Y-%m-%d")
-            )
-
-        search = Search(
+    def iter_documents(self,
+                       select=None,
+                       page_size=None,
+                       start_date=None,
+                       end_date=None,
+                       literal=None,
+                       offset=0,
+                       last_id_doc=None):
+        """
+        Stream status documents page by page ordered by id_doc
+
+        :param select: Fields to be returned. Defaults to the whole document
+        :param page_size: Documents fetched per request. Defaults to config page_size
+        :param start_date: Filter by inclusion_datetime starting on this date
+        :param end_date: Filter by inclusion_datetime ending on this date
+        :param literal: Extra SQL filter
+        :param offset: Documents skipped on the first page
+        :param last_id_doc: Start scan after this id_doc
+        :return: Generator of status dicts
+        """
+        if page_size is None:
+            page_size = self.page_size
+
+        return documents.iter_documents(
+            self,
             select=select,
-            limit=None,
+            page_size=page_size,
             literal=literal,
-            order_by=orderby,
-            offset=offset
+            start_date=start_date,
+            end_date=end_date,
+            offset=offset,
+            last_id_doc=last_id_doc
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
-        vars = {
-            '$$': search._asjson()
-        }
 
-        # Envia requisição para o REST
-        response = requests.get(url, params=vars)
-        collection = response.json()
+    def get_document_ids(self, offset=0, start_date=None, end_date=None):
+        """
+        Build a lis with all document ID's
+        """
         saida = list()
-
-        # Cria uma lista de resultados como ID
-        if collection.get('results') is None:
-            return None
-
-        for results in collection['results']:
+        for results in self.iter_documents(
+                select=['id_doc'],
+                offset=offset,
+                start_date=start_date,
+                end_date=end_date):
             saida.append(results['_metadata']['id_doc'])
 
         return saida
@@ -661,6 +749,16 @@ class StatusBase(LBSociam):
         """
         return self.documentrest.get(id_doc)
 
+    def get_documents(self, id_list, select=None):
+        """
+        Fetch many status documents in bulk
+
+        :param id_list: List of id_doc to fetch
+        :param select: Fields to be returned. Defaults to the whole document
+        :return: List of document dicts in id_list order. None for missing documents
+        """
+        return documents.get_documents(self, id_list, select=select)
+
     def search_by_token(self, token, limit=10):
         """
         Search status by content
@@ -675,8 +773,8 @@ class StatusBase(LBSociam):
             '$$': search._asjson()
         }
 
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc'
-        result = requests.get(
+        url = self.schema.doc_url
+        result = session.get(
             url=url,
             params=params
         )
@@ -690,31 +788,9 @@ class StatusBase(LBSociam):
         Get events corpus
         :return: Events corpus
         """
-        orderby = OrderBy(asc=['id_doc'])
-        select = ['events_tokens']
-        search = Search(
-            select=select,
-            limit=None,
-            order_by=orderby,
-            offset=0
-        )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
-        vars = {
-            '$$': search._asjson()
-        }
-
-        # Envia requisição para o REST
-        response = requests.get(url, params=vars)
-        collection = response.json()
         saida = list()
-
-        # Cria uma lista de resultados como ID
-        if collection.get('results') is None:
-            return None
-
-        for results in collection['results']:
-            if results is not None:
+        for results in self.iter_documents(select=['events_tokens']):
+            if results.get('events_tokens') is not None:
                 saida.append(results['events_tokens'])
 
         return saida
@@ -732,14 +808,13 @@ class StatusBase(LBSociam):
             order_by=orderby,
             offset=0
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
         saida = list()
 
@@ -764,14 +839,13 @@ class StatusBase(LBSociam):
             offset=offset,
             literal=literal
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
 
         return collection
@@ -814,37 +888,43 @@ class StatusBase(LBSociam):
             literal=literal,
             offset=0
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
 
         return collection
 
-    def process_tokens(self, id_doc, update=True):
+    def process_tokens(self, id_doc, update=True, status_dict=None, tokenized=None, aggregator=None,
+                       geo_stage=None):
         """
         Process tokens for this id_doc
 
         :param id_doc: Document to be processed
         :param update: Whether we should update dictionary frequency or not
+        :param status_dict: Status dict already fetched from base
+        :param tokenized: SRL result already calculated for this status text
+        :param aggregator: FrequencyAggregator shared by a batch of status
+        :param geo_stage: GeoStage receiving the status for geocoding. None to geocode here
         :return: True or False
         """
-        result = self.get_document(id_doc)
+        if status_dict is None:
+            result = self.get_document(id_doc)
 
-        # JSON
-        status_dict = conv.document2dict(self.lbbase, result)
+            # JSON
+            status_dict = self.converter.document2dict(result)
 
         # Manually add id_doc
         status_dict['_metadata'] = dict()
         status_dict['_metadata']['id_doc'] = id_doc
 
         # SRL tokenize
-        tokenized = srl.srl_tokenize(status_dict['text'])
+        if tokenized is None:
+            tokenized = srl.srl_tokenize(status_dict['text'], cache=self.srl_cache)
         if tokenized.get('arg_structures') is not None:
             status_dict['arg_structures'] = tokenized.get('arg_structures')
 
@@ -852,13 +932,22 @@ class StatusBase(LBSociam):
             status_dict['tokens'] = tokenized.get('tokens')
 
         # Now try to find location
-        status_dict = location.get_location(status_dict)
+        if geo_stage is None:
+            status_dict = location.get_location(status_dict)
 
         # Process tokens if selected
-        dictionary_base = dic.DictionaryBase(
-            dic_base=self.dictionary_base
+        if aggregator is None:
+            dictionary_base = dic.DictionaryBase(
+                dic_base=self.dictionary_base
+            )
+        else:
+            dictionary_base = aggregator.dictionary_base
+        result = dictionary.process_tokens_dict(
+            status_dict,
+            dictionary_base,
+            update=update,
+            aggregator=aggregator
         )
-        result = dictionary.process_tokens_dict(status_dict, dictionary_base, update=update)
         log.debug("Corpus da tokenização calculado. id_doc = %s", id_doc)
         status_dict = result['status']
 
@@ -868,6 +957,12 @@ class StatusBase(LBSociam):
         # Calculate category
         status_dict = self.get_category(status_dict)
 
+        if geo_stage is not None:
+            # Location and brasil city are written later by the geo stage
+            self.documentrest.update(id_doc, json.dumps(status_dict))
+            geo_stage.submit(id_doc, status_dict)
+            return True
+
         # Get brasil city information
         status_dict = self.process_geo_dict(
             id_doc=id_doc,
@@ -879,11 +974,12 @@ class StatusBase(LBSociam):
 
         return True
 
-    def process_hashtags(self, id_doc):
-        result = self.get_document(id_doc)
+    def process_hashtags(self, id_doc, status_dict=None):
+        if status_dict is None:
+            result = self.get_document(id_doc)
 
-        # JSON
-        status_dict = conv.document2dict(self.lbbase, result)
+            # JSON
+            status_dict = self.converter.document2dict(result)
 
         # Manually add id_doc
         status_dict['_metadata'] = dict()
@@ -920,14 +1016,13 @@ class StatusBase(LBSociam):
             order_by=orderby,
             offset=0
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
 
         return collection
@@ -982,8 +1077,8 @@ class StatusBase(LBSociam):
             '$$': search._asjson()
         }
 
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc'
-        result = requests.get(
+        url = self.schema.doc_url
+        result = session.get(
             url=url,
             params=params
         )
@@ -998,6 +1093,42 @@ class StatusBase(LBSociam):
 
         return response
 
+    def update_path(self, id_doc, path, value):
+        """
+        Update only one path on status document
+        :param id_doc: Document ID
+        :param path: Document path
+        :param value: New value. Already encoded as JSON for groups
+        :return: Response text
+        """
+        url = self.schema.doc_url + '/' + str(id_doc) + '/' + path
+        params = {
+            'value': value
+        }
+        response = session.put(
+            url=url,
+            data=params
+        )
+
+        # Raise any update errors
+        response.raise_for_status()
+
+        return response.text
+
+    def classify_batch(self, status_list):
+        """
+        Find category for many status at once
+
+        :param status_list: List of status dicts
+        :return: List of status dicts with category
+        """
+        # Use default status base to load the stored LDA Model
+        return lda.classify_batch(
+            status_list,
+            status_base,
+            self.crimes_base
+        )
+
     def get_category(self, status_dict):
         """
         Find category for this status
@@ -1005,10 +1136,8 @@ class StatusBase(LBSociam):
         :param status_dict: Status dict to be inserted back on the base
         :return dict: Identified category
         """
-        # Consider always training base for the model
-        status_base = StatusBase()
-
-        # Use default status base to calculate LDA Model
+        # Consider always training base for the model. Use default status
+        # base to load the stored LDA Model
         category = lda.get_category(
             status_dict,
             status_base,
@@ -1025,7 +1154,7 @@ class StatusBase(LBSociam):
         """
         if status_dict is None:
             document = self.get_document(id_doc)
-            status_dict = conv.document2dict(self.lbbase, document)
+            status_dict = self.converter.document2dict(document)
 
         if status_dict.get('location') is None:
             if status_dict.get('arg_structures') is not None:
@@ -1041,13 +1170,25 @@ class StatusBase(LBSociam):
                 log.error("Location not available for document id = %s", id_doc)
                 return status_dict
 
+        if self.gazetteer is not None:
+            # Find city locally
+            city = geocoder.get_geocoder(self.gazetteer).nearest(
+                float(status_dict['location']['latitude']),
+                float(status_dict['location']['longitude']),
+                max_distance
+            )
+            if city is not None:
+                status_dict['brasil_city'] = city
+
+            return status_dict
+
         params = {
             'lat': status_dict['location']['latitude'],
             'lng': status_dict['location']['longitude']
         }
 
         url = self.geo_url + '/city'
-        result = requests.post(
+        result = session.post(
             url=url,
             data=json.dumps(params)
         )
@@ -1076,13 +1217,65 @@ class StatusBase(LBSociam):
 
         return status_dict
 
-    def process_geo(self, id_doc, max_distance=50000):
+    def process_geo_batch(self, status_list, max_distance=50000):
+        """
+        Get Brasil city for many status at once
+
+        :param status_list: List of status dicts with _metadata
+        :param max_distance: Max distance (Meters) to consider
+        :return: List of status dicts
+        """
+        if self.gazetteer is None:
+            # No local gazetteer. Ask geo_url one by one
+            return [
+                self.process_geo_dict(elm['_metadata']['id_doc'], max_distance, status_dict=elm)
+                for elm in status_list
+            ]
+
+        positions = list()
+        lat = list()
+        lng = list()
+        for i, status_dict in enumerate(status_list):
+            id_doc = status_dict['_metadata']['id_doc']
+            if status_dict.get('location') is None:
+                if status_dict.get('arg_structures') is None:
+                    log.error("Location not available for document id = %s", id_doc)
+                    continue
+
+                # Now try to find location again
+                status_dict = location.get_location(status_dict)
+                status_list[i] = status_dict
+                if status_dict.get('location') is None:
+                    log.error("Location not available for document id = %s", id_doc)
+                    continue
+
+            positions.append(i)
+            lat.append(float(status_dict['location']['latitude']))
+            lng.append(float(status_dict['location']['longitude']))
+
+        if not positions:
+            return status_list
+
+        cities = geocoder.get_geocoder(self.gazetteer).cities_batch(
+            lat,
+            lng,
+            max_distance=max_distance,
+            tile_size=self.geo_tile_size
+        )
+        for i, city in zip(positions, cities):
+            if city is not None:
+                status_list[i]['brasil_city'] = city
+
+        return status_list
+
+    def process_geo(self, id_doc, max_distance=50000, status_dict=None):
         """
         Get Brasil city distance from document
         :param max_distance: Max distance (Meters) to consider
+        :param status_dict: Status dict already fetched from base
         :return: JSON with Geo information from LBGeo
         """
-        status_dict = self.process_geo_dict(id_doc, max_distance)
+        status_dict = self.process_geo_dict(id_doc, max_distance, status_dict=status_dict)
         try:
             self.documentrest.update(
                 id_doc,
@@ -1129,14 +1322,13 @@ class StatusBase(LBSociam):
             order_by=orderby,
             literal=literal
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
+        url = self.schema.doc_url
         vars = {
             '$$': search._asjson()
         }
 
         # Envia requisição para o REST
-        response = requests.get(url, params=vars)
+        response = session.get(url, params=vars)
         collection = response.json()
 
         return collection
@@ -1258,14 +1450,14 @@ class Status(StatusClass):
         Convert status object to Python dict
         :return:
         """
-        return conv.document2dict(self.status_base.lbbase, self)
+        return self.status_base.converter.document2dict(self)
 
     def status_to_json(self):
         """
         Convert object to json
         :return:
         """
-        return conv.document2json(self.status_base.lbbase, self)
+        return self.status_base.converter.document2json(self)
 
     def create_status(self):
         """
@@ -1304,9 +1496,9 @@ class Status(StatusClass):
         Find category for this status
         """
         if status_dict is None:
-            self.status_to_dict()
+            status_dict = self.status_to_dict()
 
-        # Use default status base to calculate LDA Model
+        # Use default status base to load the stored LDA Model
         category = lda.get_category(
             status_dict,
             status_base,
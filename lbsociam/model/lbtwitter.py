@@ -132,6 +132,15 @@ class Twitter(LBSociam):
         :param tokenize: Whether we should tokenize it directly or not
         :return: True or None if it isn't possible to store it
         """
+        # Tokens created by other processes since the last import
+        self.dictionary_base.refresh_index()
+
+        # Dictionary frequencies are written in bulk
+        aggregator = dictionary.FrequencyAggregator(
+            self.dictionary_base,
+            max_tokens=self.frequency_flush_size,
+            max_age=self.frequency_flush_interval
+        )
         for elm in status_list:
             status_json = self.status_to_json([elm])
 
@@ -153,7 +162,7 @@ class Twitter(LBSociam):
 
                 continue
 
-            status_dict = conv.document2dict(self.status_base.lbbase, status)
+            status_dict = self.status_base.converter.document2dict(status)
 
             # Manually add id_doc
             status_dict['_metadata'] = dict()
@@ -162,7 +171,10 @@ class Twitter(LBSociam):
             if tokenize:
                 # SRL tokenize
                 if status_dict.get('text') is not None:
-                    tokenized = srl.srl_tokenize(status_dict['text'])
+                    tokenized = srl.srl_tokenize(
+                        status_dict['text'],
+                        cache=self.status_base.srl_cache
+                    )
                     if tokenized.get('arg_structures') is not None:
                         status_dict['arg_structures'] = tokenized.get('arg_structures')
                     if tokenized.get('tokens') is not None:
@@ -172,7 +184,7 @@ class Twitter(LBSociam):
             status_dict = location.get_location(status_dict)
 
             # Process tokens if selected
-            result = dictionary.process_tokens_dict(status_dict, self.dictionary_base)
+            result = dictionary.process_tokens_dict(status_dict, self.dictionary_base, aggregator=aggregator)
             log.info("Corpus da tokenizacao calculado. id_doc = %s", retorno)
             status_dict = result['status']
 
@@ -191,4 +203,6 @@ class Twitter(LBSociam):
             # Now update document back
             self.status_base.documentrest.update(retorno, json.dumps(status_dict))
 
+        aggregator.flush()
+
         return retorno
\ No newline at end of file
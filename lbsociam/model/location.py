@@ -3,7 +3,6 @@
 __author__ = 'eduardo'
 
 import logging
-import requests
 from lbsociam import LBSociam
 from liblightbase import lbrest
 from liblightbase.lbbase.struct import Base, BaseMetadata
@@ -12,6 +11,8 @@ from liblightbase.lbbase.lbstruct.field import *
 from liblightbase.lbbase.content import Content
 from liblightbase.lbsearch.search import *
 from liblightbase.lbutils import conv
+from lbsociam.lib import documents, session
+from lbsociam.model import schema
 from ..lib import dictionary
 
 log = logging.getLogger()
@@ -37,8 +38,32 @@ class LocationBase(LBSociam):
             response_object=False
         )
 
+    @property
+    def schema_key(self):
+        """
+        Identification of this base on schema registry
+        """
+        return 'location', 'location'
+
+    @property
+    def schema(self):
+        """
+        Base schema built once per process
+        """
+        return schema.registry.get(
+            self.schema_key,
+            self.build_lbbase,
+            self.lbgenerator_rest_url
+        )
+
     @property
     def lbbase(self):
+        """
+        Cached LB Base object
+        """
+        return self.schema.lbbase
+
+    def build_lbbase(self):
         """
         Generate LB Base object
         :return:
@@ -131,21 +156,21 @@ class LocationBase(LBSociam):
         """
         Retorna metaclass para essa base
         """
-        return self.lbbase.metaclass()
+        return self.schema.metaclass()
 
     @property
     def arg_structures(self):
         """
         Metaclass para o grupo
         """
-        return self.lbbase.metaclass('arg_structures')
+        return self.schema.metaclass('arg_structures')
 
     @property
     def argument(self):
         """
         Metaclass para o grupo
         """
-        return self.lbbase.metaclass('argument')
+        return self.schema.metaclass('argument')
 
     def create_base(self):
         """
@@ -177,6 +202,8 @@ class LocationBase(LBSociam):
         """
         response = self.baserest.update(self.lbbase)
         if response.status_code == 200:
+            # Make sure the next access gets the new structure
+            schema.registry.invalidate(self.schema_key)
             return True
         else:
             raise IOError('Error updating LB Base structure')
@@ -186,8 +213,8 @@ class LocationBase(LBSociam):
         Get base
         :return: Base JSON object
         """
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/doc'
-        response = requests.get(
+        url = self.schema.doc_url
+        response = session.get(
             url=url
         )
 
@@ -196,34 +223,40 @@ class LocationBase(LBSociam):
         else:
             raise IOError('Error getting LB Base structure')
 
-    def get_document_ids(self, offset=0):
+    def iter_documents(self,
+                       select=None,
+                       page_size=None,
+                       literal=None,
+                       offset=0,
+                       last_id_doc=None):
         """
-        Build a lis with all document ID's
+        Stream location documents page by page ordered by id_doc
+
+        :param select: Fields to be returned. Defaults to the whole document
+        :param page_size: Documents fetched per request. Defaults to config page_size
+        :param literal: Extra SQL filter
+        :param offset: Documents skipped on the first page
+        :param last_id_doc: Start scan after this id_doc
+        :return: Generator of document dicts
         """
-        orderby = OrderBy(asc=['id_doc'])
-        select = ['id_doc']
-        search = Search(
+        if page_size is None:
+            page_size = self.page_size
+
+        return documents.iter_documents(
+            self,
             select=select,
-            limit=None,
-            order_by=orderby,
-            offset=offset
+            page_size=page_size,
+            literal=literal,
+            offset=offset,
+            last_id_doc=last_id_doc
         )
-        url = self.documentrest.rest_url
-        url += "/" + self.lbbase._metadata.name + "/doc"
-        params = {
-            '$$': search._asjson()
-        }
 
-        # Envia requisição para o REST
-        response = requests.get(url, params=params)
-        collection = response.json()
+    def get_document_ids(self, offset=0):
+        """
+        Build a lis with all document ID's
+        """
         saida = list()
-
-        # Cria uma lista de resultados como ID
-        if collection.get('results') is None:
-            return None
-
-        for results in collection['results']:
+        for results in self.iter_documents(select=['id_doc'], offset=offset):
             saida.append(results['_metadata']['id_doc'])
 
         return saida
@@ -234,6 +267,16 @@ class LocationBase(LBSociam):
         """
         return self.documentrest.get(id_doc)
 
+    def get_documents(self, id_list, select=None):
+        """
+        Fetch many location documents in bulk
+
+        :param id_list: List of id_doc to fetch
+        :param select: Fields to be returned. Defaults to the whole document
+        :return: List of document dicts in id_list order. None for missing documents
+        """
+        return documents.get_documents(self, id_list, select=select)
+
     def get_location(self, name):
         """
         Find location in base
@@ -251,8 +294,8 @@ class LocationBase(LBSociam):
             'q': es_name
         }
 
-        url = self.lbgenerator_rest_url + '/' + self.lbbase.metadata.name + '/es/_search'
-        result = requests.get(
+        url = self.schema.search_url
+        result = session.get(
             url=url,
             params=params
         )
@@ -0,0 +1,94 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import logging
+from lbsociam.model.converter import DocumentConverter
+
+log = logging.getLogger()
+
+
+class SchemaEntry(object):
+    """
+    LB Base object and derived artifacts built once per process
+    """
+    def __init__(self, lbbase, rest_url):
+        """
+        Building method
+        :param lbbase: LB Base object
+        :param rest_url: LBGenerator REST URL
+        """
+        self.lbbase = lbbase
+        self.name = lbbase.metadata.name
+        self.base_url = rest_url + '/' + self.name
+        self.doc_url = self.base_url + '/doc'
+        self.search_url = self.base_url + '/es/_search'
+        self._metaclasses = dict()
+        self._converter = None
+
+    @property
+    def converter(self):
+        """
+        Document converter compiled from this base structure
+        """
+        if self._converter is None:
+            self._converter = DocumentConverter(self.lbbase)
+
+        return self._converter
+
+    def metaclass(self, group=None):
+        """
+        Cached metaclass for base or group
+        :param group: Group name. None for the base metaclass
+        :return: Metaclass
+        """
+        metaclass = self._metaclasses.get(group)
+        if metaclass is None:
+            if group is None:
+                metaclass = self.lbbase.metaclass()
+            else:
+                metaclass = self.lbbase.metaclass(group)
+
+            self._metaclasses[group] = metaclass
+
+        return metaclass
+
+
+class SchemaRegistry(object):
+    """
+    Process wide registry of base schemas
+    """
+    def __init__(self):
+        """
+        Building method
+        """
+        self._entries = dict()
+
+    def get(self, key, builder, rest_url):
+        """
+        Get schema entry, building it on first access
+        :param key: Base identification
+        :param builder: Function returning LB Base object
+        :param rest_url: LBGenerator REST URL
+        :return: SchemaEntry instance
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            log.debug("SCHEMA: building base schema for %s", key)
+            entry = SchemaEntry(builder(), rest_url)
+            self._entries[key] = entry
+
+        return entry
+
+    def invalidate(self, key=None):
+        """
+        Drop cached schema so it is built again on next access
+        :param key: Base identification. None drops every base
+        """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+registry = SchemaRegistry()
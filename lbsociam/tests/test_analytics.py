@@ -0,0 +1,170 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+from lbsociam.model.analytics import CategoryCounts, AnalyticsCube, RollupStore
+
+
+class TestCategoryCounts(unittest.TestCase):
+    """
+    Testa contagem de status por estado e categoria
+    """
+    def setUp(self):
+        """
+        Load test data
+        """
+        self.status_list = [
+            {'_metadata': {'id_doc': 1}, 'brasil_city': {'state_short_name': 'DF'},
+             'category': {'category_id_doc': 10}},
+            {'_metadata': {'id_doc': 2}, 'brasil_city': {'state_short_name': 'DF'},
+             'category': {'category_id_doc': 10}},
+            {'_metadata': {'id_doc': 3}, 'brasil_city': {'state_short_name': 'SP'},
+             'category': {'category_id_doc': 11}},
+            {'_metadata': {'id_doc': 4}, 'category': {'category_id_doc': 11}}
+        ]
+        pass
+
+    def test_merge(self):
+        """
+        Test partial counts merged give the same state list
+        """
+        first = CategoryCounts()
+        for status_dict in self.status_list[:2]:
+            first.add(status_dict)
+
+        second = CategoryCounts()
+        for status_dict in self.status_list[2:]:
+            second.add(status_dict)
+
+        first.merge(second)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(first.state_list(), [
+            {'state_uf': 'DF', 'category': [{'category_id_doc': 10, 'category_status': 2}]},
+            {'state_uf': 'SP', 'category': [{'category_id_doc': 11, 'category_status': 1}]}
+        ])
+
+
+class TestAnalyticsCube(unittest.TestCase):
+    """
+    Testa cubo de estados, categorias e dias
+    """
+    def setUp(self):
+        """
+        Load test data
+        """
+        self.status_list = [
+            {'brasil_city': {'state_short_name': 'DF'}, 'category': {'category_id_doc': 10},
+             'inclusion_date': '01/03/2016'},
+            {'brasil_city': {'state_short_name': 'DF'}, 'category': {'category_id_doc': 10},
+             'inclusion_date': '02/03/2016'},
+            {'brasil_city': {'state_short_name': 'SP'}, 'category': {'category_id_doc': 11},
+             'inclusion_datetime': '03/03/2016 10:00:00'},
+            {'brasil_city': {'state_short_name': 'SP'}, 'category': {'category_id_doc': 11},
+             'inclusion_date': '10/03/2016'},
+            {'category': {'category_id_doc': 11}, 'inclusion_date': '01/03/2016'}
+        ]
+        self.cube = AnalyticsCube.from_status(
+            self.status_list,
+            datetime.date(2016, 3, 1),
+            datetime.date(2016, 3, 5),
+            chunk_size=2
+        )
+        pass
+
+    def test_queries(self):
+        """
+        Test aggregations by state and category
+        """
+        self.assertEqual(self.cube.days, 5)
+        self.assertEqual(self.cube.by_state(), {'DF': 2, 'SP': 1})
+        self.assertEqual(self.cube.by_category(), {10: 2, 11: 1})
+        self.assertEqual(
+            self.cube.state_category(datetime.date(2016, 3, 2), datetime.date(2016, 3, 3)),
+            {'total_status': 2, 10: {'DF': 1}, 11: {'SP': 1}}
+        )
+        self.assertEqual(list(self.cube.rolling(2)), [1, 2, 2, 1, 0])
+        self.assertEqual(list(self.cube.daily(uf='SP')), [0, 0, 1, 0, 0])
+
+    def test_save(self):
+        """
+        Test cube stored on npz file
+        """
+        fd, filename = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        self.cube.save(filename)
+        cube = AnalyticsCube.load(filename)
+        os.remove(filename)
+
+        self.assertEqual(cube.start_date, self.cube.start_date)
+        self.assertEqual(cube.categories, [10, 11])
+        self.assertTrue((cube.data == self.cube.data).all())
+
+
+class TestRollupStore(unittest.TestCase):
+    """
+    Testa consolidação diária
+    """
+    def setUp(self):
+        """
+        Create rollups directory
+        """
+        self.path = tempfile.mkdtemp()
+        self.store = RollupStore(self.path)
+        for day, uf in (('2016-03-01', 'DF'), ('2016-03-02', 'SP')):
+            self.store.save({
+                'day': day,
+                'total_status': 2,
+                'total_all': 10,
+                'total_crimes': 4,
+                'total_positives': 3,
+                'state': [{'state_uf': uf, 'category': [{'category_id_doc': 10, 'category_status': 2}]}]
+            })
+        pass
+
+    def test_missing(self):
+        """
+        Test days without rollup
+        """
+        self.assertEqual(
+            self.store.missing(datetime.date(2016, 3, 1), datetime.date(2016, 3, 3)),
+            [datetime.date(2016, 3, 3)]
+        )
+
+    def test_sum(self):
+        """
+        Test rollups summed on interval
+        """
+        analysis = self.store.sum(datetime.date(2016, 3, 1), datetime.date(2016, 3, 2))
+        self.assertEqual(analysis['total_status'], 4)
+        self.assertEqual(analysis['total_all'], 20)
+        self.assertEqual(analysis['total_positives'], 6)
+        self.assertEqual(analysis['state'], [
+            {'state_uf': 'DF', 'category': [{'category_id_doc': 10, 'category_status': 2}]},
+            {'state_uf': 'SP', 'category': [{'category_id_doc': 10, 'category_status': 2}]}
+        ])
+        self.assertEqual(self.store.sum('02/03/2016', '02/03/2016')['total_crimes'], 4)
+
+    def test_cube(self):
+        """
+        Test cube filled from rollups and days replaced
+        """
+        cube = AnalyticsCube.from_rollups(self.store, datetime.date(2016, 3, 1), datetime.date(2016, 3, 3))
+        self.assertEqual(cube.state_category(), {'total_status': 4, 10: {'DF': 2, 'SP': 2}})
+
+        self.assertTrue(cube.set_day('2016-03-02', [
+            {'state_uf': 'RJ', 'category': [{'category_id_doc': 11, 'category_status': 5}]}
+        ]))
+        self.assertFalse(cube.set_day('2016-03-04', []))
+        self.assertEqual(cube.by_state(), {'DF': 2, 'RJ': 5})
+        self.assertEqual(list(cube.daily(category=11)), [0, 5, 0])
+
+    def tearDown(self):
+        """
+        Remove rollups directory
+        """
+        shutil.rmtree(self.path)
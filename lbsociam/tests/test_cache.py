@@ -0,0 +1,127 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from lbsociam.lib.cache import DiskCache, LRUCache
+
+
+class TestDiskCache(unittest.TestCase):
+    """
+    Testa cache em disco
+    """
+    def setUp(self):
+        """
+        Create cache directory
+        """
+        self.path = tempfile.mkdtemp()
+        pass
+
+    def test_get_set(self):
+        """
+        Test storing and reading entries
+        """
+        cache = DiskCache(self.path)
+        self.assertIsNone(cache.get(u'texto'))
+
+        value = {'tokens': [u'crime'], 'arg_structures': []}
+        cache.set(u'texto', value)
+        self.assertEqual(cache.get(u'texto'), value)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_eviction(self):
+        """
+        Test oldest entries are removed
+        """
+        cache = DiskCache(self.path, max_entries=2, check_interval=1)
+        for i in range(3):
+            cache.set('key%d' % i, i)
+            # Make mtime order explicit
+            os.utime(cache.filename('key%d' % i), (i, i))
+
+        cache.evict()
+        self.assertIsNone(cache.get('key0'))
+        self.assertEqual(cache.get('key2'), 2)
+
+    def test_eviction_sample(self):
+        """
+        Test eviction reads mtime only for a sample of entries
+        """
+        cache = DiskCache(self.path, max_entries=20, check_interval=1000, sample_size=4)
+        for i in range(22):
+            cache.set('key%d' % i, i)
+
+        stats = list()
+        getmtime = os.path.getmtime
+
+        def counted(filename):
+            stats.append(filename)
+            return getmtime(filename)
+
+        os.path.getmtime = counted
+        try:
+            removed = cache.evict()
+        finally:
+            os.path.getmtime = getmtime
+
+        self.assertEqual(removed, 2)
+        self.assertEqual(len(stats), 4)
+        self.assertEqual(len(cache.entries()), 20)
+
+    def test_ttl(self):
+        """
+        Test expired entries are not returned
+        """
+        cache = DiskCache(self.path, ttl=60)
+        cache.set('key', 1)
+        old = time.time() - 120
+        os.utime(cache.filename('key'), (old, old))
+        self.assertIsNone(cache.get('key'))
+
+    def tearDown(self):
+        """
+        Remove cache directory
+        """
+        shutil.rmtree(self.path)
+        pass
+
+
+class TestLRUCache(unittest.TestCase):
+    """
+    Testa cache em memória
+    """
+    def setUp(self):
+        """
+        Create cache
+        """
+        self.cache = LRUCache(max_entries=2)
+        pass
+
+    def test_eviction(self):
+        """
+        Test least recently used entry is removed
+        """
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('c', 3)
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        """
+        Test expired entries are not returned
+        """
+        self.cache.set('a', 1, ttl=-1)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['misses'], 1)
@@ -0,0 +1,82 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import json
+import unittest
+from liblightbase.lbutils import conv
+from lbsociam.model import lbstatus
+from lbsociam.model.converter import DocumentConverter
+
+
+class TestDocumentConverter(unittest.TestCase):
+    """
+    Testa conversão compilada de documentos
+    """
+    def setUp(self):
+        """
+        Load status base structure and test document
+        """
+        self.lbbase = lbstatus.status_base.lbbase
+        self.converter = DocumentConverter(self.lbbase)
+        self.document = {
+            'origin': 'twitter',
+            'inclusion_date': '01/03/2016',
+            'search_term': 'crime',
+            'text': u'Assalto com arma em Brasília',
+            'tokens': ['assalto', 'arma', u'brasília'],
+            'events_tokens': ['assalto'],
+            'arg_structures': [{
+                'predicate': 'assaltar',
+                'argument': [
+                    {'argument_name': 'A0', 'argument_value': ['assalto']},
+                    {'argument_name': 'A1', 'argument_value': ['arma', u'brasília']}
+                ]
+            }]
+        }
+        pass
+
+    def generic(self, document):
+        """
+        Conversion by liblightbase
+        """
+        return conv.document2dict(self.lbbase, conv.dict2document(self.lbbase, document))
+
+    def test_dict(self):
+        """
+        Test dict with nested multivalued group
+        """
+        saida = self.converter.document2dict(self.document)
+        self.assertEqual(saida, self.generic(self.document))
+        self.assertEqual(saida['arg_structures'][0]['argument'][1]['argument_value'], ['arma', u'brasília'])
+
+    def test_object(self):
+        """
+        Test document object
+        """
+        document = conv.dict2document(self.lbbase, self.document)
+        self.assertEqual(
+            self.converter.document2dict(document),
+            conv.document2dict(self.lbbase, document)
+        )
+
+    def test_unknown_field(self):
+        """
+        Test unknown fields go through liblightbase conversion
+        """
+        document = dict(self.document, unknown_field='value')
+        try:
+            expected = self.generic(document)
+        except Exception as e:
+            self.assertRaises(type(e), self.converter.document2dict, document)
+        else:
+            self.assertEqual(self.converter.document2dict(document), expected)
+
+    def test_json(self):
+        """
+        Test JSON output has the same document
+        """
+        self.assertEqual(
+            json.loads(self.converter.document2json(self.document)),
+            self.generic(self.document)
+        )
@@ -0,0 +1,71 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import unittest
+from lbsociam.lib import documents
+
+
+class FakeBase(object):
+    """
+    Base keeping documents in memory
+    """
+    def __init__(self, docs):
+        self.docs = docs
+
+    def iter_documents(self, select=None, last_id_doc=None):
+        for id_doc in sorted(self.docs):
+            if last_id_doc is None or id_doc > last_id_doc:
+                yield self.get(id_doc)
+
+    def get_documents(self, id_list, select=None):
+        return [self.get(id_doc) if id_doc in self.docs else None for id_doc in id_list]
+
+    def get(self, id_doc):
+        document = dict(self.docs[id_doc])
+        document['_metadata'] = dict(id_doc=id_doc)
+        return document
+
+
+class TestIterProcessed(unittest.TestCase):
+    """
+    Testa leitura incremental de documentos processados
+    """
+    def setUp(self):
+        """
+        Status 2 is still waiting for SRL
+        """
+        self.base = FakeBase({
+            1: dict(events_tokens=['assalto']),
+            2: dict(),
+            3: dict(events_tokens=['roubo'])
+        })
+        pass
+
+    def read(self, state, max_scans=10):
+        return [document['_metadata']['id_doc']
+                for document in documents.iter_processed(self.base, 'events_tokens', state, max_scans)]
+
+    def test_pending(self):
+        """
+        Status processed out of order are read on the next scan
+        """
+        state = dict(last_id_doc=None, pending=None)
+        self.assertEqual(self.read(state), [1, 3])
+        self.assertEqual(state['last_id_doc'], 3)
+        self.assertEqual(state['pending'], {'2': 1})
+
+        self.base.docs[2] = dict(events_tokens=['furto'])
+        self.base.docs[4] = dict(events_tokens=['crime'])
+        self.assertEqual(self.read(state), [2, 4])
+        self.assertEqual(state['last_id_doc'], 4)
+        self.assertEqual(state['pending'], dict())
+
+    def test_max_scans(self):
+        """
+        Status never processed are dropped after max_scans
+        """
+        state = dict(last_id_doc=None, pending=None)
+        self.read(state, max_scans=2)
+        self.assertEqual(self.read(state, max_scans=2), [])
+        self.assertEqual(state['pending'], dict())
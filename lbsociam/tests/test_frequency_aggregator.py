@@ -0,0 +1,113 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import unittest
+from lbsociam.lib.dictionary import FrequencyAggregator
+from lbsociam.model import dictionary
+
+
+class FakeDictionaryBase(dictionary.DictionaryBase):
+    """
+    Dictionary base recording searches instead of sending them
+    """
+    def __init__(self, found=None):
+        self.dictionary_base = 'test_frequency_aggregator'
+        self.found = found or dict()
+        self.searches = list()
+        self.updates = list()
+
+    def search_tokens(self, token_list, chunk_size=200):
+        self.searches.append(sorted(token_list))
+        saida = dict()
+        for token in token_list:
+            if token in self.found:
+                saida[token] = self.found[token]
+                self.index_token(token, self.found[token]['_metadata']['id_doc'], self.found[token]['frequency'])
+
+        return saida
+
+    def update_frequency(self, id_doc, frequency, token=None):
+        self.updates.append((id_doc, frequency))
+        self.index_token(token, id_doc, frequency)
+
+
+class TestFrequencyAggregator(unittest.TestCase):
+    """
+    Testa busca de tokens pelo índice
+    """
+    def setUp(self):
+        """
+        Load test index
+        """
+        self.dictionary_base = FakeDictionaryBase(found={
+            'assalto': dict(_metadata=dict(id_doc=10), token='assalto', frequency=7, status_list=[100]),
+            'roubo': dict(_metadata=dict(id_doc=20), token='roubo', frequency=3)
+        })
+        index = dictionary.TokenIndex()
+        index.add('assalto', 10, 5)
+        dictionary.token_indexes[self.dictionary_base.dictionary_base] = index
+        pass
+
+    def tearDown(self):
+        """
+        Remove test index
+        """
+        dictionary.token_indexes.pop(self.dictionary_base.dictionary_base, None)
+
+    def test_lookup_from_index(self):
+        """
+        Indexed tokens are served without a base search
+        """
+        aggregator = FrequencyAggregator(self.dictionary_base)
+        aggregator.lookup(['assalto'])
+
+        self.assertEqual(self.dictionary_base.searches, [])
+        self.assertTrue(aggregator.exists('assalto'))
+        self.assertEqual(aggregator.known['assalto']['_metadata']['id_doc'], 10)
+        self.assertEqual(aggregator.known['assalto']['frequency'], 5)
+
+    def test_lookup_misses(self):
+        """
+        Only missing tokens are searched and found ones are indexed
+        """
+        aggregator = FrequencyAggregator(self.dictionary_base)
+        aggregator.lookup(['assalto', 'roubo', 'furto'])
+
+        self.assertEqual(self.dictionary_base.searches, [['furto', 'roubo']])
+        self.assertTrue(aggregator.exists('roubo'))
+        self.assertFalse(aggregator.exists('furto'))
+        self.assertEqual(self.dictionary_base.index.get('roubo'), (20, 3))
+
+    def test_get_by_token(self):
+        """
+        Single token lookup uses the index
+        """
+        document = self.dictionary_base.get_by_token('assalto')
+
+        self.assertEqual(self.dictionary_base.searches, [])
+        self.assertEqual(document['_metadata']['id_doc'], 10)
+
+    def test_flush_from_base(self):
+        """
+        Index hits being increased use the stored document
+        """
+        aggregator = FrequencyAggregator(self.dictionary_base)
+        aggregator.add('assalto', 'assalt', 100)
+        aggregator.add('assalto', 'assalt', 101)
+        aggregator.flush()
+
+        # Status 100 is already counted and the stored frequency is newer than the index
+        self.assertEqual(self.dictionary_base.searches, [['assalto']])
+        self.assertEqual(self.dictionary_base.updates, [(10, 8)])
+        self.assertEqual(self.dictionary_base.index.get('assalto'), (10, 8))
+
+    def test_flush_processed_again(self):
+        """
+        Status already counted don't increase frequency
+        """
+        aggregator = FrequencyAggregator(self.dictionary_base)
+        aggregator.add('assalto', 'assalt', 100)
+        aggregator.flush()
+
+        self.assertEqual(self.dictionary_base.updates, [])
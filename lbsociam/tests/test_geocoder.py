@@ -0,0 +1,80 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import tempfile
+import unittest
+from lbsociam.lib import geocoder
+
+
+class TestGeocoder(unittest.TestCase):
+    """
+    Testa geocodificação reversa offline
+    """
+    def setUp(self):
+        """
+        Load test data
+        """
+        self.cities = [
+            dict(city_id=1, city_name=u'Brasília', state_short_name=u'DF',
+                 city_lat=-15.7801, city_lng=-47.9292),
+            dict(city_id=2, city_name=u'São Paulo', state_short_name=u'SP',
+                 city_lat=-23.5505, city_lng=-46.6333),
+            dict(city_id=3, city_name=u'Rio de Janeiro', state_short_name=u'RJ',
+                 city_lat=-22.9068, city_lng=-43.1729)
+        ]
+        self.geocoder = geocoder.Geocoder(self.cities)
+        pass
+
+    def test_haversine(self):
+        """
+        Test distance between Brasília and São Paulo
+        """
+        distance = geocoder.haversine(-15.7801, -47.9292, -23.5505, -46.6333)
+        self.assertAlmostEqual(distance / 1000, 874.6, delta=1)
+
+    def test_nearest(self):
+        """
+        Test nearest city and distance
+        """
+        city = self.geocoder.nearest(-15.79, -47.88)
+        self.assertEqual(city['city_name'], u'Brasília')
+        self.assertEqual(city['state_short_name'], u'DF')
+        self.assertLess(city['city_distance'], 10000)
+
+    def test_max_distance(self):
+        """
+        Test cities too far away are not returned
+        """
+        city = self.geocoder.nearest(-3.7319, -38.5267, max_distance=50000)
+        self.assertIsNone(city)
+
+    def test_nearest_batch(self):
+        """
+        Test batch results match single point results
+        """
+        lat = [-15.79, -3.7319, -23.55]
+        lng = [-47.88, -38.5267, -46.63]
+        cities = self.geocoder.cities_batch(lat, lng, max_distance=50000, tile_size=2)
+        self.assertEqual(len(cities), 3)
+        self.assertIsNone(cities[1])
+        for i in (0, 2):
+            single = self.geocoder.nearest(lat[i], lng[i])
+            self.assertEqual(cities[i]['city_name'], single['city_name'])
+            self.assertAlmostEqual(cities[i]['city_distance'], single['city_distance'], places=3)
+
+    def test_load(self):
+        """
+        Test loading gazetteer from CSV
+        """
+        fd, filename = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, "city_id,city_name,state_short_name,city_lat,city_lng\n"
+                     "1,Brasília,DF,-15.7801,-47.9292\n")
+        os.close(fd)
+
+        g = geocoder.Geocoder.load(filename)
+        os.remove(filename)
+
+        self.assertEqual(len(g), 1)
+        self.assertEqual(g.nearest(-15.78, -47.93)['city_name'], u'Brasília')
@@ -0,0 +1,142 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import json
+import time
+import threading
+import unittest
+from requests.exceptions import ConnectionError
+from lbsociam.lib.geostage import GeoStage
+
+
+class FakeStatusBase(object):
+    """
+    Status base recording path updates
+    """
+    def __init__(self):
+        self.updates = list()
+        self.touched = list()
+        self.lock = threading.Lock()
+
+    def update_path(self, id_doc, path, value):
+        with self.lock:
+            self.updates.append((id_doc, path, json.loads(value)))
+
+    def touch(self, status_list):
+        with self.lock:
+            self.touched.append(list(status_list))
+
+
+class BlockingStage(GeoStage):
+    """
+    Stage waiting for a signal before finishing every status
+    """
+    def __init__(self, *args, **kwargs):
+        GeoStage.__init__(self, *args, **kwargs)
+        self.processing = threading.Event()
+        self.release = threading.Event()
+
+    def process(self, id_doc, status_dict):
+        self.processing.set()
+        self.release.wait()
+        self.collect(id_doc, status_dict)
+        return True
+
+
+class FailingStage(GeoStage):
+    """
+    Stage failing with connection errors a few times
+    """
+    def __init__(self, failures, *args, **kwargs):
+        GeoStage.__init__(self, *args, **kwargs)
+        self.failures = failures
+
+    def process(self, id_doc, status_dict):
+        with self.lock:
+            self.failures -= 1
+            if self.failures >= 0:
+                raise ConnectionError('connection refused')
+
+        return True
+
+
+class TestGeoStage(unittest.TestCase):
+    """
+    Testa geocodificação em threads
+    """
+    def setUp(self):
+        """
+        Status with location found
+        """
+        self.status_base = FakeStatusBase()
+        self.status_dict = dict(
+            location=dict(latitude=-15.79, longitude=-47.88),
+            brasil_city=dict(city_name='Brasília', state_short_name='DF')
+        )
+        pass
+
+    def test_submit_blocks(self):
+        """
+        Submit blocks while the queue is full and join drains it
+        """
+        stage = BlockingStage(self.status_base, concurrency=1, queue_size=2).start()
+        stage.submit(1, dict(self.status_dict))
+        # Thread is holding status 1, so the next two fill the queue
+        self.assertTrue(stage.processing.wait(5))
+        stage.submit(2, dict(self.status_dict))
+        stage.submit(3, dict(self.status_dict))
+
+        submitter = threading.Thread(target=stage.submit, args=(4, dict(self.status_dict)))
+        submitter.start()
+        time.sleep(0.2)
+        self.assertTrue(submitter.is_alive())
+
+        stage.release.set()
+        submitter.join(5)
+        self.assertFalse(submitter.is_alive())
+
+        stats = stage.join()
+        self.assertEqual(stats['submitted'], 4)
+        self.assertEqual(stats['found'], 4)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(len(self.status_base.updates), 8)
+
+    def test_collect(self):
+        """
+        Location and Brasil city are written to status
+        """
+        self.status_dict['inclusion_date'] = '01/03/2016'
+        stage = GeoStage(self.status_base, queue_size=2)
+        stage.collect(10, self.status_dict)
+        self.assertEqual(self.status_base.updates, [
+            (10, 'location', self.status_dict['location']),
+            (10, 'brasil_city', self.status_dict['brasil_city'])
+        ])
+
+        # Changed days are recorded once for every queue of status
+        self.assertEqual(self.status_base.touched, [])
+        stage.collect(11, self.status_dict)
+        self.assertEqual([len(batch) for batch in self.status_base.touched], [2])
+        stage.collect(12, self.status_dict)
+        stage.join()
+        self.assertEqual([len(batch) for batch in self.status_base.touched], [2, 1])
+        self.assertEqual(self.status_base.touched[0][0]['inclusion_date'], '01/03/2016')
+
+    def test_retry(self):
+        """
+        Connection errors are retried up to the limit
+        """
+        stage = FailingStage(2, self.status_base, concurrency=1, retries=3, retry_interval=0).start()
+        stage.submit(1, dict(self.status_dict))
+        stats = stage.join()
+        self.assertEqual(stats['found'], 1)
+        self.assertEqual(stats['retried'], 2)
+        self.assertEqual(stats['errors'], 0)
+
+        stage = FailingStage(5, self.status_base, concurrency=1, retries=2, retry_interval=0).start()
+        stage.submit(2, dict(self.status_dict))
+        stats = stage.join()
+        self.assertEqual(stats['found'], 0)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stage.failed, [2])
@@ -0,0 +1,55 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import shutil
+import tempfile
+import unittest
+from lbsociam.lib.jsonqueue import JsonQueue
+
+
+class TestJsonQueue(unittest.TestCase):
+    """
+    Testa fila de entradas JSON
+    """
+    def setUp(self):
+        """
+        Create queue directory
+        """
+        self.path = tempfile.mkdtemp()
+        self.queue = JsonQueue(os.path.join(self.path, 'queue.jsonl'))
+        pass
+
+    def test_take(self):
+        """
+        Test entries are taken once
+        """
+        self.assertEqual(self.queue.take(), [])
+        self.queue.put(location=u'Brasília', id_doc=1)
+        self.queue.put(location=u'Goiânia', id_doc=2)
+        self.assertEqual(len(self.queue), 2)
+
+        entries = self.queue.take()
+        self.assertEqual([elm['id_doc'] for elm in entries], [1, 2])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_read_remove(self):
+        """
+        Test entries appended after read are kept on remove
+        """
+        self.assertEqual(self.queue.read(), ([], 0))
+        self.queue.put(id_doc=1)
+        entries, size = self.queue.read()
+        self.assertEqual(entries, [{'id_doc': 1}])
+        self.assertEqual(len(self.queue), 1)
+
+        self.queue.put(id_doc=2)
+        self.queue.remove(size)
+        self.assertEqual(self.queue.take(), [{'id_doc': 2}])
+
+    def tearDown(self):
+        """
+        Remove queue directory
+        """
+        shutil.rmtree(self.path)
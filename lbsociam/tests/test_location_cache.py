@@ -0,0 +1,77 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import shutil
+import tempfile
+import unittest
+from lbsociam.lib import location as liblocation
+
+
+class FakeLocationBase(object):
+    """
+    Locations base answering from a dict
+    """
+    def __init__(self, locations):
+        self.locations = locations
+        self.searches = 0
+
+    def get_location(self, name):
+        self.searches += 1
+        return self.locations.get(name)
+
+
+class TestLocationCache(unittest.TestCase):
+    """
+    Testa cache de localizações
+    """
+    def setUp(self):
+        """
+        Create cache directory
+        """
+        self.path = tempfile.mkdtemp()
+        self.location_base = FakeLocationBase({
+            u'Brasília': {
+                'latitude': -15.7801,
+                'longitude': -47.9292,
+                'location_name': u'Brasília',
+                'id_location': 1,
+                'score': 10
+            }
+        })
+        pass
+
+    def test_normalize(self):
+        """
+        Test equivalent strings share the same key
+        """
+        self.assertEqual(liblocation.normalize(u' Brasília - DF!'), u'brasília df')
+        self.assertEqual(liblocation.normalize('Brasília, DF'), u'brasília df')
+
+    def test_tiers(self):
+        """
+        Test base is searched only once
+        """
+        cache = liblocation.LocationCache(self.path)
+        result = cache.search(self.location_base, u'Brasília')
+        self.assertEqual(result['id_location'], 1)
+        self.assertNotIn('score', result)
+
+        cache.search(self.location_base, u'brasília')
+        self.assertEqual(self.location_base.searches, 1)
+
+        # New process reads from disk
+        other = liblocation.LocationCache(self.path)
+        self.assertEqual(other.search(self.location_base, u'BRASÍLIA')['latitude'], -15.7801)
+        self.assertEqual(self.location_base.searches, 1)
+
+        stats = cache.stats()
+        self.assertEqual(stats['base'], 1)
+        self.assertEqual(stats['memory'], 1)
+        self.assertEqual(other.stats()['disk'], 1)
+
+    def tearDown(self):
+        """
+        Remove cache directory
+        """
+        shutil.rmtree(self.path)
@@ -0,0 +1,59 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from lbsociam.lib.ratelimit import TokenBucket, SharedQuota
+
+
+class TestRateLimit(unittest.TestCase):
+    """
+    Testa limite de requisições
+    """
+    def setUp(self):
+        """
+        Create state directory
+        """
+        self.path = tempfile.mkdtemp()
+        pass
+
+    def test_token_bucket(self):
+        """
+        Test requests above capacity are not allowed
+        """
+        bucket = TokenBucket(rate=1, capacity=2)
+        self.assertTrue(bucket.acquire(block=False))
+        self.assertTrue(bucket.acquire(block=False))
+        self.assertFalse(bucket.acquire(block=False))
+
+    def test_daily_limit(self):
+        """
+        Test quota is shared by instances on the same file
+        """
+        filename = os.path.join(self.path, 'quota.json')
+        quota = SharedQuota(filename, daily_limit=2)
+        other = SharedQuota(filename, daily_limit=2)
+        self.assertTrue(quota.consume())
+        self.assertTrue(other.consume())
+        self.assertFalse(quota.consume())
+        self.assertGreater(other.state()['wakeup_time'], time.time())
+
+    def test_sleep(self):
+        """
+        Test no requests are made while sleeping
+        """
+        quota = SharedQuota(os.path.join(self.path, 'quota.json'))
+        quota.sleep(60)
+        self.assertFalse(quota.consume())
+        quota.sleep(-1)
+        self.assertTrue(quota.consume())
+
+    def tearDown(self):
+        """
+        Remove state directory
+        """
+        shutil.rmtree(self.path)
@@ -0,0 +1,43 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+__author__ = 'eduardo'
+
+import unittest
+from lbsociam.lib.dictionary import TokenFilter
+
+
+class TestTokenFilter(unittest.TestCase):
+    """
+    Testa filtro de tokens
+    """
+    def setUp(self):
+        """
+        Load test data
+        """
+        self.token_filter = TokenFilter(stopwords=['para', 'com', 'uma'])
+        pass
+
+    def test_is_valid(self):
+        """
+        Test single token validation
+        """
+        assert self.token_filter.is_valid('assalto')
+        assert not self.token_filter.is_valid('para')
+        assert not self.token_filter.is_valid('https')
+        assert not self.token_filter.is_valid('ab')
+        assert not self.token_filter.is_valid('...')
+
+    def test_filter_tokens(self):
+        """
+        Test list filtering and punctuation removal
+        """
+        tokens = ['assalto', 'com', 'arma', 'roubo!', 'co', '#crime']
+        result = self.token_filter.filter_tokens(tokens)
+        self.assertEqual(result, ['assalto', 'arma', 'roubo'])
+
+    def test_unicode_tokens(self):
+        """
+        Test unicode tokens keep accents and lose punctuation
+        """
+        result = self.token_filter.filter_tokens([u'polícia.', u'uma'])
+        self.assertEqual(result, [u'polícia'])
@@ -15,7 +15,9 @@ requires = [
     'PasteScript',
     'gensim',
     'googlemaps',
-    'beaker'
+    'beaker',
+    'numpy',
+    'scipy'
     ]
 
 